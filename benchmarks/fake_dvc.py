@@ -0,0 +1,116 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Stand-in for the dvc executable, used to measure the overhead of running it.
+
+Usage:
+    python fake_dvc.py dvc_config.txt
+
+It reads the configuration written by the app, prints a "N/M" progress line for each
+point, like the dvc executable, and writes well-formed .disp and .stat files. The
+displacement of every point is the rigid_trans of the configuration. Only the standard
+library is imported, so that its start up time is close to the one of the executable.
+
+The timing is set by environment variables:
+
+- IDVC_FAKE_DVC_RATE: points processed per second by each OMP thread, 0 (the default)
+  to process the points as fast as possible.
+- IDVC_FAKE_DVC_LOAD_TIME: time spent loading the volumes, in seconds, default 0.
+- IDVC_FAKE_DVC_FAIL: if set, the process prints an input error and exits with 1.
+'''
+
+import os
+import sys
+import time
+
+# order of the fields in the .stat file, read by position by idvc.utilities.RunResults
+STAT_FIELDS = ['reference_filename', 'correlate_filename', 'point_cloud_filename', 'output_filename',
+               'vol_bit_depth', 'vol_hdr_lngth', 'vol_wide', 'vol_high', 'vol_tall', 'vol_endian',
+               'num_points_to_process', 'starting_point', 'points_processed', 'points_converged', 'run_time',
+               'subvol_geom', 'subvol_size', 'subvol_npts', 'subvol_thresh', 'gray_thresh_min',
+               'gray_thresh_max', 'disp_max', 'num_srch_dof', 'obj_function', 'interp_type', 'min_vol_fract',
+               'rigid_trans', 'basin_radius', 'subvol_aspect']
+
+def read_config(config_filename):
+    '''Returns a dictionary of the fields of a dvc configuration file'''
+    fields = {}
+    with open(config_filename) as f:
+        for line in f:
+            words = line.split(None, 1)
+            if words and not line.startswith('#'):
+                fields[words[0]] = words[1].split('###')[0].strip() if len(words) > 1 else ''
+    return fields
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1 or not os.path.exists(argv[0]):
+        print("Input Error: usage fake_dvc.py <config file>", flush=True)
+        return 1
+    config = read_config(argv[0])
+    if os.environ.get('IDVC_FAKE_DVC_FAIL'):
+        print("Input Error: failure requested by IDVC_FAKE_DVC_FAIL", flush=True)
+        return 1
+    start = time.time()
+    time.sleep(float(os.environ.get('IDVC_FAKE_DVC_LOAD_TIME', 0)))
+
+    with open(config['point_cloud_filename']) as f:
+        points = [line.split() for line in f if line.strip()]
+    points = points[:int(config.get('num_points_to_process', len(points)))]
+    rate = float(os.environ.get('IDVC_FAKE_DVC_RATE', 0)) * int(os.environ.get('OMP_NUM_THREADS', 1))
+    displacement = [float(value) for value in config.get('rigid_trans', '0 0 0').split()]
+    columns = ['n', 'x', 'y', 'z', 'status', 'objmin', 'u', 'v', 'w']
+    if int(config.get('num_srch_dof', 3)) >= 6:
+        columns += ['phi', 'the', 'psi']
+
+    output_filename = config['output_filename']
+    with open(output_filename + '.disp', 'w') as disp:
+        disp.write('\t'.join(columns) + '\n')
+        total = len(points)
+        for i, point in enumerate(points, 1):
+            if rate > 0:
+                # keeps the average rate, the sleeps are shorter than the scheduler resolution
+                delay = start + i / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            values = point[:4] + ['0', '0.01'] + ['{:.3f}'.format(value) for value in displacement]
+            values += ['0.000'] * (len(columns) - len(values))
+            disp.write('\t'.join(values) + '\n')
+            print("{}/{}".format(i, total), flush=True)
+
+    config['points_processed'] = str(len(points))
+    config['points_converged'] = str(len(points))
+    config['run_time'] = '{:.3f}'.format(time.time() - start)
+    # the executable writes the rigid body offset rounded to voxels
+    config['rigid_trans'] = ' '.join(str(int(round(value))) for value in displacement)
+    with open(output_filename + '.stat', 'w') as stat:
+        for field in STAT_FIELDS:
+            stat.write('\t'.join([field] + config.get(field, '').split()) + '\n')
+    return 0
+
+def make_dvc_executable(folder):
+    '''Writes a launcher of this script in folder, which can be used as the dvc executable,
+    e.g. with the IDVC_DVC_EXECUTABLE environment variable. Returns its path.'''
+    script = os.path.abspath(__file__)
+    if sys.platform.startswith('win'):
+        path = os.path.join(folder, 'dvc.bat')
+        with open(path, 'w') as f:
+            f.write('@"{}" "{}" %*\n'.format(sys.executable, script))
+    else:
+        path = os.path.join(folder, 'dvc')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, script))
+        os.chmod(path, 0o755)
+    return path
+
+
+if __name__ == '__main__':
+    sys.exit(main())
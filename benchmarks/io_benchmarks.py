@@ -0,0 +1,345 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Benchmarks of the reading and conversion of the volume formats accepted by
+ImageDataCreator.createImageData.
+
+Usage:
+    python -m benchmarks.io_benchmarks --dims 512 512 512 --dtype uint16 --output io.json
+    python -m benchmarks.io_benchmarks --dims 512 512 512 --dtype uint16 --baseline io.json
+
+A synthetic volume of the given dimensions and type, a gradient along z with noise, is
+written as .raw, .npy, .mha, compressed .mha, .mhd with its .raw, a TIFF stack and a
+chunked, gzip compressed NeXus file. It is generated a slice at a time, so it does not
+have to fit in memory. For each format, the scenarios time:
+
+- resample: the display loader with resample=True, with the target size of --target-size,
+  by default an eighth of the volume.
+- crop: the loader with crop_image=True, on an eighth of the slices in the middle of the volume.
+- load: the full resolution loader. Uncompressed volumes are memory mapped, so their voxels
+  are only read when they are displayed.
+- to_raw: the conversion to raw for the dvc executable, save_tiff_stack_as_raw,
+  save_nxs_as_raw, or loadMetaImage with convert_raw for compressed MetaImage files.
+
+The loaders are loadTif, loadNpyImage, loadMetaImage and saveRawImageData for raw files.
+Each scenario runs in a new process, so that its peak resident set size is measured alone.
+The throughput is the size of the volume divided by the time; the volumes are read from
+the page cache if it holds them. The dvc_engine conversions use the same functions.
+
+idvc.io imports the graphical interface dependencies, PySide2, eqt and ccpi-viewer: without
+them the volumes are written, but the scenarios are skipped.
+
+The throughput and peak memory of each scenario are compared to the baseline, if given, and
+the exit code is 1 if any is worse than the baseline by more than the tolerance.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import zlib
+import argparse
+import tempfile
+import importlib
+import importlib.util
+import multiprocessing
+
+import numpy as np
+import h5py
+import vtk
+from vtk.util import numpy_support
+
+from idvc.idvc_run import NoOpCallback
+
+FORMATS = ['raw', 'npy', 'mha', 'mha_compressed', 'mhd', 'tiff', 'nxs']
+SCENARIOS = ['resample', 'crop', 'load', 'to_raw']
+# scenarios of the paths of the app for each format
+FORMAT_SCENARIOS = {'raw': ['resample', 'crop', 'load'],
+                    'npy': ['resample', 'crop', 'load'],
+                    'mha': ['resample', 'crop', 'load'],
+                    'mha_compressed': ['resample', 'crop', 'load', 'to_raw'],
+                    'mhd': ['resample', 'crop', 'load'],
+                    'tiff': ['resample', 'crop', 'to_raw'],
+                    'nxs': ['to_raw']}
+METAIMAGE_TYPES = {'uint8': 'MET_UCHAR', 'uint16': 'MET_USHORT', 'float32': 'MET_FLOAT'}
+NXS_DATASET = 'entry1/tomo_entry/data/data'
+
+def synthetic_slice(z, dims, dtype, rng):
+    '''Returns the slice z of the synthetic volume, indexed y, x: a gradient along z with noise,
+    so that it compresses like a scan rather than like random or constant data'''
+    nx, ny, nz = dims
+    high = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1000.
+    level = high * (0.25 + 0.5 * z / max(nz - 1, 1))
+    values = rng.normal(level, 0.02 * high, size=(ny, nx))
+    return np.clip(values, 0, high).astype(dtype)
+
+def iter_slices(dims, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    for z in range(dims[2]):
+        yield synthetic_slice(z, dims, dtype, rng)
+
+def write_metaimage(filename, dims, dtype, compressed=False, data_filename=None):
+    '''Writes the synthetic volume as MetaImage, with the voxels in data_filename if given,
+    otherwise after the header. Compressed data is a single zlib stream.'''
+    fields = [('ObjectType', 'Image'), ('NDims', 3), ('BinaryData', 'True'),
+              ('BinaryDataByteOrderMSB', 'False'), ('CompressedData', str(compressed))]
+    tmp_filename = filename + '.data'
+    with open(tmp_filename, 'wb') as f:
+        compressor = zlib.compressobj(1) if compressed else None
+        for data in iter_slices(dims, dtype):
+            data = data.astype(np.dtype(dtype).newbyteorder('<')).tobytes()
+            f.write(compressor.compress(data) if compressed else data)
+        if compressed:
+            f.write(compressor.flush())
+    if compressed:
+        fields.append(('CompressedDataSize', os.path.getsize(tmp_filename)))
+    fields += [('DimSize', ' '.join(str(d) for d in dims)), ('ElementSpacing', '1 1 1'),
+               ('ElementType', METAIMAGE_TYPES[np.dtype(dtype).name]),
+               ('ElementDataFile', 'LOCAL' if data_filename is None else os.path.basename(data_filename))]
+    with open(filename, 'w') as f:
+        f.write(''.join('{} = {}\n'.format(key, value) for key, value in fields))
+    if data_filename is None:
+        with open(filename, 'ab') as f, open(tmp_filename, 'rb') as data:
+            shutil.copyfileobj(data, f)
+        os.remove(tmp_filename)
+    else:
+        os.replace(tmp_filename, data_filename)
+
+def write_volume(folder, fmt, dims, dtype):
+    '''Writes the synthetic volume in folder in the format fmt, returns the list of its image files'''
+    if fmt == 'raw':
+        filename = os.path.join(folder, 'volume.raw')
+        with open(filename, 'wb') as f:
+            for data in iter_slices(dims, dtype):
+                f.write(data.astype(np.dtype(dtype).newbyteorder('<')).tobytes())
+        return [filename]
+    elif fmt == 'npy':
+        filename = os.path.join(folder, 'volume.npy')
+        volume = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=tuple(dims[::-1]))
+        for z, data in enumerate(iter_slices(dims, dtype)):
+            volume[z] = data
+        volume.flush()
+        del volume
+        return [filename]
+    elif fmt in ['mha', 'mha_compressed']:
+        filename = os.path.join(folder, fmt + '.mha')
+        write_metaimage(filename, dims, dtype, compressed=fmt == 'mha_compressed')
+        return [filename]
+    elif fmt == 'mhd':
+        filename = os.path.join(folder, 'volume.mhd')
+        write_metaimage(filename, dims, dtype, data_filename=os.path.join(folder, 'volume_mhd.raw'))
+        return [filename]
+    elif fmt == 'tiff':
+        tiff_folder = os.path.join(folder, 'tiff')
+        os.makedirs(tiff_folder, exist_ok=True)
+        filenames = []
+        writer = vtk.vtkTIFFWriter()
+        for z, data in enumerate(iter_slices(dims, dtype)):
+            image = vtk.vtkImageData()
+            image.SetDimensions(dims[0], dims[1], 1)
+            image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(data.ravel(), deep=True))
+            filenames.append(os.path.join(tiff_folder, 'slice_{:05d}.tif'.format(z)))
+            writer.SetFileName(filenames[-1])
+            writer.SetInputData(image)
+            writer.Write()
+        return filenames
+    elif fmt == 'nxs':
+        filename = os.path.join(folder, 'volume.nxs')
+        chunks = tuple(min(64, d) for d in dims[::-1])
+        with h5py.File(filename, 'w') as f:
+            data = f.create_dataset(NXS_DATASET, shape=tuple(dims[::-1]), dtype=dtype, chunks=chunks,
+                                    compression='gzip', shuffle=True)
+            slab = []
+            for z, slice_data in enumerate(iter_slices(dims, dtype)):
+                slab.append(slice_data)
+                if len(slab) == chunks[0] or z == dims[2] - 1:
+                    data[z + 1 - len(slab):z + 1] = np.stack(slab)
+                    slab = []
+        return [filename]
+    raise ValueError("Unknown format {}".format(fmt))
+
+def peak_rss():
+    '''Returns the peak resident set size of the process in MB, or None if it is not available'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in kilobytes, except on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def crop_extent(dims):
+    '''Returns the z extent of the crop scenario, an eighth of the slices in the middle of the volume'''
+    depth = max(dims[2] // 8, 1)
+    start = (dims[2] - depth) // 2
+    return start, start + depth - 1
+
+def run_loader(fmt, scenario, files, dims, dtype, target_size, output_folder):
+    '''Runs the loader or conversion of a scenario, as the app does'''
+    from idvc import io
+    from ccpi.viewer.utils.error_handling import ErrorObserver
+
+    class LoaderWindow(object):
+        '''The attributes of the main window read by the loaders: the VTK error observer and the type
+        chosen in the raw import dialog'''
+        class TypeCodeName(object):
+            def currentText(self):
+                return np.dtype(dtype).name
+        def __init__(self):
+            self.e = ErrorObserver()
+            self.raw_import_dialog = {'dtype': self.TypeCodeName()}
+
+    progress_callback = NoOpCallback()
+    output_image = vtk.vtkImageData()
+    z_extent = crop_extent(dims)
+    kwargs = dict(output_image=output_image, resample=scenario == 'resample', crop_image=scenario == 'crop',
+                  target_size=target_size, origin=(0, 0, 0), target_z_extent=z_extent,
+                  progress_callback=progress_callback)
+    if scenario == 'to_raw' and fmt == 'tiff':
+        io.save_tiff_stack_as_raw(files, os.path.join(output_folder, 'converted.raw'), progress_callback, 0, 100)
+    elif scenario == 'to_raw' and fmt == 'nxs':
+        io.save_nxs_as_raw(files[0], NXS_DATASET, os.path.join(output_folder, 'converted.raw'),
+                           progress_callback, 0, 100)
+    elif fmt == 'tiff':
+        io.loadTif(files, kwargs.pop('output_image'), image_info={}, **kwargs)
+    elif fmt == 'npy':
+        io.loadNpyImage(image_file=files[0], image_info={}, **kwargs)
+    elif fmt == 'raw':
+        info_var = {'file_type': 'raw', 'dimensions': list(dims), 'isFortran': False, 'isBigEndian': False,
+                    'typcode': io.RAW_TYPECODES.index(np.dtype(dtype).name)}
+        errors = io.saveRawImageData(main_window=LoaderWindow(), fname=files[0], info_var=info_var, **kwargs)
+        if errors:
+            raise ValueError("The raw file does not have the expected size: {}".format(errors))
+    else:
+        io.loadMetaImage(main_window=LoaderWindow(), image=files[0], image_info={},
+                         convert_raw=scenario == 'to_raw', output_dir=output_folder, **kwargs)
+
+def run_scenario(fmt, scenario, files, dims, dtype, target_size, output_folder):
+    '''Runs a scenario in the current process, returns its time in seconds, the peak resident set
+    size of the process before and after it in MB'''
+    # the imports are not part of the time or memory of the scenario
+    _ = importlib.import_module("idvc.io")
+    baseline_rss = peak_rss()
+    start = time.perf_counter()
+    run_loader(fmt, scenario, files, dims, dtype, target_size, output_folder)
+    elapsed = time.perf_counter() - start
+    return elapsed, baseline_rss, peak_rss()
+
+def bench_io(folder, formats, scenarios, dims, dtype, target_size, repeat=1):
+    '''Writes the volumes in folder and times the scenarios, each in a new process.
+    Returns a list of dictionaries of the results.'''
+    size_mb = int(np.prod(dims)) * np.dtype(dtype).itemsize / 1024**2
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for fmt in formats:
+        start = time.perf_counter()
+        files = write_volume(folder, fmt, dims, dtype)
+        print("Wrote {} in {:.1f} s".format(fmt, time.perf_counter() - start))
+        for scenario in [s for s in scenarios if s in FORMAT_SCENARIOS[fmt]]:
+            output_folder = tempfile.mkdtemp(dir=folder)
+            timings = []
+            try:
+                for _ in range(repeat):
+                    with context.Pool(1) as pool:
+                        timings.append(pool.apply(run_scenario, (fmt, scenario, files, dims, dtype,
+                                                                 target_size, output_folder)))
+            finally:
+                shutil.rmtree(output_folder, ignore_errors=True)
+            elapsed, baseline_rss, peak = min(timings)
+            results.append({'format': fmt, 'scenario': scenario, 'dims': list(dims), 'dtype': np.dtype(dtype).name,
+                            'size_mb': size_mb, 'time': elapsed, 'throughput': size_mb / elapsed,
+                            'baseline_rss': baseline_rss, 'peak_rss': peak})
+    return results
+
+def compare(results, baseline, tolerance):
+    '''Returns the lines describing the results with a throughput lower, or a peak memory higher,
+    than the baseline by more than tolerance'''
+    def key(r):
+        return r['format'], r['scenario'], tuple(r['dims']), r['dtype']
+    reference = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        if key(r) not in reference:
+            continue
+        b = reference[key(r)]
+        if r['throughput'] < b['throughput'] * (1 - tolerance):
+            regressions.append("{} {}: {:.1f} MB/s, baseline {:.1f} MB/s".format(
+                r['format'], r['scenario'], r['throughput'], b['throughput']))
+        if r['peak_rss'] is not None and b['peak_rss'] is not None and \
+                r['peak_rss'] > b['peak_rss'] * (1 + tolerance):
+            regressions.append("{} {}: peak memory {:.0f} MB, baseline {:.0f} MB".format(
+                r['format'], r['scenario'], r['peak_rss'], b['peak_rss']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='iDVC - benchmarks of the reading and conversion of the volume formats')
+    parser.add_argument('--dims', type=int, nargs=3, default=[256, 256, 256], help='dimensions of the volume, x y z')
+    parser.add_argument('--dtype', type=str, default='uint16', choices=sorted(METAIMAGE_TYPES),
+                        help='type of the voxels')
+    parser.add_argument('--formats', type=str, nargs='+', default=FORMATS, choices=FORMATS,
+                        help='formats of the volume')
+    parser.add_argument('--scenarios', type=str, nargs='+', default=SCENARIOS, choices=SCENARIOS,
+                        help='paths timed for each format')
+    parser.add_argument('--target-size', type=float, default=None,
+                        help='target size of the resampled volumes in GB, by default an eighth of the volume')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each scenario, the fastest is kept')
+    parser.add_argument('--folder', type=str, default=None,
+                        help='folder the volumes are written to, by default a temporary folder which is removed')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are written to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON file of results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative loss of throughput, or increase of peak memory, reported as a regression')
+    args = parser.parse_args(argv)
+
+    dtype = np.dtype(args.dtype)
+    target_size = args.target_size
+    if target_size is None:
+        target_size = int(np.prod(args.dims)) * dtype.itemsize / 8 / 1024**3
+    scenarios = args.scenarios
+    try:
+        # the idvc package imports ccpi-viewer
+        if importlib.util.find_spec("idvc.io") is None:
+            raise ImportError("No module named 'idvc.io'")
+    except ImportError as err:
+        print("The scenarios are skipped, they need the graphical interface dependencies: {}".format(err))
+        scenarios = []
+
+    folder = args.folder if args.folder is not None else tempfile.mkdtemp(prefix="idvc_io_benchmark_")
+    os.makedirs(folder, exist_ok=True)
+    try:
+        results = bench_io(folder, args.formats, scenarios, args.dims, dtype, target_size, args.repeat)
+    finally:
+        if args.folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    print("{:<16}{:<10}{:>10}{:>10}{:>16}".format("format", "scenario", "time (s)", "MB/s", "peak RSS (MB)"))
+    for r in results:
+        peak = "" if r['peak_rss'] is None else "{:.0f}".format(r['peak_rss'])
+        print("{:<16}{:<10}{:>10.3f}{:>10.1f}{:>16}".format(r['format'], r['scenario'], r['time'],
+                                                           r['throughput'], peak))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("Regression: " + line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Benchmarks of the overhead of running the dvc executable, apart from the correlation itself.
+
+Usage:
+    python -m benchmarks.runner_benchmarks --sizes 1 10 100 1000 --output runner.json
+    python -m benchmarks.runner_benchmarks --baseline runner.json
+
+The dvc executable is replaced by benchmarks/fake_dvc.py, which processes the points
+as fast as possible unless --rate is given. For each number of configurations of a
+bulk run, the scenarios time:
+
+- set_up: DVCEngine.set_up, which writes the run folders and configurations.
+  DVC_runner.set_up delegates to it.
+- run: HeadlessRunner.run, i.e. process launch, progress reporting and chaining of the
+  configurations. The Qt DVC_runner uses the same scheduler.
+- progress: parsing of the progress lines by the scheduler, as done for every line
+  printed by the executable.
+- load_results: createResultsDataFrame on the run folder, as done by the results tab.
+  It needs the graphical interface dependencies, otherwise it is skipped.
+
+The time per item (configuration or line) is compared to the baseline, if given, and
+the exit code is 1 if any is slower than the baseline by more than the tolerance.
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from idvc.dvc_engine import DVCEngine, DVCRun, DVCScheduler, HeadlessRunner
+from idvc.dvc_progress import Throttle
+from idvc.idvc_run import NoOpCallback
+from benchmarks.fake_dvc import make_dvc_executable
+
+def create_session(folder, num_configurations, num_points=20, dims=(32, 32, 32)):
+    '''Writes the volumes, point cloud and run config of a bulk run with num_configurations
+    configurations in folder. Returns the path of the run config.'''
+    rng = np.random.default_rng(0)
+    volume = rng.integers(0, 255, size=dims[::-1], dtype=np.uint8)
+    volume.tofile(os.path.join(folder, "reference.raw"))
+    volume.tofile(os.path.join(folder, "correlate.raw"))
+
+    run_folder = os.path.join("Results", "benchmark")
+    os.makedirs(os.path.join(folder, run_folder))
+    grid = np.linspace(8, dims[0] - 8, int(np.ceil(num_points ** (1 / 3.))))
+    points = np.array(np.meshgrid(grid, grid, grid, indexing='ij')).reshape(3, -1).T[:num_points]
+    roi_file = os.path.join(run_folder, "pointcloud.roi")
+    np.savetxt(os.path.join(folder, roi_file), np.column_stack([np.arange(1, len(points) + 1), points]),
+               '%d\t%.3f\t%.3f\t%.3f')
+
+    # the configurations differ by the number of points in the subvolume
+    subvolume_points = [100 + i for i in range(num_configurations)]
+    config = {'subvolume_points': subvolume_points, 'subvolume_sizes': [10], 'points': num_points,
+              'roi_files': [roi_file], 'reference_file': "reference.raw", 'correlate_file': "correlate.raw",
+              'vol_bit_depth': 8, 'vol_hdr_lngth': 0, 'vol_endian': 'little', 'dims': list(dims),
+              'subvol_geom': 'cube', 'subvol_npts': subvolume_points, 'disp_max': [5], 'dof': 6,
+              'obj': 'znssd', 'interp_type': 'tricubic', 'rigid_trans': '0.0 0.0 0.0',
+              'run_folder': run_folder, 'point0': [8, 8, 8], 'point0_world_coordinate': [8, 8, 8],
+              'shards': 1, 'result_cache_size': 0}
+    run_config = os.path.join(folder, run_folder, "_run_config.json")
+    with open(run_config, "w") as f:
+        json.dump(config, f)
+    return run_config
+
+def bench_runner(num_configurations, threads, processes, num_points):
+    '''Times the set up, run and loading of the results of a bulk run with the fake executable'''
+    timings = []
+    folder = tempfile.mkdtemp(prefix="idvc_benchmark_")
+    cwd = os.getcwd()
+    try:
+        run_config = create_session(folder, num_configurations, num_points)
+        engine = DVCEngine(run_config, folder, use_cache=False)
+        start = time.perf_counter()
+        engine.set_up(NoOpCallback(), NoOpCallback())
+        timings.append(('set_up', num_configurations, time.perf_counter() - start))
+
+        runner = HeadlessRunner(engine, threads, processes, stream=io.StringIO())
+        start = time.perf_counter()
+        exit_code = runner.run()
+        timings.append(('run', num_configurations, time.perf_counter() - start))
+        if exit_code != 0:
+            raise RuntimeError("the runs failed with exit code {}".format(exit_code))
+
+        try:
+            from idvc.utils.manipulate_result_files import createResultsDataFrame
+        except ImportError as err:
+            print("load_results skipped: {}".format(err))
+        else:
+            start = time.perf_counter()
+            createResultsDataFrame(engine.run_folder, False)
+            timings.append(('load_results', num_configurations, time.perf_counter() - start))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+    return timings
+
+def bench_progress(num_lines, num_runs=4):
+    '''Times the parsing of num_lines progress lines, split between num_runs concurrent runs'''
+    folder = tempfile.mkdtemp(prefix="idvc_benchmark_")
+    try:
+        points = num_lines // num_runs
+        runs = [DVCRun("dvc", "dvc_config.txt", os.path.join(folder, "dvc_result_{}".format(i)), points)
+                for i in range(num_runs)]
+        scheduler = DVCScheduler(runs, total_threads=num_runs, max_concurrent=num_runs)
+        while scheduler.next_run() is not None:
+            pass
+        throttle = Throttle(0.25)
+        start = time.perf_counter()
+        for i in range(1, points + 1):
+            for run in runs:
+                scheduler.update(run, "{}/{}\n".format(i, points))
+                if throttle.ready():
+                    scheduler.progress()
+        elapsed = time.perf_counter() - start
+        for run in runs:
+            scheduler.run_finished(run, True, 0)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return [('progress', points * num_runs, elapsed)]
+
+def compare(results, baseline, tolerance):
+    '''Returns the lines describing the results slower than the baseline by more than tolerance'''
+    reference = {(r['scenario'], r['size']): r['per_item'] for r in baseline}
+    regressions = []
+    for r in results:
+        key = (r['scenario'], r['size'])
+        if key in reference and r['per_item'] > reference[key] * (1 + tolerance):
+            regressions.append("{} {}: {:.6f} s per item, baseline {:.6f} s".format(
+                r['scenario'], r['size'], r['per_item'], reference[key]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='iDVC - benchmarks of the overhead of running the dvc executable')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='numbers of configurations of the bulk runs')
+    parser.add_argument('--points', type=int, default=20, help='number of points of the point cloud')
+    parser.add_argument('--threads', type=int, default=4, help='total number of OMP threads')
+    parser.add_argument('--processes', type=int, default=1, help='maximum number of concurrent dvc processes')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='points per second per thread of the fake executable, 0 for as fast as possible')
+    parser.add_argument('--lines', type=int, default=100000, help='number of progress lines parsed')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are written to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON file of results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slow down from the baseline reported as a regression')
+    args = parser.parse_args(argv)
+
+    bin_folder = tempfile.mkdtemp(prefix="idvc_fake_dvc_")
+    os.environ['IDVC_DVC_EXECUTABLE'] = make_dvc_executable(bin_folder)
+    os.environ['IDVC_FAKE_DVC_RATE'] = str(args.rate)
+    timings = []
+    try:
+        for size in args.sizes:
+            timings += bench_runner(size, args.threads, args.processes, args.points)
+        timings += bench_progress(args.lines)
+    finally:
+        shutil.rmtree(bin_folder, ignore_errors=True)
+
+    results = []
+    print("{:<14}{:>8}{:>12}{:>16}".format("scenario", "size", "time (s)", "per item (ms)"))
+    for scenario, size, elapsed in timings:
+        results.append({'scenario': scenario, 'size': size, 'time': elapsed, 'per_item': elapsed / size})
+        print("{:<14}{:>8}{:>12.3f}{:>16.3f}".format(scenario, size, elapsed, elapsed / size * 1000))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("Regression: " + line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
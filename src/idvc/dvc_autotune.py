@@ -0,0 +1,167 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Autotuner of the number of threads and concurrent processes of the dvc executable.
+
+The configuration of a run is executed on a small sample of points with several
+layouts of concurrent processes and OMP threads per process, and the layout with
+the highest throughput is chosen. The throughput is measured from the progress
+lines printed by the executable, so the time spent loading the volumes is not
+counted.
+'''
+
+import os
+import time
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+
+from idvc.dvc_engine import PrintCallback, set_config_fields, memory_budget, memory_concurrency
+from idvc.dvc_progress import parse_progress_line
+
+def autotune_settings_key(volume_key):
+    '''Returns the key of the best layout in the settings, for this machine and volume size'''
+    return "dvc_autotune_layouts/{}/{}".format(platform.node() or "localhost", volume_key)
+
+def candidate_layouts(total_threads, max_processes=None):
+    '''Returns a list of (processes, threads per process) using total_threads.
+
+    The threads per process are the powers of 2 up to total_threads, and total_threads itself.'''
+    total_threads = max(int(total_threads), 1)
+    threads = {total_threads}
+    t = 1
+    while t < total_threads:
+        threads.add(t)
+        t *= 2
+    layouts = []
+    for t in sorted(threads, reverse=True):
+        processes = max(total_threads // t, 1)
+        if max_processes is not None:
+            processes = max(min(processes, int(max_processes)), 1)
+        if (processes, t) not in layouts:
+            layouts.append((processes, t))
+    return layouts
+
+
+class Autotuner(object):
+    '''Measures the throughput of the dvc executable with several layouts of processes and threads.
+
+    Parameters
+    ----------
+    run : DVCRun
+        the run whose configuration is used for the measurements.
+    total_threads : int
+        total number of threads available.
+    sample_points : int, default 200
+        number of points processed by each process in a measurement.
+    max_processes : int, optional
+        maximum number of concurrent processes.
+    timeout : float, default 600
+        maximum duration of a measurement, in seconds.
+    memory_limit : int, optional
+        memory the processes may use, in bytes, by default measured as in DVCScheduler. The
+        layouts are limited to the processes whose volumes fit in memory.
+    '''
+    def __init__(self, run, total_threads, sample_points=200, max_processes=None, timeout=600, memory_limit=None):
+        self.run = run
+        self.total_threads = total_threads
+        self.sample_points = sample_points
+        memory_processes = memory_concurrency([run], memory_limit if memory_limit is not None else memory_budget())
+        if memory_processes is not None and (max_processes is None or memory_processes < max_processes):
+            max_processes = memory_processes
+        self.max_processes = max_processes
+        self.timeout = timeout
+        self.results = []
+
+    def measure(self, processes, threads, work_folder):
+        '''Runs the sample with processes concurrent processes of threads threads each.
+
+        Returns the total throughput in points per second, 0 if any process failed.'''
+        with open(self.run.config_filename) as f:
+            config_text = f.read()
+        sample_points = min(self.sample_points, self.run.num_points)
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(threads)
+        progress = []
+        running = []
+        for i in range(processes):
+            folder = os.path.join(work_folder, "p{}_t{}_{}".format(processes, threads, i))
+            os.mkdir(folder)
+            config_filename = os.path.join(folder, "dvc_config.txt")
+            with open(config_filename, "w") as f:
+                f.write(set_config_fields(config_text, output_filename=os.path.join(folder, "dvc_result"),
+                                          num_points_to_process=sample_points))
+            process = subprocess.Popen([self.run.exe_file, config_filename], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, env=env, universal_newlines=True)
+            # times of the first and last progress lines and the points processed in between
+            record = [None, None, 0, 0]
+            reader = threading.Thread(target=self._read_output, args=(process, record), daemon=True)
+            reader.start()
+            running.append((process, reader))
+            progress.append(record)
+
+        start = time.time()
+        succeeded = True
+        for process, reader in running:
+            try:
+                process.wait(max(self.timeout - (time.time() - start), 0.1))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            reader.join()
+            succeeded = succeeded and process.returncode == 0
+
+        if not succeeded:
+            return 0.
+        points_per_second = 0.
+        for first_time, last_time, first_points, last_points in progress:
+            if first_time is None or last_time <= first_time:
+                continue
+            points_per_second += (last_points - first_points) / (last_time - first_time)
+        return points_per_second
+
+    def _read_output(self, process, record):
+        for line in process.stdout:
+            num_processed_points = parse_progress_line(line)
+            if num_processed_points is None:
+                continue
+            now = time.time()
+            if record[0] is None:
+                record[0], record[2] = now, num_processed_points
+            record[1], record[3] = now, num_processed_points
+
+    def tune(self, message_callback=None, progress_callback=None):
+        '''Measures all the candidate layouts.
+
+        Returns a tuple (processes, threads, points per second) of the best layout, or None
+        if all the measurements failed.'''
+        if message_callback is None:
+            message_callback = PrintCallback()
+        if progress_callback is None:
+            progress_callback = PrintCallback()
+        layouts = candidate_layouts(self.total_threads, self.max_processes)
+        work_folder = tempfile.mkdtemp(prefix="idvc_autotune_")
+        self.results = []
+        try:
+            for i, (processes, threads) in enumerate(layouts):
+                message_callback.emit("Autotuning: {} processes with {} threads".format(processes, threads))
+                points_per_second = self.measure(processes, threads, work_folder)
+                self.results.append((processes, threads, points_per_second))
+                progress_callback.emit(int((i + 1) / len(layouts) * 100))
+        finally:
+            shutil.rmtree(work_folder, ignore_errors=True)
+        best = max(self.results, key=lambda result: result[2])
+        if best[2] <= 0:
+            return None
+        return best
@@ -0,0 +1,1410 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+#   Author: Laura Murgatroyd (UKRI-STFC)
+#   Author: Edoardo Pasca (UKRI-STFC)
+
+'''Qt-free engine to set up and run the configurations of a DVC run.
+
+The engine reads the run config json file created by the app (create_run_config),
+converts the image files to raw if needed, creates the run folders with the
+configuration files for the dvc executable and schedules the dvc processes.
+It is used by the DVC_runner in the app, which runs the processes with QProcess,
+and by the `idvc-run` console entry point, which runs them with subprocess.
+'''
+
+import os
+import sys
+import io
+import json
+import math
+import time
+import hashlib
+import shutil
+import platform
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from idvc.utils.cache import FileCache, user_cache_dir, hash_file, stat_fingerprint
+from idvc.dvc_progress import (parse_progress_line, ProgressEvent, ProgressTracker,
+                               RunMetricsLog, SharedProgress, Throttle, METRICS_FILENAME)
+
+class PrintCallback(object):
+    '''Class to handle the emit call when no callback is provided'''
+    def emit(self, *args, **kwargs):
+        print (args, kwargs)
+
+blank_config = '''###############################################################################
+#
+#
+#		example dvc process control file
+#
+#
+###############################################################################
+
+# all lines beginning with a # character are ignored
+# some parameters are conditionally required, depending on the setting of other parameters
+# for example, if subvol_thresh is off, the threshold description parameters are not required
+
+### file names
+
+reference_filename	{reference_filename}		### reference tomography image volume
+correlate_filename	{correlate_filename}		### correlation tomography image volume
+
+point_cloud_filename	{point_cloud_filename}	### file of search point locations
+output_filename		{output_filename}		### base name for output files
+
+### description of the image data files, all must be the same size and structure
+
+vol_bit_depth		{vol_bit_depth}			### 8 or 16
+vol_hdr_lngth		{vol_hdr_lngth}		### fixed-length header size, may be zero
+vol_wide		{vol_wide}			### width in pixels of each slice
+vol_high		{vol_high}			### height in pixels of each slice
+vol_tall		{vol_tall}			### number of slices in the stack
+vol_endian		{vol_endian}        ### big or little endian byte ordering
+
+### parameters defining the subvolumes that will be created at each search point
+
+subvol_geom		{subvol_geom}			### cube, sphere
+subvol_size		{subvol_size}			### side length or diameter, in voxels
+subvol_npts		{subvol_npts}			### number of points to distribute within the subvol
+
+subvol_thresh		{subvol_thresh}			### on or off, evaluate subvolumes based on threshold
+gray_thresh_min		{gray_thresh_min}			### lower limit of a gray threshold range if subvol_thresh is on
+gray_thresh_max		{gray_thresh_max}			### upper limit of a gray threshold range if subvol_thresh is on
+min_vol_fract		{min_vol_fract}			### only search if subvol fraction is greater than
+
+### required parameters defining the basic the search process
+
+disp_max		{disp_max}			### in voxels, used for range checking and global search limits
+num_srch_dof		{num_srch_dof}			### 3, 6, or 12
+obj_function		{obj_function}			### sad, ssd, zssd, nssd, znssd
+interp_type		{interp_type}		### trilinear, tricubic
+
+### optional parameters tuning and refining the search process
+
+rigid_trans		{rigid_trans}		### rigid body offset of target volume, in voxels
+basin_radius		{basin_radius}			### coarse-search resolution, in voxels, 0.0 = none
+subvol_aspect		{subvol_aspect}		### subvolume aspect ratio
+num_points_to_process   {num_points_to_process}  ### Number of points in the point cloud to process
+starting_point  {starting_point}    ### x,y,z location of starting point for DVC analysis
+'''
+
+def get_dvc_executable():
+    '''Returns the name of the dvc executable for the current platform.
+
+    The IDVC_DVC_EXECUTABLE environment variable overrides it, e.g. to run a build of the
+    executable which is not in the PATH, or the stand-in used by the benchmarks.'''
+    if os.environ.get('IDVC_DVC_EXECUTABLE'):
+        return os.environ['IDVC_DVC_EXECUTABLE']
+    if platform.system() in ['Linux', 'Darwin']:
+        return 'dvc'
+    elif platform.system() == 'Windows':
+        return 'dvc.exe'
+    else:
+        raise ValueError('Not supported platform, ', platform.system())
+
+def count_points(roi_file):
+    '''Returns the number of points in a point cloud file'''
+    i = 0
+    with open(roi_file) as f:
+        for i, l in enumerate(f, 1):
+            pass
+    return i
+
+def set_config_fields(config_text, **fields):
+    '''Returns the text of a dvc configuration file with the values of some fields replaced'''
+    lines = []
+    for line in config_text.splitlines(True):
+        words = line.split(None, 1)
+        if words and not line.startswith('#') and words[0] in fields:
+            line = "{}\t{}\n".format(words[0], fields[words[0]])
+        lines.append(line)
+    return ''.join(lines)
+
+
+def read_config_fields(config_text):
+    '''Returns a dictionary of the fields of a dvc configuration file and their values'''
+    fields = {}
+    for line in config_text.splitlines():
+        words = line.split(None, 1)
+        if words and not line.startswith('#'):
+            fields[words[0]] = words[1].split('###')[0].strip() if len(words) > 1 else ''
+    return fields
+
+# version of the raw files written by convert_to_raw, part of the key of the volume cache
+RAW_CONVERSION_VERSION = 1
+
+# fraction of the available memory the dvc processes may use, the rest is left to the system
+MEMORY_HEADROOM = 0.9
+
+# memory used by a dvc process besides the image volumes, in bytes
+PROCESS_MEMORY_OVERHEAD = 64 * 1024**2
+
+def available_memory(meminfo="/proc/meminfo", cgroup="/sys/fs/cgroup"):
+    '''Returns the memory available to new processes in bytes, or None if it is not known.
+
+    It is read from MemAvailable in /proc/meminfo, and is limited by the memory left in the
+    cgroup of the process, e.g. on the nodes of a cluster. On the systems without
+    /proc/meminfo, the free physical memory is used.'''
+    available = None
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    if available is None:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
+    try:
+        with open(os.path.join(cgroup, "memory.max")) as f:
+            limit = f.read().strip()
+        with open(os.path.join(cgroup, "memory.current")) as f:
+            current = int(f.read())
+        if limit != "max":
+            available = min(available, max(int(limit) - current, 0))
+    except (OSError, ValueError):
+        pass
+    return available
+
+def memory_budget():
+    '''Returns the memory the dvc processes may use in bytes, or None if it is not known'''
+    available = available_memory()
+    if available is None:
+        return None
+    return int(available * MEMORY_HEADROOM)
+
+def estimate_run_memory(config_text):
+    '''Returns an estimate of the memory used by the dvc process of a configuration, in bytes.
+
+    The executable loads the reference and correlate volumes in full, so the estimate is
+    twice vol_wide x vol_high x vol_tall x the bytes per voxel, plus PROCESS_MEMORY_OVERHEAD.'''
+    fields = read_config_fields(config_text)
+    voxels = int(fields['vol_wide']) * int(fields['vol_high']) * int(fields['vol_tall'])
+    bytes_per_voxel = int(math.ceil(int(fields['vol_bit_depth']) / 8.))
+    return 2 * voxels * bytes_per_voxel + PROCESS_MEMORY_OVERHEAD
+
+def memory_concurrency(runs, memory_limit):
+    '''Returns the number of runs which fit in memory_limit bytes at the same time, at least 1,
+    or None if the limit or the memory of the runs is not known'''
+    run_memory = max([run.memory for run in runs] or [0])
+    if memory_limit is None or run_memory == 0:
+        return None
+    return max(int(memory_limit // run_memory), 1)
+
+def split_thread_budget(total_threads, num_runs, max_concurrent=None):
+    '''Splits a budget of threads between concurrent dvc processes.
+
+    Parameters
+    ----------
+    total_threads : int
+        total number of threads the runs can use.
+    num_runs : int
+        number of runs to be executed.
+    max_concurrent : int, optional
+        maximum number of processes to run at the same time. If None, as many
+        processes as the threads allow are run.
+
+    Returns
+    -------
+    tuple of int: number of concurrent processes, OMP_NUM_THREADS for each process
+    '''
+    total_threads = max(int(total_threads), 1)
+    concurrent = max(min(int(num_runs), total_threads), 1)
+    if max_concurrent is not None:
+        concurrent = max(min(concurrent, int(max_concurrent)), 1)
+    return concurrent, max(total_threads // concurrent, 1)
+
+def partition_point_cloud(points, num_shards):
+    '''Partitions a point cloud in spatially coherent shards.
+
+    The cloud is recursively bisected along the axis of largest extent, so that
+    each shard is a compact box-like region with about the same number of points.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        point cloud as read from a roi file, columns are id, x, y, z.
+    num_shards : int
+        number of shards to create.
+
+    Returns
+    -------
+    list of numpy.ndarray with the indices of the points in each shard.
+    '''
+    def bisect(indices, k):
+        if k <= 1 or len(indices) < 2:
+            return [indices]
+        coords = points[indices, 1:4]
+        axis = int(np.argmax(coords.max(axis=0) - coords.min(axis=0)))
+        k_left = k // 2
+        # split so that the number of points is proportional to the number of shards
+        split = int(round(len(indices) * k_left / k))
+        order = np.argsort(coords[:, axis], kind='stable')
+        return bisect(indices[order[:split]], k_left) + bisect(indices[order[split:]], k - k_left)
+
+    num_shards = max(min(int(num_shards), len(points)), 1)
+    return bisect(np.arange(len(points)), num_shards)
+
+def nearest_point(points, location):
+    '''Returns the index of the point of the cloud nearest to location'''
+    distance = np.sum((points[:, 1:4] - np.asarray(location, dtype=float)) ** 2, axis=1)
+    return int(np.argmin(distance))
+
+# the parameters of the run, echoed at the start of the .stat files
+CONFIG_FIELDS = {line.split()[0] for line in blank_config.splitlines() if line.strip() and not line.startswith('#')}
+# the parameters which differ between the shards of a run, and are summed
+SHARD_SUM_PARAMETERS = ('num_points_to_process',)
+# the statistics and timings which follow the parameters depend on the version of the dvc
+# executable, so they are matched by name: the counts are summed over the shards and the
+# times are the longest of the shards, as they run at the same time
+SHARD_MAX_PATTERNS = ('time',)
+SHARD_SUM_PATTERNS = ('point', 'num', 'fail', 'success', 'conver')
+
+def shard_merge_rule(field):
+    '''Returns how a field of the .stat files of the shards is merged, sum or max, or None
+    if the field of the first shard is kept'''
+    if field in SHARD_SUM_PARAMETERS:
+        return sum
+    if field is None or field.startswith('#') or field in CONFIG_FIELDS:
+        return None
+    if any(pattern in field.lower() for pattern in SHARD_MAX_PATTERNS):
+        return max
+    if any(pattern in field.lower() for pattern in SHARD_SUM_PATTERNS):
+        return sum
+    return None
+
+def merge_shard_stats(shard_stat_filenames, stat_filename):
+    '''Writes the .stat file of a sharded run from the .stat files of its shards.
+
+    The lines of the first shard are kept, with the counts summed over the shards and the
+    times the longest of the shards, see shard_merge_rule. A field which is not a single number
+    in every shard is left as in the first shard.'''
+    shards = []
+    for filename in shard_stat_filenames:
+        with open(filename, "r") as f:
+            shards.append([line.rstrip('\n').split('\t') for line in f])
+    fields = [{words[0]: words[1:] for words in lines if words} for lines in shards]
+    with open(stat_filename, "w") as merged:
+        for words in shards[0]:
+            field = words[0] if words else None
+            merge = shard_merge_rule(field)
+            if merge is not None and len(words) == 2:
+                try:
+                    values = [float(shard[field][0]) for shard in fields]
+                except (KeyError, IndexError, ValueError):
+                    values = None
+                if values is not None:
+                    value = merge(values)
+                    integers = all('.' not in shard[field][0] for shard in fields)
+                    words = [field, str(int(value)) if integers else '{:.3f}'.format(value)] + words[2:]
+            merged.write('\t'.join(words) + '\n')
+
+def merge_shard_results(shard_output_filenames, output_filename):
+    '''Merges the results of the shards of a run in a single set of result files.
+
+    The displacement files are concatenated, keeping the header of the first shard.
+    The first shard must be the one containing the starting point of the run, its status
+    file, which holds the echo of the run parameters, is merged with the ones of the other
+    shards by merge_shard_stats.
+
+    Parameters
+    ----------
+    shard_output_filenames : list of str
+        output_filename of each shard, without extension.
+    output_filename : str
+        output_filename of the merged run, without extension.
+    '''
+    with open(output_filename + ".disp", "w") as merged:
+        for i, shard in enumerate(shard_output_filenames):
+            with open(shard + ".disp", "r") as shard_disp:
+                header = shard_disp.readline()
+                if i == 0:
+                    merged.write(header)
+                shutil.copyfileobj(shard_disp, merged)
+    merge_shard_stats([shard + ".stat" for shard in shard_output_filenames], output_filename + ".stat")
+
+def link_or_copy(source, destination):
+    '''Makes destination a hardlink to source. If hardlinks are not supported,
+    a symbolic link is tried and, as a last resort, the file is copied.'''
+    try:
+        os.link(source, destination)
+        return
+    except (OSError, AttributeError):
+        pass
+    try:
+        os.symlink(os.path.relpath(source, os.path.dirname(os.path.abspath(destination))), destination)
+        return
+    except (OSError, NotImplementedError, AttributeError):
+        pass
+    shutil.copyfile(source, destination)
+
+
+def copy_voxels(filename, offset, raw_fname, block_size=16 * 1024**2):
+    '''Copies the end of a file from offset to a raw file, in blocks of block_size bytes'''
+    with open(filename, "rb") as source:
+        source.seek(offset)
+        with open(raw_fname + ".tmp", "wb") as destination:
+            shutil.copyfileobj(source, destination, block_size)
+    os.replace(raw_fname + ".tmp", raw_fname)
+
+def raw_dtype(vol_bit_depth, endian):
+    '''Returns the dtype of the voxels the dvc executable reads, from the vol_bit_depth and
+    vol_endian of the run config'''
+    dtype = np.dtype(np.uint8 if int(vol_bit_depth) == 8 else np.uint16)
+    return dtype.newbyteorder('>' if endian == 'big' else '<')
+
+def voxels_in_place(volume_info, vol_bit_depth, endian, dims):
+    '''Returns True if the dvc executable can read the voxels of a volume from its file.
+
+    They must be stored uncompressed, with the type and byte order of the run config, and with
+    x varying the fastest for the dims of the run config. volume_info is returned by the probes,
+    see idvc.io.probe_volume.'''
+    if volume_info['compressed'] or volume_info['header_length'] is None:
+        return False
+    dtype = volume_info['dtype']
+    if dtype.kind != 'u' or dtype.itemsize != raw_dtype(vol_bit_depth, endian).itemsize:
+        return False
+    if dtype.itemsize > 1 and endian is not None and volume_info['isBigEndian'] != (endian == 'big'):
+        return False
+    shape = volume_info['shape']
+    xyz_shape = shape if volume_info['isFortran'] else shape[::-1]
+    return [int(n) for n in xyz_shape] == [int(n) for n in dims]
+
+def make_run_folder(folder, replace=False):
+    '''Creates the folder of a run. If replace is True, an existing folder
+    is removed first, with any partial result in it.'''
+    if replace and os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+
+def result_is_complete(output_filename):
+    '''Returns True if a run has written its results.
+
+    Both the .disp and .stat files must be present and not empty. If the folder has
+    a metrics file, its last record must report that the run finished successfully,
+    so that the partial results of an interrupted run are not taken as complete.'''
+    for extension in (".disp", ".stat"):
+        filename = output_filename + extension
+        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            return False
+    metrics_filename = os.path.join(os.path.dirname(output_filename), METRICS_FILENAME)
+    if os.path.exists(metrics_filename):
+        with open(metrics_filename) as f:
+            lines = [line for line in f if line.strip()]
+        try:
+            last = json.loads(lines[-1])
+        except (IndexError, ValueError):
+            return False
+        return last.get("event") == "finished" and bool(last.get("succeeded"))
+    return True
+
+def run_results_complete(run_config, session_folder):
+    '''Returns True if every configuration of a run has complete results in its run folder.
+
+    run_config is the run config as a dictionary, see DVCEngine.set_up. The configurations
+    pruned by an adaptive sweep are not checked, see dvc_sweep.'''
+    from idvc.dvc_sweep import SWEEP_FILENAME
+    run_folder = os.path.join(session_folder, run_config['run_folder'])
+    configurations = range(len(run_config['roi_files']) * len(run_config['subvolume_points']))
+    sweep_filename = os.path.join(run_folder, SWEEP_FILENAME)
+    if os.path.exists(sweep_filename):
+        with open(sweep_filename) as f:
+            configurations = json.load(f)['kept']
+    return all(result_is_complete(os.path.join(run_folder, "dvc_result_{}".format(c), "dvc_result_{}".format(c)))
+               for c in configurations)
+
+
+class PointCloudStore(object):
+    '''Content-addressed store of point cloud files.
+
+    Each point cloud is saved once, with the hash of its content as file name,
+    so identical point clouds used by many runs share the same file.
+
+    Parameters
+    ----------
+    folder : str
+        folder where the point clouds are saved, created if it does not exist.
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def add_bytes(self, data):
+        '''Saves data in the store, if not already there, and returns the stored file name.'''
+        filename = os.path.join(self.folder, hashlib.sha1(data).hexdigest() + ".roi")
+        if not os.path.exists(filename):
+            # write to a temporary file first so that a partial file is never in the store
+            tmp_filename = filename + ".tmp"
+            with open(tmp_filename, "wb") as f:
+                f.write(data)
+            os.replace(tmp_filename, filename)
+        return filename
+
+    def add_file(self, filename):
+        with open(filename, "rb") as f:
+            return self.add_bytes(f.read())
+
+    def add_points(self, points, fmt='%d\t%.3f\t%.3f\t%.3f'):
+        '''Saves a point cloud array in the roi format, see np.savetxt.'''
+        buffer = io.BytesIO()
+        np.savetxt(buffer, points, fmt)
+        return self.add_bytes(buffer.getvalue())
+
+
+class DVCRun(object):
+    '''A configuration file to be run by the dvc executable.
+
+    Parameters
+    ----------
+    exe_file : str
+        the dvc executable.
+    config_filename : str
+        the configuration file passed to the executable.
+    output_filename : str
+        base name of the output files written by the executable.
+    num_points : int
+        number of points the executable will process.
+    fingerprint : str, optional
+        digest of the inputs of the run, used as key in the result cache.
+    '''
+    def __init__(self, exe_file, config_filename, output_filename, num_points, fingerprint=None):
+        self.exe_file = exe_file
+        self.config_filename = config_filename
+        self.output_filename = output_filename
+        self.num_points = num_points
+        self.fingerprint = fingerprint
+        self.points_processed = 0
+        self.succeeded = None
+        self._memory = None
+
+    @property
+    def memory(self):
+        '''Estimate of the memory used by the process in bytes, 0 if the configuration can't be read'''
+        if self._memory is None:
+            try:
+                with open(self.config_filename) as f:
+                    self._memory = estimate_run_memory(f.read())
+            except (OSError, KeyError, ValueError):
+                self._memory = 0
+        return self._memory
+
+    @property
+    def args(self):
+        return [self.config_filename]
+
+    def __str__(self):
+        return "DVCRun: {}".format(self.config_filename)
+
+
+class DVCEngine(object):
+    '''Sets up the runs described in a run config json file.
+
+    Parameters
+    ----------
+    input_file : str
+        the run config json file, created in dvc_interface create_run_config.
+    session_folder : str
+        the session folder, paths in the run config are relative to it.
+    hdf5_dataset_path : str, optional
+        path of the dataset in HDF5/NeXus image files. If None, the 'hdf5_dataset_path'
+        in the run config is used.
+    resume : bool, default False
+        resume a run which was cancelled or interrupted: the run folders with complete
+        results are kept and only the other configurations are run.
+    use_cache : bool, default True
+        whether to use the user level caches of results and of converted volumes, if enabled
+        in the run config with 'result_cache_size' and 'volume_cache_size'.
+    '''
+    def __init__(self, input_file, session_folder, hdf5_dataset_path=None, resume=False, use_cache=True):
+        self.input_file = input_file
+        self.session_folder = session_folder
+        self.hdf5_dataset_path = hdf5_dataset_path
+        self.resume = resume
+        self.use_cache = use_cache
+        self.cache = None
+        self.volume_cache = None
+        self.runs = []
+        self.shard_groups = []
+        self.skipped_runs = 0
+        self.cached_runs = 0
+        self.volume_key = None
+        # runs of the fine stage of the coarse-to-fine pipeline
+        self.pending_runs = []
+        # returns the runs of the next stage, see next_stage
+        self.next_stage_fn = None
+
+    def set_up(self, message_callback=None, progress_callback=None):
+        '''This function sets up the DVC run, creating the run configurations and setting up the run folders.
+
+        Parameters:
+        -----------
+        message_callback: callback function for messages
+        progress_callback: callback function for progress updates
+
+        Returns:
+        --------
+        list of DVCRun, the configurations to be run.
+
+        This function reads a json file containing the run configuration and creates the run configurations.
+        The json file contains the following:
+        - subvolume_points: list of number of points to process at each subvolume
+        - subvolume_sizes: list of subvolume sizes, if not an integer multiple runs will be created
+        - points: number of points to process in the point cloud
+        - roi_files: list of point cloud files
+        - reference_file: reference image volume
+        - correlate_file: correlation image volume
+        - vol_bit_depth: bit depth of the image volumes. If loading an image not of type int8 or int16, the image will be converted to uint16.
+        - vol_hdr_lngth: header length of the image volumes
+        - dims: dimensions of the image volumes
+        - subvol_geom: geometry of the subvolume, either cube or sphere
+        - subvol_npts: number of points in the subvolume, not used
+        - disp_max: maximum displacement in voxels
+        - dof: number of parameters in the optimisation, 3,6, or 12
+        - obj: objective function, either sad, ssd, zssd, nssd, or znssd
+        - interp_type: interpolation type, either trilinear or tricubic
+        - run_folder: folder to save the run results and configurations
+        - rigid_trans: rigid translation between the reference and correlation volumes
+        - point0_world_coordinate: world coordinates of the starting point for the DVC analysis
+        - shards: optional, number of shards each point cloud is split into. Each shard is run as a
+          separate process and the results are merged in the run folder when all the runs are completed.
+        - hdf5_dataset_path: optional, path of the dataset in HDF5/NeXus image files.
+        - coarse_to_fine: optional, binning factor of the coarse stage of the coarse-to-fine pipeline,
+          1 to disable it. The coarse stage runs on the binned volumes with a sparse point cloud; each point
+          cloud is then split in 'coarse_regions' regions (default 8), run as shards whose rigid_trans is
+          taken from the coarse displacements, with a search range of 'fine_disp_max' (by default
+          disp_max / coarse_to_fine). The runs of the fine stage are returned by next_stage.
+        - adaptive_sweep: optional, if true the configurations are pruned by successive halving,
+          see dvc_sweep.AdaptiveSweep: they are run on 'sweep_sample_points' points (default 200)
+          first, and the best 1/'sweep_eta' (default 2) on eta times more points at each next stage,
+          until the configurations left are run on the full point cloud. Not used with coarse_to_fine.
+        - result_cache_size: optional, maximum size in GB of the user level cache of results.
+          If larger than 0, the results of configurations which were run before are taken from
+          the cache instead of running the dvc executable.
+        - volume_cache_size: optional, maximum size in GB of the user level cache of the TIFF stacks
+          and HDF5/NeXus files converted to raw. If larger than 0, the volumes converted before, in
+          this or another session, are taken from the cache instead of being converted again.
+        '''
+        if message_callback is None:
+            message_callback = PrintCallback()
+        if progress_callback is None:
+            progress_callback = PrintCallback()
+        self.runs = []
+        self.shard_groups = []
+        self.skipped_runs = 0
+        self.cached_runs = 0
+        self.volume_key = None
+        # runs of the fine stage of the coarse-to-fine pipeline
+        self.pending_runs = []
+        # returns the runs of the next stage, see next_stage
+        self.next_stage_fn = None
+
+        # created in dvc_interface create_run_config
+        with open(self.input_file) as tmp:
+            config = json.load(tmp)
+
+        # paths in the run config are relative to the session folder
+        os.chdir(self.session_folder)
+
+        subvolume_points = config['subvolume_points']
+        subvolume_sizes = config['subvolume_sizes']
+        points = int(config['points'])
+        num_points_to_process = points
+
+        roi_files = config['roi_files']
+        hdf5_dataset_path = self.hdf5_dataset_path
+        if hdf5_dataset_path is None:
+            hdf5_dataset_path = config.get('hdf5_dataset_path', None)
+        base = os.path.abspath(self.session_folder)
+        results_folder = os.path.dirname(os.path.join(base, config['run_folder']))
+
+        self.volume_cache = None
+        volume_cache_size = float(config.get('volume_cache_size', 0) or 0)
+        if self.use_cache and volume_cache_size > 0:
+            self.volume_cache = FileCache(user_cache_dir('volumes'), int(volume_cache_size * 1024**3))
+
+        vol_bit_depth = int(config['vol_bit_depth'])
+        if vol_bit_depth not in [8, 16]:
+            # the data will be converted to 16 bit by save_tiff_stack_as_raw
+            # it won't work with other formats
+            vol_bit_depth = 16
+
+        if 'vol_endian' in config:
+            endian = config['vol_endian']
+        else:
+            endian = None
+
+        dims= config['dims'] #image dimensions
+
+        progress_callback.emit(10)
+        # the reference and correlate volumes are converted at the same time, so the wait is
+        # the longest of the two conversions rather than their sum
+        progress = SharedProgress(progress_callback, 2, 10, 90)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(self.convert_to_raw, config[name + '_file'],
+                                       os.path.join(results_folder, name + '.raw'), hdf5_dataset_path,
+                                       message_callback, progress.task(i), 0, 100,
+                                       raw_format=(vol_bit_depth, endian, dims))
+                       for i, name in enumerate(['reference', 'correlate'])]
+            reference_file, correlate_file = [future.result() for future in futures]
+        progress_callback.emit(90)
+
+        message_callback.emit("Creating run configurations")
+        vol_hdr_lngth = int(config['vol_hdr_lngth'])
+        reference_file, correlate_file, vol_hdr_lngth = self.locate_voxels(
+            [(config['reference_file'], reference_file), (config['correlate_file'], correlate_file)],
+            vol_hdr_lngth, results_folder, message_callback)
+        # identifies the size of the volumes, e.g. to store the autotuned layout of the processes
+        self.volume_key = "{}x{}x{}_{}bit".format(dims[0], dims[1], dims[2], vol_bit_depth)
+
+        subvol_geom = config['subvol_geom']
+
+        disp_max = int(config['disp_max'][0]) #TODO: need to change
+        dof = int(config['dof'])
+        obj = config['obj']
+        interp_type = config['interp_type']
+
+        rigid_trans = config['rigid_trans']
+        starting_point = config['point0_world_coordinate']
+        shards = int(config.get('shards', 1))
+
+        self.coarse_factor = int(config.get('coarse_to_fine', 1) or 1)
+        self.rigid_trans = [float(value) for value in str(rigid_trans).split()]
+        if self.coarse_factor > 1:
+            # the regions of the fine stage are run as shards
+            shards = max(shards, int(config.get('coarse_regions', 8)))
+            fine_disp_max = int(config.get('fine_disp_max', 0) or 0)
+            if fine_disp_max <= 0:
+                fine_disp_max = max(int(math.ceil(disp_max / self.coarse_factor)), 2 * self.coarse_factor)
+        adaptive_sweep = bool(config.get('adaptive_sweep', False))
+        if adaptive_sweep and self.coarse_factor > 1:
+            message_callback.emit("The adaptive sweep is not used with the coarse-to-fine pipeline")
+            adaptive_sweep = False
+        # the configurations of the bulk run, for the adaptive sweep
+        configurations = {}
+
+        # this is the one directory we created where we will run the dvc command in
+        # we want to change this to create multiple directories first and then run through
+        # all the directory created https://github.com/TomographicImaging/iDVC/issues/37
+        # see also https://github.com/TomographicImaging/iDVC/pull/69
+        self.run_folder = config['run_folder']
+
+        exe_file = get_dvc_executable()
+
+        self.cache = None
+        cache_size = float(config.get('result_cache_size', 0) or 0)
+        if self.use_cache and cache_size > 0:
+            self.cache = FileCache(user_cache_dir('results'), int(cache_size * 1024**3))
+            message_callback.emit("Computing the fingerprint of the input files")
+            exe_path = shutil.which(exe_file)
+            # the results depend on the content of the files and on the version of the executable
+            self.exe_digest = self.cache.file_digest(exe_path) if exe_path is not None else exe_file
+
+        def write_config(config_filename, point_cloud_filename, output_filename, subvolume_size,
+                         subvolume_point, num_points_to_process, starting_point, fingerprint=True, **overrides):
+            """Writes the configuration file, the fields in overrides replace the ones of the run.
+
+            Returns its fingerprint if the result cache is used and fingerprint is True, otherwise None"""
+            fields = dict(
+                reference_filename=  reference_file, # reference tomography image volume
+                correlate_filename=  correlate_file, # correlation tomography image volume
+                point_cloud_filename = point_cloud_filename,
+                output_filename= output_filename,
+                vol_bit_depth=  vol_bit_depth, # get from ref, 8 or 16
+                vol_hdr_lngth=vol_hdr_lngth,# get from ref, fixed-length header size, may be zero
+                vol_wide= dims[0], # number of x slices
+                vol_high= dims[1], # number of y slices
+                vol_tall= dims[2], #number of z slices
+                vol_endian = endian,
+                subvol_geom=  subvol_geom,
+                subvol_size=  subvolume_size,
+                subvol_npts= subvolume_point,
+                subvol_thresh='off',
+                gray_thresh_min='27',
+                gray_thresh_max='127',
+                min_vol_fract='0.2',
+                disp_max=  disp_max, #38 for test image
+                num_srch_dof=  dof, #6 for test image
+                obj_function=  obj,
+                interp_type=  interp_type, #tricubic for test image
+                rigid_trans= rigid_trans, #translation between ref and cor - determined from image registration
+                basin_radius='0.0',
+                subvol_aspect='1.0 1.0 1.0',# image spacing
+                num_points_to_process=num_points_to_process,
+                starting_point='{} {} {}'.format(*starting_point))
+            fields.update(overrides)
+            with open(config_filename,"w") as config_file:
+                config_file.write(blank_config.format(**fields))
+            if not fingerprint:
+                return None
+            return self.config_fingerprint(config_filename)
+
+        start_progress = 90
+        end_progress = 99
+
+        # the point clouds are shared by many runs, the run folders link to a single copy
+        store = PointCloudStore(os.path.join(self.run_folder, ".point_clouds"))
+
+        if self.coarse_factor > 1:
+            from idvc.dvc_multiresolution import (bin_raw_volume, sparse_point_cloud,
+                                                  to_coarse_coordinates)
+            # coarse stage: a single run on the binned volumes with a sparse point cloud
+            factor = self.coarse_factor
+            coarse_folder = os.path.join(self.run_folder, "coarse")
+            self.coarse_output = os.path.join(coarse_folder, "dvc_result_coarse")
+            if self.resume and result_is_complete(self.coarse_output):
+                self.skipped_runs += 1
+            else:
+                make_run_folder(coarse_folder, self.resume)
+                message_callback.emit("Binning the volumes for the coarse stage")
+                binned = {}
+                for name, image_file in (("reference", reference_file), ("correlate", correlate_file)):
+                    binned[name] = os.path.join(coarse_folder, "{}_bin{}.raw".format(name, factor))
+                    coarse_dims = bin_raw_volume(image_file, binned[name], dims, vol_bit_depth, vol_hdr_lngth,
+                                                 endian, factor)
+                cloud = np.loadtxt(roi_files[0], ndmin=2)
+                sparse = sparse_point_cloud(cloud, min(int(config.get('coarse_points', 200)), len(cloud)))
+                sparse[:, 1:4] = to_coarse_coordinates(sparse[:, 1:4], factor)
+                coarse_roi = os.path.join(coarse_folder, "grid_input.roi")
+                np.savetxt(coarse_roi, sparse, '%d\t%.3f\t%.3f\t%.3f')
+                coarse_start = sparse[nearest_point(sparse, to_coarse_coordinates(starting_point, factor)), 1:4]
+                coarse_subvolume_size = max(int(subvolume_sizes[0]) // factor, 8)
+                coarse_config = os.path.join(coarse_folder, "dvc_config.txt")
+                fingerprint = write_config(coarse_config, coarse_roi, self.coarse_output, coarse_subvolume_size,
+                    min(int(subvolume_points[0]), coarse_subvolume_size ** 3), len(sparse), coarse_start,
+                    reference_filename=binned["reference"], correlate_filename=binned["correlate"],
+                    vol_hdr_lngth=0, vol_endian="little",
+                    vol_wide=coarse_dims[0], vol_high=coarse_dims[1], vol_tall=coarse_dims[2],
+                    disp_max=int(math.ceil(disp_max / factor)),
+                    rigid_trans='{} {} {}'.format(*[value / factor for value in self.rigid_trans]))
+                if not self.restore_cached_result(fingerprint, self.coarse_output):
+                    self.runs.append(DVCRun(exe_file, coarse_config, self.coarse_output, len(sparse), fingerprint))
+
+        for roi_num, roi_file in enumerate(roi_files):
+            subvolume_size = int(subvolume_sizes[roi_num])
+            num_points = min(count_points(roi_file), num_points_to_process)
+
+            stored_roi = store.add_file(roi_file)
+            if shards > 1:
+                # split the point cloud once for all the runs that use it
+                cloud = np.loadtxt(roi_file, ndmin=2)
+                shard_indices = partition_point_cloud(cloud, shards)
+                # the shard containing the starting point of the run goes first,
+                # so that its results are the first in the merged files
+                first = nearest_point(cloud, starting_point)
+                shard_indices.sort(key=lambda indices: first not in indices)
+                stored_shards = [store.add_points(cloud[indices]) for indices in shard_indices]
+
+            for subv_num, subvolume_point in enumerate(subvolume_points):
+                # use a counter for both for loops
+                counter = subv_num + roi_num * len(subvolume_points)
+
+                this_run_folder = os.path.join(self.run_folder, "dvc_result_{}".format(counter))
+                output_filename = os.path.join(this_run_folder, "dvc_result_{}".format(counter))
+                config_filename = os.path.join(this_run_folder,"dvc_config.txt")
+                first_run = len(self.runs)
+                configurations[counter] = {'roi_file': roi_file, 'size': subvolume_size, 'points': subvolume_point,
+                                           'num_points': num_points, 'run_folder': this_run_folder, 'runs': []}
+                if self.resume and result_is_complete(output_filename):
+                    self.skipped_runs += 1
+                    continue
+                grid_roi_fname = os.path.join(this_run_folder, "grid_input.roi")
+                if not (self.resume and shards > 1 and os.path.isdir(this_run_folder)):
+                    # when resuming a sharded run, the shards with complete results are kept
+                    make_run_folder(this_run_folder, self.resume)
+                    # links the pointcloud file as a whole in the run directory
+                    link_or_copy(stored_roi, grid_roi_fname)
+
+                if shards > 1:
+                    # the configuration of the merged run, as if it was not sharded, so that the
+                    # run folder reads as the folder of a single dvc run
+                    overrides = {'disp_max': fine_disp_max} if self.coarse_factor > 1 else {}
+                    write_config(config_filename, grid_roi_fname, output_filename, subvolume_size,
+                                 subvolume_point, num_points_to_process, starting_point, fingerprint=False,
+                                 **overrides)
+                    shard_outputs = []
+                    for shard_num, indices in enumerate(shard_indices):
+                        shard_folder = os.path.join(this_run_folder, "shard_{}".format(shard_num))
+                        shard_output_filename = os.path.join(shard_folder, "dvc_result_{}".format(counter))
+                        shard_outputs.append(shard_output_filename)
+                        if self.resume and result_is_complete(shard_output_filename):
+                            self.skipped_runs += 1
+                            continue
+                        make_run_folder(shard_folder, self.resume)
+                        shard_roi_fname = os.path.join(shard_folder, "grid_input.roi")
+                        link_or_copy(stored_shards[shard_num], shard_roi_fname)
+                        shard_config_filename = os.path.join(shard_folder, "dvc_config.txt")
+                        if shard_num == 0:
+                            shard_starting_point = starting_point
+                        else:
+                            # seed the shard with its point nearest to the starting point of the run
+                            shard_cloud = cloud[indices]
+                            shard_starting_point = shard_cloud[nearest_point(shard_cloud, starting_point), 1:4]
+                        # share the points to process between the shards
+                        shard_points = min(len(indices),
+                            max(int(round(num_points_to_process * len(indices) / len(cloud))), 1))
+                        if self.coarse_factor > 1:
+                            # the rigid_trans of the region is set by next_stage, from the coarse stage
+                            write_config(shard_config_filename, shard_roi_fname, shard_output_filename,
+                                         subvolume_size, subvolume_point, shard_points, shard_starting_point,
+                                         fingerprint=False, disp_max=fine_disp_max)
+                            run = DVCRun(exe_file, shard_config_filename, shard_output_filename, shard_points)
+                            run.region = cloud[indices, 1:4]
+                            self.pending_runs.append(run)
+                            continue
+                        fingerprint = write_config(shard_config_filename, shard_roi_fname, shard_output_filename,
+                                     subvolume_size, subvolume_point, shard_points, shard_starting_point)
+                        if self.restore_cached_result(fingerprint, shard_output_filename):
+                            continue
+                        self.runs.append(DVCRun(exe_file, shard_config_filename, shard_output_filename, shard_points,
+                                                fingerprint))
+                    self.shard_groups.append((output_filename, shard_outputs))
+                else:
+                    fingerprint = write_config(config_filename, grid_roi_fname, output_filename, subvolume_size,
+                                 subvolume_point, num_points_to_process, starting_point)
+                    if not self.restore_cached_result(fingerprint, output_filename):
+                        self.runs.append(DVCRun(exe_file, config_filename, output_filename, num_points,
+                                                fingerprint))
+                configurations[counter]['runs'] = self.runs[first_run:]
+                progress_callback.emit(int(start_progress + (end_progress - start_progress) * (subv_num / len(roi_files))))
+            progress_callback.emit(100)
+
+        if self.pending_runs:
+            self.next_stage_fn = self.fine_stage
+
+        if adaptive_sweep:
+            from idvc.dvc_sweep import AdaptiveSweep
+            from idvc.dvc_multiresolution import sparse_point_cloud
+            clouds = {}
+
+            def write_sample_run(counter, num_sample_points, round_num):
+                '''Writes a configuration on a stratified subset of its point cloud, in the sweep folder'''
+                configuration = configurations[counter]
+                round_folder = os.path.join(self.run_folder, "sweep", "round_{}".format(round_num))
+                os.makedirs(round_folder, exist_ok=True)
+                sample_folder = os.path.join(round_folder, "dvc_result_{}".format(counter))
+                sample_output = os.path.join(sample_folder, "dvc_result_{}".format(counter))
+                if self.resume and result_is_complete(sample_output):
+                    self.skipped_runs += 1
+                    return sample_output, None
+                make_run_folder(sample_folder, self.resume)
+                if configuration['roi_file'] not in clouds:
+                    clouds[configuration['roi_file']] = np.loadtxt(configuration['roi_file'], ndmin=2)
+                cloud = clouds[configuration['roi_file']]
+                sample = sparse_point_cloud(cloud, min(num_sample_points, len(cloud)))
+                sample_roi = os.path.join(sample_folder, "grid_input.roi")
+                link_or_copy(store.add_points(sample), sample_roi)
+                sample_config = os.path.join(sample_folder, "dvc_config.txt")
+                fingerprint = write_config(sample_config, sample_roi, sample_output, configuration['size'],
+                    configuration['points'], len(sample), sample[nearest_point(sample, starting_point), 1:4])
+                if self.restore_cached_result(fingerprint, sample_output):
+                    return sample_output, None
+                return sample_output, DVCRun(exe_file, sample_config, sample_output, len(sample), fingerprint)
+
+            self.sweep = AdaptiveSweep(self, configurations, write_sample_run,
+                                       int(config.get('sweep_sample_points', 200)), int(config.get('sweep_eta', 2)))
+            self.runs = self.sweep.first_round()
+        return self.runs
+
+    def convert_to_raw(self, image_file, raw_fname, hdf5_dataset_path, message_callback, progress_callback,
+                       start_progress, end_progress, raw_format=None):
+        '''Converts TIFF stacks and HDF5/NeXus files to raw, which can be read by the dvc executable.
+
+        .npy and MetaImage files are converted too if the executable can't read them in place,
+        see voxels_in_place, e.g. if they are compressed or their type or byte order differ from
+        raw_format, the vol_bit_depth, vol_endian and dims of the run config.
+
+        If the volume cache is used, the conversion is taken from it when the source files did not
+        change, and stored in it otherwise.
+
+        Returns the file to pass to the dvc executable.'''
+        is_tiff_stack = isinstance(image_file, (list, tuple))
+        dtype = None
+        if is_tiff_stack:
+            sources = list(image_file)
+            hdf5_dataset_path = None
+        elif image_file.endswith(('.nxs', '.h5', '.hdf5')):
+            sources = [image_file]
+        elif raw_format is not None and image_file.lower().endswith(('.mha', '.mhd', '.npy')):
+            # imported here as the probes require the full app installation
+            from idvc.io import probe_volume
+            volume_info = probe_volume([image_file])
+            if voxels_in_place(volume_info, *raw_format):
+                # see locate_voxels
+                return image_file
+            sources = sorted({image_file, volume_info['data_file']})
+            hdf5_dataset_path = None
+            dtype = raw_dtype(*raw_format[:2])
+        else:
+            return image_file
+        if os.path.exists(raw_fname):
+            return raw_fname
+
+        key = None
+        if self.volume_cache is not None:
+            # the raw files of .npy and MetaImage files also depend on the type of the run config
+            parameters = {} if dtype is None else {'dtype': dtype.str}
+            key = stat_fingerprint(sources, dataset_path=hdf5_dataset_path, version=RAW_CONVERSION_VERSION,
+                                   **parameters)
+            cached_fname = self.restore_cached_volume(key, raw_fname)
+            if cached_fname is not None:
+                message_callback.emit("Using the {} volume converted before".format(
+                    os.path.splitext(os.path.basename(raw_fname))[0]))
+                return cached_fname
+
+        message_callback.emit("Converting {} file to raw format".format(
+            os.path.splitext(os.path.basename(raw_fname))[0]))
+        # imported here as the conversion requires the full app installation
+        if is_tiff_stack:
+            from idvc.io import save_tiff_stack_as_raw
+            save_tiff_stack_as_raw(image_file, raw_fname, progress_callback, start_progress, end_progress)
+        elif dtype is not None:
+            from idvc.io import save_volume_as_raw
+            save_volume_as_raw(image_file, raw_fname, dtype, progress_callback, start_progress, end_progress)
+        else:
+            from idvc.io import save_nxs_as_raw
+            save_nxs_as_raw(image_file, hdf5_dataset_path, raw_fname, progress_callback, start_progress,
+                            end_progress)
+        if key is not None:
+            try:
+                # the raw file is not modified after the conversion, it can be shared with the cache
+                self.volume_cache.put(key, {"volume.raw": raw_fname}, link=True)
+            except OSError as err:
+                print (err)
+        return raw_fname
+
+    def restore_cached_volume(self, key, raw_fname):
+        '''Links or copies a converted volume from the cache to raw_fname, if it is there.
+
+        The cached file itself is never passed to the dvc executable, as it can be evicted while
+        the runs read it. Returns raw_fname, or None if the volume is not in the cache.'''
+        files = self.volume_cache.get(key)
+        if files is None:
+            return None
+        try:
+            os.link(files["volume.raw"], raw_fname)
+        except OSError:
+            # e.g. on another file system; not a symbolic link, which eviction would break
+            try:
+                shutil.copyfile(files["volume.raw"], raw_fname + ".tmp")
+                os.replace(raw_fname + ".tmp", raw_fname)
+            except OSError as err:
+                # e.g. evicted by another session since get
+                print (err)
+                return None
+        return raw_fname
+
+    def locate_voxels(self, inputs, vol_hdr_lngth, results_folder, message_callback):
+        '''Returns the files passed to the dvc executable for the reference and correlate volumes,
+        and their header length.
+
+        .npy and MetaImage files which convert_to_raw did not convert are passed in place, with
+        the offset of their voxels as header length. As the executable takes a single header
+        length for both volumes, if they differ the voxels are copied to raw files in the results
+        folder.
+
+        Parameters
+        ----------
+        inputs : list of tuple
+            for the reference and correlate volumes, the image file of the run config and the
+            file returned by convert_to_raw.
+        vol_hdr_lngth : int
+            the header length of the run config, used for the raw files.
+        '''
+        files, offsets = [], []
+        for image_file, converted_file in inputs:
+            if converted_file != image_file:
+                files.append(converted_file)
+                offsets.append(0)
+            elif image_file.lower().endswith(('.mha', '.mhd', '.npy')):
+                # imported here as the probes require the full app installation
+                from idvc.io import probe_volume
+                volume_info = probe_volume([image_file])
+                files.append(volume_info['data_file'])
+                offsets.append(volume_info['header_length'])
+            else:
+                files.append(image_file)
+                offsets.append(vol_hdr_lngth)
+        if offsets[0] != offsets[1]:
+            for i, name in enumerate(("reference", "correlate")):
+                if offsets[i] != 0:
+                    raw_fname = os.path.join(results_folder, name + ".raw")
+                    if not os.path.exists(raw_fname):
+                        message_callback.emit("Copying the {} volume to raw format".format(name))
+                        copy_voxels(files[i], offsets[i], raw_fname)
+                    files[i] = raw_fname
+            offsets = [0, 0]
+        return files[0], files[1], offsets[0]
+
+    @property
+    def has_next_stage(self):
+        '''True if there are runs which can start only when the current ones have succeeded'''
+        return self.next_stage_fn is not None
+
+    def next_stage(self):
+        '''Sets up the next stage of the run, called when all the runs of the current stage
+        have succeeded, e.g. the fine stage of the coarse-to-fine pipeline or the next round
+        of the adaptive sweep. Returns the runs of the stage, which replace self.runs.'''
+        stage, self.next_stage_fn = self.next_stage_fn, None
+        self.runs = stage()
+        return self.runs
+
+    def fine_stage(self):
+        '''Sets up the fine stage of the coarse-to-fine pipeline.
+
+        The rigid_trans of each region is the median displacement of the nearest points of
+        the coarse stage. Returns the runs of the fine stage.'''
+        from idvc.dvc_multiresolution import (read_displacements, region_translation,
+                                              to_fine_coordinates)
+        factor = self.coarse_factor
+        positions, displacements = read_displacements(self.coarse_output + ".disp")
+        positions = to_fine_coordinates(positions, factor)
+        displacements = displacements * factor
+        runs = []
+        for run in self.pending_runs:
+            rigid_trans = region_translation(run.region, positions, displacements, self.rigid_trans)
+            with open(run.config_filename) as f:
+                config_text = f.read()
+            with open(run.config_filename, "w") as f:
+                f.write(set_config_fields(config_text, rigid_trans='{:.3f} {:.3f} {:.3f}'.format(*rigid_trans)))
+            run.fingerprint = self.config_fingerprint(run.config_filename)
+            if not self.restore_cached_result(run.fingerprint, run.output_filename):
+                runs.append(run)
+        self.pending_runs = []
+        return runs
+
+    def config_fingerprint(self, config_filename):
+        '''Returns the digest of the inputs of a configuration file, or None if the result cache is not used.
+
+        The fingerprint covers the content of the input files, the dvc executable and all the other
+        fields of the configuration, except the name of the output files.'''
+        if self.cache is None:
+            return None
+        with open(config_filename) as f:
+            config_text = f.read()
+        fields = read_config_fields(config_text)
+        config_text = set_config_fields(config_text,
+            reference_filename=self.cache.file_digest(fields['reference_filename']),
+            correlate_filename=self.cache.file_digest(fields['correlate_filename']),
+            point_cloud_filename=hash_file(fields['point_cloud_filename']),
+            output_filename='')
+        return hashlib.sha256((config_text + self.exe_digest).encode()).hexdigest()
+
+    def restore_cached_result(self, fingerprint, output_filename):
+        '''Links the results of a configuration from the cache, if they are there.
+
+        Returns True if the results were restored.'''
+        if self.cache is None or fingerprint is None:
+            return False
+        files = self.cache.get(fingerprint)
+        if files is None:
+            return False
+        for extension in (".disp", ".stat"):
+            destination = output_filename + extension
+            if os.path.exists(destination):
+                os.remove(destination)
+            try:
+                os.link(files["result" + extension], destination)
+            except OSError:
+                shutil.copyfile(files["result" + extension], destination)
+        self.cached_runs += 1
+        return True
+
+    def cache_result(self, run):
+        '''Stores the results of a run which succeeded in the cache'''
+        if self.cache is None or run.fingerprint is None or not run.succeeded:
+            return
+        try:
+            self.cache.put(run.fingerprint, {"result.disp": run.output_filename + ".disp",
+                                             "result.stat": run.output_filename + ".stat"})
+        except OSError as err:
+            print (err)
+
+    def finalise(self):
+        '''Merges the results of the sharded runs. Called when all the runs have succeeded.'''
+        for output_filename, shard_outputs in self.shard_groups:
+            merge_shard_results(shard_outputs, output_filename)
+
+
+class DVCScheduler(object):
+    '''Decides which runs to start and keeps track of their progress.
+
+    It does not start the processes itself, so it can be used both with QProcess
+    and with subprocess.
+
+    Parameters
+    ----------
+    runs : list of DVCRun
+        the runs to execute.
+    total_threads : int
+        total number of threads available to the runs.
+    max_concurrent : int
+        maximum number of dvc processes running at the same time.
+    log_metrics : bool, default True
+        whether to write the metrics of each run in METRICS_FILENAME, in the
+        folder of its output files.
+    on_run_finished : callable, optional
+        called with each run that finishes, e.g. DVCEngine.cache_result.
+    memory_limit : int, optional
+        memory the dvc processes may use, in bytes. By default, a fraction MEMORY_HEADROOM of the
+        memory available when the scheduler is created. The number of concurrent processes is
+        reduced so that their estimated memory fits, and the threads are shared between them.
+    '''
+    def __init__(self, runs, total_threads=4, max_concurrent=1, log_metrics=True, on_run_finished=None,
+                 memory_limit=None):
+        self.runs = runs
+        self.memory_limit = memory_limit if memory_limit is not None else memory_budget()
+        self.concurrent, self.threads_per_process = \
+            split_thread_budget(total_threads, len(runs), max_concurrent)
+        memory_concurrent = memory_concurrency(runs, self.memory_limit)
+        if memory_concurrent is not None and memory_concurrent < self.concurrent:
+            print ("Running at most {} dvc processes at the same time: each needs about {:.1f} GB "
+                   "of the {:.1f} GB of memory available".format(memory_concurrent,
+                   max(run.memory for run in runs) / 1024**3, self.memory_limit / 1024**3))
+            # the threads of the processes which can't run are given to the others
+            self.concurrent, self.threads_per_process = \
+                split_thread_budget(total_threads, len(runs), memory_concurrent)
+        self.next_index = 0
+        self.running = []
+        self.completed = []
+        self.cancelled = False
+        self.log_metrics = log_metrics
+        self.on_run_finished = on_run_finished
+        self.metrics = {}
+        self.tracker = ProgressTracker(sum(run.num_points for run in runs))
+
+    def next_run(self):
+        '''Returns the next run to start, or None if no run can be started now.'''
+        if self.cancelled or self.next_index >= len(self.runs) \
+            or len(self.running) >= self.concurrent:
+            return None
+        run = self.runs[self.next_index]
+        if self.running and self.memory_limit is not None and \
+            sum(r.memory for r in self.running) + run.memory > self.memory_limit:
+            # the first run is always started, even if it may not fit
+            return None
+        self.next_index += 1
+        run.points_processed = 0
+        self.running.append(run)
+        self.tracker.start(run)
+        if self.log_metrics:
+            try:
+                self.metrics[run] = RunMetricsLog(
+                    os.path.join(os.path.dirname(run.output_filename), METRICS_FILENAME), run)
+            except OSError as err:
+                print (err)
+        return run
+
+    def environment(self, run):
+        '''Environment variables to set for the process of run'''
+        return {"OMP_NUM_THREADS": str(self.threads_per_process)}
+
+    def update(self, run, line):
+        '''Updates the progress of run with a line of output of the dvc executable.
+
+        Returns the ProgressEvent for the line.'''
+        event = self.tracker.update(run, line)
+        if event.kind == ProgressEvent.POINTS:
+            run.points_processed = parse_progress_line(line)
+            if run in self.metrics:
+                self.metrics[run].progress(run.points_processed)
+        return event
+
+    def run_finished(self, run, succeeded, exit_code=None):
+        if run in self.running:
+            self.running.remove(run)
+        run.succeeded = succeeded
+        self.tracker.finish(run, succeeded)
+        if succeeded:
+            run.points_processed = run.num_points
+        if run in self.metrics:
+            self.metrics.pop(run).finish(succeeded, exit_code, run.points_processed)
+        self.completed.append(run)
+        if self.on_run_finished is not None:
+            self.on_run_finished(run)
+
+    def process_finished(self, run, exit_code, normal_exit=True):
+        '''Records the end of the process of a run, which succeeded if it exited normally with
+        the exit code 0. Returns whether it succeeded.'''
+        succeeded = normal_exit and exit_code == 0
+        self.run_finished(run, succeeded, exit_code)
+        return succeeded
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def finished(self):
+        '''True when no run is running and no other run will be started'''
+        return len(self.running) == 0 and \
+            (self.cancelled or self.next_index >= len(self.runs))
+
+    @property
+    def succeeded(self):
+        return not self.cancelled and len(self.completed) == len(self.runs) and \
+            all(run.succeeded for run in self.completed)
+
+    def progress(self):
+        '''Returns the percentage of points processed and the estimated time to completion in seconds'''
+        return self.tracker.percentage(), self.tracker.eta()
+
+
+class HeadlessRunner(object):
+    '''Runs the configurations of a DVCEngine with subprocess, reporting the progress on a stream.
+
+    Parameters
+    ----------
+    engine : DVCEngine
+        an engine that has been set up.
+    total_threads : int
+        total number of threads available to the runs.
+    max_concurrent : int
+        maximum number of dvc processes running at the same time.
+    stream : file-like, default sys.stdout
+        where the progress is reported.
+    report_interval : float, default 1
+        minimum time between progress reports, in seconds.
+    memory_limit : int, optional
+        memory the dvc processes may use, in bytes, see DVCScheduler.
+    stop_file : str, optional
+        the execution is cancelled, as if interrupted, when this file is created.
+        Used to stop the runs where the process can't be sent a SIGINT, e.g. on Windows.
+    '''
+    def __init__(self, engine, total_threads=4, max_concurrent=1, stream=None, report_interval=1.,
+                 memory_limit=None, stop_file=None):
+        self.engine = engine
+        self.stop_file = stop_file
+        self.total_threads = total_threads
+        self.max_concurrent = max_concurrent
+        self.memory_limit = memory_limit
+        self.scheduler = DVCScheduler(engine.runs, total_threads, max_concurrent,
+                                      on_run_finished=engine.cache_result, memory_limit=memory_limit)
+        self.stream = stream if stream is not None else sys.stdout
+        self.throttle = Throttle(report_interval)
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.input_errors = []
+        # set by the reader threads when a process exits, so that the next run starts at once
+        self.wakeup = threading.Event()
+
+    def report(self, message):
+        self.stream.write(message + "\n")
+        self.stream.flush()
+
+    def _read_output(self, run, process):
+        for line in process.stdout:
+            with self.lock:
+                event = self.scheduler.update(run, line)
+            if event.kind == ProgressEvent.INPUT_ERROR:
+                self.input_errors.append(run)
+                self.report("{}: {}".format(run.config_filename, line.strip()))
+                process.kill()
+        process.wait()
+        self.wakeup.set()
+
+    def _start(self, run):
+        env = dict(os.environ)
+        env.update(self.scheduler.environment(run))
+        process = subprocess.Popen([run.exe_file] + run.args, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, env=env, cwd=os.getcwd(), universal_newlines=True)
+        reader = threading.Thread(target=self._read_output, args=(run, process), daemon=True)
+        reader.start()
+        self.processes[run] = (process, reader)
+        self.report("Started {}".format(run.config_filename))
+
+    def run(self):
+        '''Runs all the configurations, stage after stage.
+
+        Returns the exit code: 0 if all the runs succeeded, 1 if any failed and
+        130 if the execution was interrupted.'''
+        exit_code = self.run_stage()
+        while exit_code == 0 and self.engine.has_next_stage:
+            self.report("Starting the next stage of the run")
+            self.scheduler = DVCScheduler(self.engine.next_stage(), self.total_threads, self.max_concurrent,
+                                          on_run_finished=self.engine.cache_result, memory_limit=self.memory_limit)
+            exit_code = self.run_stage()
+        if exit_code != 0:
+            return exit_code
+        self.engine.finalise()
+        self.report("The DVC code ran successfully.")
+        return 0
+
+    def run_stage(self):
+        '''Runs the configurations of the scheduler, returns the exit code'''
+        scheduler = self.scheduler
+        try:
+            while not scheduler.finished:
+                if self.stop_requested():
+                    return self.cancel(scheduler)
+                with self.lock:
+                    run = scheduler.next_run()
+                while run is not None:
+                    self._start(run)
+                    with self.lock:
+                        run = scheduler.next_run()
+                finished_runs = 0
+                for run, (process, reader) in list(self.processes.items()):
+                    if process.poll() is not None:
+                        finished_runs += 1
+                        reader.join()
+                        succeeded = process.returncode == 0 and run not in self.input_errors
+                        with self.lock:
+                            scheduler.run_finished(run, succeeded, process.returncode)
+                        del self.processes[run]
+                        self.report("Finished {} with exit code {}".format(run.config_filename, process.returncode))
+                if self.throttle.ready():
+                    self.report_progress()
+                if finished_runs == 0:
+                    # until a process exits, or to report the progress
+                    self.wakeup.wait(0.1)
+                    self.wakeup.clear()
+        except KeyboardInterrupt:
+            return self.cancel(scheduler)
+
+        self.report_progress()
+        if not scheduler.succeeded:
+            self.report("The DVC code had some troubles.")
+            return 1
+        return 0
+
+    def stop_requested(self):
+        return self.stop_file is not None and os.path.exists(self.stop_file)
+
+    def cancel(self, scheduler):
+        '''Kills the running dvc processes, returns the exit code of an interrupted execution'''
+        scheduler.cancel()
+        for run, (process, reader) in self.processes.items():
+            process.kill()
+            scheduler.run_finished(run, False)
+        self.processes = {}
+        self.report("The run was cancelled.")
+        return 130
+
+    def report_progress(self):
+        with self.lock:
+            prog, etcs = self.scheduler.progress()
+            running = len(self.scheduler.running)
+            completed = len(self.scheduler.completed)
+            points_per_second = self.scheduler.tracker.points_per_second
+        line = "Runs completed {}/{} ({} running), progress {}%".format(
+            completed, len(self.scheduler.runs), running, prog)
+        if points_per_second is not None:
+            line += ", {:.1f} points/s".format(points_per_second)
+        if etcs is not None:
+            line += ", estimated time to completion {}".format(time.strftime("%H:%M:%S", time.gmtime(etcs)))
+        self.report(line)
@@ -73,12 +73,17 @@ import zipfile
 from functools import reduce
 
 import copy
+import filecmp
 
-from idvc.io import ImageDataCreator, getProgress, displayErrorDialogFromWorker, warningDialog
+from idvc.io import (ImageDataCreator, createImageDataConcurrently, getProgress, displayErrorDialogFromWorker,
+                     warningDialog, probe_metaimage)
 
 from idvc.pointcloud_conversion import cilRegularPointCloudToPolyData, cilNumpyPointCloudToPolyData, PointCloudConverter
 
-from idvc.dvc_runner import DVC_runner
+from idvc.dvc_runner import DVC_runner, QueueRunner
+from idvc.dvc_engine import link_or_copy, run_results_complete
+from idvc.utils.cache import hash_file
+from idvc.dvc_queue import RunQueue, QUEUE_FILENAME
 
 from eqt.ui import FormDialog
 
@@ -99,7 +104,7 @@ __version__ = gui_version.version
 import logging
 
 from idvc.utils.AutomaticRegistration import AutomaticRegistration
-from idvc.utils.point_cloud_io import extract_point_cloud_from_inp_file
+from idvc.utils.point_cloud_io import extract_point_cloud_from_inp_file, point_cloud_generation_key, reusable_point_cloud
 
 allowed_point_cloud_file_formats = ('.roi', '.txt', '.csv', '.xlsx', '.inp')
 
@@ -142,6 +147,30 @@ class MainWindow(QMainWindow):
         dock_viewer_action.triggered.connect(self.Dock3DViewer)
         self.settings_menu.addAction(dock_viewer_action)
 
+        # Run queue menu
+        self.queue_menu = QMenu("Run Queue", self)
+        self.menuBar().addMenu(self.queue_menu)
+
+        show_queue_action = QAction("Show Run Queue", self)
+        show_queue_action.triggered.connect(self.ShowRunQueue)
+        self.queue_menu.addAction(show_queue_action)
+
+        cancel_queued_action = QAction("Cancel Running Job", self)
+        cancel_queued_action.triggered.connect(lambda: self.queue_runner.cancel())
+        self.queue_menu.addAction(cancel_queued_action)
+
+        remove_queued_action = QAction("Remove Queued Job", self)
+        remove_queued_action.triggered.connect(self.CreateRemoveQueuedJobWindow)
+        self.queue_menu.addAction(remove_queued_action)
+
+        requeue_action = QAction("Queue Ended Job Again", self)
+        requeue_action.triggered.connect(self.CreateRequeueJobWindow)
+        self.queue_menu.addAction(requeue_action)
+
+        clear_queue_action = QAction("Clear Ended Jobs", self)
+        clear_queue_action.triggered.connect(lambda: self.run_queue.clear_ended())
+        self.queue_menu.addAction(clear_queue_action)
+
         # Create the Help menu
         help_menu = QMenu('Help', self)
         self.menuBar().addMenu(help_menu)
@@ -200,6 +229,16 @@ class MainWindow(QMainWindow):
         self.SetAppStyle()
 
         self.settings_window = SettingsWindow(self)
+
+        # runs executed in the background, the queue survives a restart of the app
+        self.run_queue = RunQueue(os.path.join(self.temp_folder, QUEUE_FILENAME))
+        self.queue_runner = QueueRunner(self, self.run_queue, self.finished_queued_run)
+        interrupted = self.run_queue.recover()
+        if interrupted > 0:
+            print ("Resuming {} queued runs interrupted when the app exited".format(interrupted))
+        if len(self.run_queue.pending()) > 0:
+            self.queue_runner.start()
+
         if self.settings.value("first_app_load") != "False":
             self.OpenSettings()
             # self.settings.setValue("first_app_load", False)
@@ -285,6 +324,9 @@ class MainWindow(QMainWindow):
         self.reg_load = False
         self.loading_session = False
         self.dvc_input_image_in_session_folder = False    
+        # point clouds generated for runs, by generation key, see pointCloudGenerationKey
+        self.generated_point_clouds = {}
+        self.mask_digest = None
         if hasattr(self, 'ref_image_data'):
             del self.ref_image_data
 
@@ -804,9 +846,28 @@ class MainWindow(QMainWindow):
         else:
             target_size = 0.125
         self.target_image_size = target_size
-        image_data_creator = ImageDataCreator(self, self.image[0], self.ref_image_data, info_var = self.image_info, resample= True, target_size = target_size)
-        image_data_creator.createImageData(convert_raw = True,  
-        finish_fn = partial(self.save_image_info, "ref"), output_dir='.')
+        image_data_creators = [ImageDataCreator(self, self.image[0], self.ref_image_data, info_var = self.image_info, resample= True, target_size = target_size)]
+        if os.path.splitext(self.image[0][0])[1] in ['.mhd', '.mha'] and probe_metaimage(self.image[0][0])['compressed']:
+            # the correlate image is decoded to a raw file for the dvc code at the same time, see save_images_info
+            self.temp_image_data = vtk.vtkImageData()
+            self.corr_image_info = dict()
+            image_data_creators.append(ImageDataCreator(self, self.image[1], self.temp_image_data, info_var=self.corr_image_info))
+        createImageDataConcurrently(self, image_data_creators, self.save_images_info, convert_raw=True, output_dir='.')
+
+    def save_images_info(self):
+        """Called when the images read by view_image are loaded: the reference image, and the
+        correlate image if it was decoded at the same time."""
+        corr_image_info = getattr(self, 'corr_image_info', None)
+        self.save_image_info("ref")
+        if corr_image_info is not None:
+            del self.corr_image_info
+            if 'raw_file' in corr_image_info:
+                self.image_info.update(corr_image_info)
+                self.save_image_info("corr")
+            else:
+                # the correlate image is not compressed, it is passed in place to the dvc code
+                self.dvc_input_image[1] = self.image[1]
+                del self.temp_image_data
 
     def save_image_info(self, image_type):
         """Sets the value of the registration box size to the 1/10 of the max dimension."""
@@ -862,12 +923,8 @@ class MainWindow(QMainWindow):
         if 'raw_file' in self.image_info:
             image_file = [self.image_info['raw_file']]
             if image_type == "ref":
+                # the correlate image of compressed MetaImage files is decoded by view_image
                 self.dvc_input_image[0] = image_file
-                if os.path.splitext(self.image[0][0])[1] in ['.mhd', '.mha']: #need to call create image data so we read header and save image to file w/o header
-                    self.temp_image_data = vtk.vtkImageData()
-                    image_data_creator = ImageDataCreator(self, self.image[1], self.temp_image_data, info_var=self.image_info) 
-                    image_data_creator.createImageData(convert_raw=True,  finish_fn=partial(
-                        self.save_image_info, "corr"), output_dir='.')
             elif image_type == "corr":
                 self.dvc_input_image[1] = image_file
                 if hasattr(self, 'temp_image_data'):
@@ -1449,6 +1506,10 @@ It is used as a global starting point and a translation reference."
         spacing = v.img3D.GetSpacing()
         origin = v.img3D.GetOrigin()
         #  print("Point0 WORLD: ", p0)
+        # The world coordinates are the coordinates of the voxels of the unsampled image: a voxel of
+        # a downsampled image is at the centre of its block, see io.binned_geometry, which may be
+        # between two voxels. Point 0 is the starting point of the dvc code, so it is rounded to a voxel.
+        p0 = [round(c) for c in p0]
         self.point0_world_coords = copy.deepcopy(p0)
         self.point0_sampled_image_coords = copy.deepcopy(self.getPoint0ImageCoords())
         point0actor = 'Point0' in v.actors
@@ -1792,6 +1853,8 @@ It is used as a global starting point and a translation reference."
         target_z_extent = tuple(self.enlarge_extent(2))
 
         self.target_cropped_image_z_extent = target_z_extent
+        # the box read from the chunked volumes of the session, if they are enabled
+        self.target_cropped_image_extent = self.enlarge_extent(0) + self.enlarge_extent(1) + list(target_z_extent)
 
         origin = [0,0,0] #TODO: set appropriately based on input image
 
@@ -1801,19 +1864,17 @@ It is used as a global starting point and a translation reference."
        
         if self.image_info['sampled']:
             
-            if not (hasattr(self, 'unsampled_ref_image_data') and hasattr(self, 'unsampled_corr_image_data')):
-                #print("About to create image")
-                self.unsampled_ref_image_data = vtk.vtkImageData()
+            first_load = not (hasattr(self, 'unsampled_ref_image_data') and hasattr(self, 'unsampled_corr_image_data'))
+            # If registration box is changed need to update the cropped images.
+            if first_load or previous_reg_box_extent != reg_box_extent:
+                if first_load:
+                    self.unsampled_ref_image_data = vtk.vtkImageData()
                 image_data_creator = ImageDataCreator(self, self.image[0], self.unsampled_ref_image_data, info_var=self.unsampled_image_info, crop_image=True, origin=origin,
-                                                 target_z_extent=target_z_extent)
-                image_data_creator.createImageData(output_dir=os.path.abspath(tempfile.tempdir), finish_fn=self.LoadCorrImageForReg, crop_corr_image=True)
-                #TODO: move to doing both image data creators simultaneously - would this work?
-                return
-
-            if previous_reg_box_extent != reg_box_extent: # If registration box is changed need to update the cropped images.
-                image_data_creator = ImageDataCreator(self, self.image[0], self.unsampled_ref_image_data, info_var=self.unsampled_image_info, crop_image=True, origin=origin,
-                                                 target_z_extent=target_z_extent)
-                image_data_creator.createImageData(output_dir=os.path.abspath(tempfile.tempdir), finish_fn=self.LoadCorrImageForReg, crop_corr_image=True)
+                                                 target_z_extent=target_z_extent, target_extent=self.target_cropped_image_extent,
+                                                 chunked_volume=self.getChunkedVolumeFile(0))
+                # the reference and correlate images are loaded at the same time
+                createImageDataConcurrently(self, [image_data_creator, self.createCorrImageDataCreator(crop_corr_image=True)],
+                                            self.completeRegistration, output_dir=os.path.abspath(tempfile.tempdir))
             else:
                 self.completeRegistration()
             
@@ -1828,6 +1889,13 @@ It is used as a global starting point and a translation reference."
                 else:
                     self.completeRegistration()
 
+    def getChunkedVolumeFile(self, index):
+        """Returns the chunked volume of the reference (index 0) or correlate (index 1) image in the
+        session folder, or None if they are not enabled in the settings. See io.write_chunked_volume."""
+        if self.settings.value("chunked_volumes") != "true":
+            return None
+        return os.path.join(tempfile.tempdir, "Volumes", ["reference", "correlate"][index] + ".h5")
+
     def enlarge_extent(self, dim):
         """
         Given the regitration box size inputted by the user and the coordinates of the point zero wrt the unsampled volumes, 
@@ -1854,12 +1922,18 @@ It is used as a global starting point and a translation reference."
         Saves the result in self.unsampled_corr_image_data.
         Then runs self.completeRegistration()
         """
+        image_data_creator = self.createCorrImageDataCreator(resample_corr_image, crop_corr_image)
+        image_data_creator.createImageData(finish_fn=self.completeRegistration, output_dir=os.path.abspath(tempfile.tempdir))
+
+    def createCorrImageDataCreator(self, resample_corr_image=False, crop_corr_image=False):
+        """Returns the ImageDataCreator of the full resolution correlate image, cropped to the current
+        registration box extent, which is loaded in a new self.unsampled_corr_image_data."""
         origin = self.target_cropped_image_origin 
         z_extent = self.target_cropped_image_z_extent
 
         self.unsampled_corr_image_data = vtk.vtkImageData()
-        image_data_creator = ImageDataCreator(self, self.image[1], self.unsampled_corr_image_data, info_var=self.unsampled_image_info, resample=resample_corr_image, crop_image=crop_corr_image, origin=origin, target_z_extent=z_extent)
-        image_data_creator.createImageData(finish_fn=self.completeRegistration, output_dir=os.path.abspath(tempfile.tempdir))
+        return ImageDataCreator(self, self.image[1], self.unsampled_corr_image_data, info_var=self.unsampled_image_info, resample=resample_corr_image, crop_image=crop_corr_image, origin=origin, target_z_extent=z_extent,
+                                target_extent=self.target_cropped_image_extent, chunked_volume=self.getChunkedVolumeFile(1))
 
     def completeRegistration(self):
         """It shows the registration difference volume in the viewer and sets up the tab for the registration. 
@@ -3597,6 +3671,32 @@ File format allowed: 'roi', 'txt', 'csv, 'xlxs', 'inp'.")
 
         return True
 
+    def pointCloudGenerationKey(self, subvol_size):
+        """Returns a digest of the mask and of all the parameters createPointCloud uses to generate
+        a point cloud with subvol_size, so that identical point clouds are generated once."""
+        mask_file = os.path.join(tempfile.gettempdir(), "Masks", "latest_selection.mha")
+        stat = os.stat(mask_file)
+        # the mask is hashed again only when it changes
+        mask_id = (mask_file, stat.st_size, stat.st_mtime_ns)
+        if self.mask_digest is None or self.mask_digest[0] != mask_id:
+            self.mask_digest = (mask_id, hash_file(mask_file))
+        v = self.vis_widget_2D.frame.viewer
+        point0_set = hasattr(self, 'point0_world_coords')
+        return point_cloud_generation_key({
+            'mask': self.mask_digest[1],
+            'subvol_size': subvol_size,
+            'shape': self.subvolumeShapeValue.currentIndex(),
+            'dimensionality': self.dimensionalityValue.currentIndex(),
+            'orientation': v.getSliceOrientation(),
+            'slice': v.getActiveSlice(),
+            'overlap': [float(entry.text()) for entry in [self.overlapXValueEntry, self.overlapYValueEntry, self.overlapZValueEntry]],
+            'rotation': [float(entry.text()) for entry in [self.rotateXValueEntry, self.rotateYValueEntry, self.rotateZValueEntry]],
+            'erode': self.erodeCheck.isChecked(),
+            'erosion_multiplier': self.erodeRatioSpinBox.value(),
+            'point0': list(self.point0_world_coords) if point0_set else None,
+            'point0_sampled': [int(c) for c in self.point0_sampled_image_coords] if point0_set else None
+        })
+
     def loadPointCloud(self, *args, **kwargs):
         """Loads a pointcloud from file. 
         Handles BOM in csv file.
@@ -4529,6 +4629,14 @@ This parameter has a strong effect on computation time, so be careful."
         button_groupBoxFormLayout.setWidget(widgetno, QFormLayout.SpanningRole, rdvc_widgets['run_button'])
         widgetno += 1
 
+        rdvc_widgets['queue_button'] = QPushButton(button_groupBox)
+        rdvc_widgets['queue_button'].setText("Add Run to Queue")
+        rdvc_widgets['queue_button'].setToolTip("The run is executed in the background, after the runs queued before it.\n"
+            "The app can be used to prepare the next run in the meantime.\n"
+            "The session must be saved first.")
+        button_groupBoxFormLayout.setWidget(widgetno, QFormLayout.SpanningRole, rdvc_widgets['queue_button'])
+        widgetno += 1
+
         # TODO: implement option to only generate config
         # rdvc_widgets['run_config'] = QPushButton(button_groupBox)
         # rdvc_widgets['run_config'].setText("Generate Run Config")
@@ -4538,7 +4646,8 @@ This parameter has a strong effect on computation time, so be careful."
 
         #Add button functionality:
         rdvc_widgets['run_type_entry'].currentIndexChanged.connect(self.show_run_groupbox)
-        rdvc_widgets['run_button'].clicked.connect(self.create_config_worker)
+        rdvc_widgets['run_button'].clicked.connect(lambda: self.create_config_worker())
+        rdvc_widgets['queue_button'].clicked.connect(lambda: self.create_config_worker(queue=True))
 
         self.addDockWidget(QtCore.Qt.LeftDockWidgetArea, dockWidget)
 
@@ -4586,9 +4695,16 @@ This parameter has a strong effect on computation time, so be careful."
         if self.roi:
             next_button.setEnabled(True)
 
-    def create_config_worker(self):
+    def create_config_worker(self, queue=False):
         """Creates warning dialogs if information is missing to run DVC.
-        Calls the worker."""
+        Calls the worker. If queue is True, the run is added to the run queue
+        instead of being run at once."""
+        if queue and not os.path.exists(tempfile.tempdir + '.zip'):
+            # the queued run writes to the session folder, which must be loadable after a restart
+            self.warningDialog(window_title="Run Queue",
+                message="Save the session before adding runs to the queue. "
+                        "The results of the queued runs are shown when the session is loaded.")
+            return
         if hasattr(self, 'translate'):
             if self.translate is None:
                 self.warningDialog("Complete image registration first.", "Error")
@@ -4621,6 +4737,39 @@ This parameter has a strong effect on computation time, so be careful."
             self.warningDialog(window_title="Error",
                 message="Please set a run name")
             return
+
+        run_config_file = os.path.join(tempfile.tempdir, "Results", run_name, "_run_config.json")
+        if os.path.exists(run_config_file):
+            # the run was set up before, it may have been cancelled or interrupted
+            run_config = self.run_config_parameters(run_name)
+            if isinstance(run_config, str):
+                self.create_progress_window("Loading", "Generating Run Config")
+                self.show_run_config_error(run_config)
+                return
+            if not self.saved_run_config_matches(run_config_file, run_config):
+                reason = "with different parameters or point clouds"
+            else:
+                with open(run_config_file) as f:
+                    complete = run_results_complete(json.load(f), tempfile.tempdir)
+                reason = "and its results are complete" if complete else None
+            if reason is None:
+                reply = QMessageBox.question(self, "Resume run",
+                    "The run {} already exists.\nDo you want to resume it? Only the configurations without complete results will be run.".format(run_name),
+                    QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+                if reply == QMessageBox.Yes:
+                    self.run_config_file = run_config_file
+                    self.create_progress_window("Loading", "Resuming run")
+                    if queue:
+                        self.queue_run(resume=True)
+                    else:
+                        self.run_external_code(resume=True)
+                return
+            reply = QMessageBox.question(self, "Overwrite run",
+                "The run {} already exists {}.\nIts results will be overwritten. Do you want to continue?".format(run_name, reason),
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if reply != QMessageBox.Yes:
+                return
+            shutil.rmtree(os.path.dirname(run_config_file))
         elif run_name in saved_run_names:
             self.warningDialog(window_title="Error",
                 message="Please set a run name not in the following list: {}".format(saved_run_names))
@@ -4641,11 +4790,160 @@ This parameter has a strong effect on computation time, so be careful."
         self.create_progress_window("Loading", "Generating Run Config")
         self.config_worker.signals.progress.connect(self.progress)
         # if single or bulk use the line below, if remote develop new functionality
-        self.config_worker.signals.result.connect(partial (self.run_external_code))
+        if queue:
+            self.config_worker.signals.result.connect(partial (self.queue_run))
+        else:
+            self.config_worker.signals.result.connect(partial (self.run_external_code))
         self.config_worker.signals.message.connect(self.updateProgressDialogMessage)
         self.threadpool.start(self.config_worker)  
         self.progress_window.setValue(10)
         
+    def run_config_parameters(self, folder_name):
+        """Returns the run config of the run folder_name set in the interface, without the point cloud
+        files, which are written by create_run_config, or an error, see show_run_config_error."""
+        if self.singleRun_groupBox.isVisible():
+            setting = "single"
+        else:
+            setting = "bulk"
+
+        #Prepare the config files.
+        self.points = self.rdvc_widgets['run_points_spinbox'].value()
+
+        if setting == "single":
+            self.subvolume_points = [self.rdvc_widgets['subvol_points_spinbox'].value()]
+            self.subvol_sizes = [self.pointcloud_parameters['pointcloud_size_entry'].text()]
+
+        elif setting == "bulk":
+            xmin = int(self.rdvc_widgets['points_in_subvol_range_min_value'].text())
+            xmax = int(self.rdvc_widgets['points_in_subvol_range_max_value'].text())
+            xstep = int(self.rdvc_widgets['points_in_subvol_range_step_value'].text())
+
+            if xstep != 0:
+                if xmax > xmin:
+                    N = (xmax-xmin)//xstep + 1
+                    self.subvolume_points = [xmin + i * xstep for i in range(N)]
+                else:
+
+                    return ("subvolume error")
+            else:
+                self.subvolume_points = [xmin]
+
+            xmin = int(self.rdvc_widgets['subvol_size_range_min_value'].text())
+            xmax = int(self.rdvc_widgets['subvol_size_range_max_value'].text())
+            xstep = int(self.rdvc_widgets['subvol_size_range_step_value'].text())
+            if xstep != 0:
+                if xmax > xmin:
+                    N = (xmax-xmin)//xstep + 1
+                    self.subvol_sizes = [xmin + i * xstep for i in range(N)]
+                else:
+                    #print("subvolume size error")
+                    return ("subvolume size error")
+            else:
+                self.subvol_sizes = [xmin]
+
+        #print("DVC in: ", self.dvc_input_image)
+        
+        self.reference_file = self.dvc_input_image[0][0]
+        if len(self.dvc_input_image[0]) > 1:
+            self.reference_file = self.dvc_input_image[0]
+        self.correlate_file = self.dvc_input_image[1][0]
+        if len(self.dvc_input_image[1]) > 1:
+            self.correlate_file = self.dvc_input_image[1]
+
+        #print("REF: ", self.reference_file)
+
+
+        run_config = {}
+        run_config['points'] = self.points
+        run_config['subvolume_points'] = self.subvolume_points
+        run_config['subvolume_sizes'] = self.subvol_sizes
+        run_config['reference_file'] = self.reference_file
+        run_config['correlate_file'] = self.correlate_file
+        run_config['vol_bit_depth'] = self.vol_bit_depth #8
+        run_config['vol_hdr_lngth'] = self.vol_hdr_lngth #96
+        run_config['vol_endian'] = "big" if self.image_info['isBigEndian'] else "little"
+        run_config['dims']= self.unsampled_image_dimensions
+        #[self.vis_widget_2D.image_data.GetDimensions()[0],self.vis_widget_2D.image_data.GetDimensions()[1],self.vis_widget_2D.image_data.GetDimensions()[2]] #image dimensions
+
+        run_config['subvol_geom'] = self.pointcloud_parameters['pointcloud_volume_shape_entry'].currentText().lower()
+        run_config['subvol_npts'] = self.subvolume_points
+
+        run_config['disp_max'] = self.rdvc_widgets['run_max_displacement_entry'].value(), #38 for test image
+        run_config['dof'] = self.rdvc_widgets['run_ndof_entry'].currentText()
+        run_config['obj'] = self.rdvc_widgets['run_objf_entry'].currentText()
+        run_config['interp_type'] = self.rdvc_widgets['run_iterp_type_entry'].currentText().lower()
+
+        if (hasattr(self, 'translate')):
+            run_config['rigid_trans'] = str(self.translate.GetTranslation()[0]*-1) + " " + str(self.translate.GetTranslation()[1]*-1) + " " + str(self.translate.GetTranslation()[2]*-1)
+        else:
+            run_config['rigid_trans']= "0.0 0.0 0.0"
+
+        self.run_folder = "Results/" + folder_name
+        run_config['run_folder'] = self.run_folder
+
+        #where is point0
+        run_config['point0'] = self.getPoint0ImageCoords()
+        # here we assume that the world coordinate are the same as the original
+        # image coordinate because spacing is 1,1,1 and origin is 0,0,0 for the 
+        # original input image
+        run_config['point0_world_coordinate'] = self.point0_world_coords
+        if self.settings.value('dvc_shards') is not None:
+            run_config['shards'] = int(self.settings.value('dvc_shards'))
+        else:
+            run_config['shards'] = 1
+        if self.settings.value('result_cache_size') is not None:
+            run_config['result_cache_size'] = float(self.settings.value('result_cache_size'))
+        else:
+            run_config['result_cache_size'] = 0
+        if self.settings.value('volume_cache_size') is not None:
+            run_config['volume_cache_size'] = float(self.settings.value('volume_cache_size'))
+        else:
+            run_config['volume_cache_size'] = 0
+        if self.settings.value('coarse_to_fine') is not None:
+            run_config['coarse_to_fine'] = int(self.settings.value('coarse_to_fine'))
+        else:
+            run_config['coarse_to_fine'] = 1
+        if self.settings.value('coarse_regions') is not None:
+            run_config['coarse_regions'] = int(self.settings.value('coarse_regions'))
+        else:
+            run_config['coarse_regions'] = 8
+        run_config['adaptive_sweep'] = self.settings.value('adaptive_sweep') == "true"
+        if self.settings.value('sweep_sample_points') is not None:
+            run_config['sweep_sample_points'] = int(self.settings.value('sweep_sample_points'))
+        else:
+            run_config['sweep_sample_points'] = 200
+        # needed to run the configuration outside of the app, see idvc_run
+        run_config['hdf5_dataset_path'] = getattr(self, 'hdf5_dataset_path', None)
+        return run_config
+
+    def saved_run_config_matches(self, run_config_file, run_config):
+        """Returns True if the run config saved in run_config_file has the parameters of run_config,
+        see run_config_parameters, and the point clouds the run would use now."""
+        try:
+            with open(run_config_file) as f:
+                saved_run_config = json.load(f)
+        except (OSError, ValueError):
+            return False
+        parameters = {key: value for key, value in saved_run_config.items() if key != 'roi_files'}
+        # e.g. tuples are saved as lists
+        if parameters != json.loads(json.dumps(run_config)):
+            return False
+        try:
+            if self.singleRun_groupBox.isVisible() or self.pointcloud_is == 'loaded':
+                # the point cloud files of the run are copies of self.roi
+                point_cloud = self.roi
+            else:
+                # the point cloud generated for the run, if the mask and its parameters did not change
+                key = self.pointCloudGenerationKey(int(self.pointcloud_parameters['pointcloud_size_entry'].text()))
+                cached = reusable_point_cloud(self.generated_point_clouds, key, tempfile.tempdir)
+                if cached is None:
+                    return False
+                point_cloud = os.path.join(tempfile.tempdir, cached[0])
+            return all(filecmp.cmp(point_cloud, os.path.join(tempfile.tempdir, roi_file), shallow=False)
+                       for roi_file in saved_run_config.get('roi_files', []))
+        except (OSError, ValueError):
+            return False
+
     def create_run_config(self, **kwargs):
         os.chdir(tempfile.tempdir)
         progress_callback = kwargs.get('progress_callback', PrintCallback())
@@ -4656,49 +4954,16 @@ This parameter has a strong effect on computation time, so be careful."
             results_folder = os.path.join(tempfile.tempdir, "Results")
             os.mkdir(os.path.join(results_folder, folder_name))
 
-            if self.singleRun_groupBox.isVisible():
-                setting = "single"
-            else:
-                setting = "bulk"
-
-            #Prepare the config files.
-            self.points = self.rdvc_widgets['run_points_spinbox'].value()
+            run_config = self.run_config_parameters(folder_name)
+            if isinstance(run_config, str):
+                return run_config
 
-            if setting == "single":
-                self.subvolume_points = [self.rdvc_widgets['subvol_points_spinbox'].value()]
-                self.subvol_sizes = [self.pointcloud_parameters['pointcloud_size_entry'].text()]
+            if self.singleRun_groupBox.isVisible():
                 self.roi_files = [self.roi]
                 pointcloud_new_file = os.path.join(results_folder, folder_name, "_" + self.pointcloud_parameters['pointcloud_size_entry'].text() + ".roi")
                 shutil.copyfile(self.roi, pointcloud_new_file)
                 
-            elif setting == "bulk":
-                xmin = int(self.rdvc_widgets['points_in_subvol_range_min_value'].text())
-                xmax = int(self.rdvc_widgets['points_in_subvol_range_max_value'].text())
-                xstep = int(self.rdvc_widgets['points_in_subvol_range_step_value'].text())
-
-                if xstep != 0:
-                    if xmax > xmin:
-                        N = (xmax-xmin)//xstep + 1
-                        self.subvolume_points = [xmin + i * xstep for i in range(N)]
-                    else:
-
-                        return ("subvolume error")
-                else:
-                    self.subvolume_points = [xmin]
-
-                xmin = int(self.rdvc_widgets['subvol_size_range_min_value'].text())
-                xmax = int(self.rdvc_widgets['subvol_size_range_max_value'].text())
-                xstep = int(self.rdvc_widgets['subvol_size_range_step_value'].text())
-                if xstep != 0:
-                    if xmax > xmin:
-                        N = (xmax-xmin)//xstep + 1
-                        self.subvol_sizes = [xmin + i * xstep for i in range(N)]
-                    else:
-                        #print("subvolume size error")
-                        return ("subvolume size error")
-                else:
-                    self.subvol_sizes = [xmin]
-
+            else:
                 self.roi_files = []
                 #print(self.subvol_sizes)
                 subvol_size_count = 0
@@ -4710,9 +4975,20 @@ This parameter has a strong effect on computation time, so be careful."
                     if self.pointcloud_is == 'generated':
                         # we will generate the same pointcloud for each subvolume size
                         pc_subvol_size = self.pointcloud_parameters['pointcloud_size_entry'].text()
-                        if not self.createPointCloud(filename=filename, subvol_size=int(pc_subvol_size), 
-                                                     progress_callback=progress_callback, message_callback=message_callback):
-                            return ("pointcloud error")
+                        key = self.pointCloudGenerationKey(int(pc_subvol_size))
+                        cached = reusable_point_cloud(self.generated_point_clouds, key, tempfile.tempdir)
+                        if cached is not None:
+                            # the same mask and parameters, e.g. for the previous subvolume size
+                            message_callback.emit('Reusing pointcloud')
+                            link_or_copy(os.path.join(tempfile.tempdir, cached[0]), os.path.join(tempfile.tempdir, filename))
+                            self.roi = filename
+                            self.pc_no_points = cached[1]
+                        else:
+                            if not self.createPointCloud(filename=filename, subvol_size=int(pc_subvol_size), 
+                                                         progress_callback=progress_callback, message_callback=message_callback):
+                                return ("pointcloud error")
+                            # relative to the session folder, which is moved when the session is saved
+                            self.generated_point_clouds[key] = (filename, self.pc_no_points)
                     elif self.pointcloud_is == 'loaded':
                         # we will use the file with the pointcloud for each subvol size
                         shutil.copyfile(self.roi, filename)
@@ -4724,54 +5000,7 @@ This parameter has a strong effect on computation time, so be careful."
                 #print("finished making pointclouds")
 
             #print(self.roi_files)
-
-            #print("DVC in: ", self.dvc_input_image)
-            
-            self.reference_file = self.dvc_input_image[0][0]
-            if len(self.dvc_input_image[0]) > 1:
-                self.reference_file = self.dvc_input_image[0]
-            self.correlate_file = self.dvc_input_image[1][0]
-            if len(self.dvc_input_image[1]) > 1:
-                self.correlate_file = self.dvc_input_image[1]
-
-            #print("REF: ", self.reference_file)
-
-
-            run_config = {}
-            run_config['points'] = self.points
-            run_config['subvolume_points'] = self.subvolume_points
-            run_config['subvolume_sizes'] = self.subvol_sizes
-            run_config['reference_file'] = self.reference_file
-            run_config['correlate_file'] = self.correlate_file
             run_config['roi_files']= self.roi_files
-            run_config['vol_bit_depth'] = self.vol_bit_depth #8
-            run_config['vol_hdr_lngth'] = self.vol_hdr_lngth #96
-            run_config['vol_endian'] = "big" if self.image_info['isBigEndian'] else "little"
-            run_config['dims']= self.unsampled_image_dimensions
-            #[self.vis_widget_2D.image_data.GetDimensions()[0],self.vis_widget_2D.image_data.GetDimensions()[1],self.vis_widget_2D.image_data.GetDimensions()[2]] #image dimensions
-
-            run_config['subvol_geom'] = self.pointcloud_parameters['pointcloud_volume_shape_entry'].currentText().lower()
-            run_config['subvol_npts'] = self.subvolume_points
-
-            run_config['disp_max'] = self.rdvc_widgets['run_max_displacement_entry'].value(), #38 for test image
-            run_config['dof'] = self.rdvc_widgets['run_ndof_entry'].currentText()
-            run_config['obj'] = self.rdvc_widgets['run_objf_entry'].currentText()
-            run_config['interp_type'] = self.rdvc_widgets['run_iterp_type_entry'].currentText().lower()
-
-            if (hasattr(self, 'translate')):
-                run_config['rigid_trans'] = str(self.translate.GetTranslation()[0]*-1) + " " + str(self.translate.GetTranslation()[1]*-1) + " " + str(self.translate.GetTranslation()[2]*-1)
-            else:
-                run_config['rigid_trans']= "0.0 0.0 0.0"
-
-            self.run_folder = "Results/" + folder_name
-            run_config['run_folder'] = self.run_folder
-
-            #where is point0
-            run_config['point0'] = self.getPoint0ImageCoords()
-            # here we assume that the world coordinate are the same as the original
-            # image coordinate because spacing is 1,1,1 and origin is 0,0,0 for the 
-            # original input image
-            run_config['point0_world_coordinate'] = self.point0_world_coords
             suffix_text = "run_config"
 
             self.run_config_file = os.path.join(tempfile.tempdir, "Results", folder_name, "_" + suffix_text + ".json")
@@ -4788,13 +5017,13 @@ This parameter has a strong effect on computation time, so be careful."
             self.progress_window.close()
             #TODO: test this and see if we need to stop the worker, or if not returning anything is enough
 
-    def run_external_code(self, error = None):
-        "The error signal of the setup worker is connected to a dialog."
+    def show_run_config_error(self, error):
+        """Shows a dialog for an error returned by create_run_config. Returns True if there was an error."""
         if error == "subvolume error":
             self.progress_window.setValue(100)
             self.warningDialog("Minimum number of sampling points in subvolume value higher than maximum", window_title="Value Error")
             self.cancelled = True
-            return
+            return True
         elif error == "pointcloud error":
             self.progress_window.setValue(100) 
             self.warningDialog(window_title="Error", 
@@ -4803,20 +5032,25 @@ This parameter has a strong effect on computation time, so be careful."
 Try modifying the subvolume size before creating a new pointcloud, and make sure it is smaller than the extent of the mask.\
 The dimensionality of the pointcloud can also be changed in the Point Cloud panel.' )
             self.cancelled = True
-            return
+            return True
         elif error == "subvolume size error":
             self.progress_window.setValue(100) 
             self.warningDialog("Minimum subvolume size value higher than maximum", window_title="Value Error")
             self.cancelled = True
+            return True
+        return False
+
+    def run_external_code(self, error = None, resume = False):
+        """The error signal of the setup worker is connected to a dialog.
+        If resume is True, only the configurations without complete results are run."""
+        if self.show_run_config_error(error):
             return
-            
 
-        
         self.run_succeeded = True
     
         # this command will call DVC_runner to create the directories
         self.dvc_runner = DVC_runner(self, os.path.abspath(self.run_config_file), 
-                                     self.finished_run, self.run_succeeded, tempfile.tempdir)
+                                     self.finished_run, self.run_succeeded, tempfile.tempdir, resume)
 
         setup = Worker(self.dvc_runner.set_up)
         setup.signals.message.connect(self.updateProgressDialogMessage)
@@ -4829,6 +5063,75 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
         self.threadpool.start(setup)
         # self.dvc_runner.run_dvc()
 
+    def queue_run(self, error = None, resume = False):
+        """Adds the run config created by create_run_config to the run queue,
+        and starts the queue if no run is in progress."""
+        if self.show_run_config_error(error):
+            return
+        self.progress_window.close()
+        job = self.run_queue.add(self.run_config_file, tempfile.tempdir, self.rdvc_widgets['name_entry'].text(),
+                                 getattr(self, 'hdf5_dataset_path', None), resume)
+        if not self.queue_runner.start():
+            self.statusBar().showMessage("Run queue: {} added, {} runs pending".format(
+                job['name'], len(self.run_queue.pending())))
+
+    def finished_queued_run(self, job, exit_code):
+        """Adds a run of the current session to the results when it has finished in the run queue.
+        The runs of the other saved sessions are listed in the results when they are loaded."""
+        if exit_code != 0:
+            return
+        if job['session_folder'] != os.path.abspath(tempfile.tempdir):
+            self.statusBar().showMessage("Run queue: {} finished, load the session {} to see its results".format(
+                job['name'], os.path.basename(job['session_folder'])))
+            return
+        if self.result_widgets['run_entry'].findText(job['name']) == -1:
+            self.result_widgets['run_entry'].addItem(job['name'])
+
+    def ShowRunQueue(self):
+        """Shows the jobs of the run queue and their status."""
+        lines = []
+        for job in self.run_queue.jobs():
+            added = datetime.fromtimestamp(job['added']).strftime("%d-%m-%Y %H:%M")
+            lines.append("{}: {} (added {})".format(job['name'], job['status'], added))
+        self.warningDialog(window_title="Run Queue",
+            message="\n".join(lines) if lines else "No runs in the queue.",
+            detailed_text="Queue file: {}".format(self.run_queue.filename))
+
+    def CreateQueueJobSelector(self, title, statuses, ok_text, ok_fn):
+        """Shows a dialog to select a job of the run queue with one of the statuses.
+        ok_fn is called with the id of the selected job."""
+        jobs = [job for job in self.run_queue.jobs() if job['status'] in statuses]
+        if len(jobs) == 0:
+            self.warningDialog(window_title="Run Queue", message="There are no {} jobs in the queue.".format(
+                " or ".join(statuses)))
+            return
+        dialog = FormDialog(parent=self, title=title)
+        combo = QComboBox(dialog.groupBox)
+        for job in jobs:
+            added = datetime.fromtimestamp(job['added']).strftime("%d-%m-%Y %H:%M")
+            combo.addItem("{}: {} (added {})".format(job['name'], job['status'], added), job['id'])
+        dialog.addWidget(combo, 'Select a job:', 'select_job')
+        dialog.Ok.setText(ok_text)
+        dialog.Ok.clicked.connect(lambda: ok_fn(combo.currentData()))
+        dialog.Ok.clicked.connect(dialog.close)
+        dialog.Cancel.clicked.connect(dialog.close)
+        self.QueueJobSelectionWindow = dialog
+        dialog.open()
+
+    def CreateRemoveQueuedJobWindow(self):
+        """Shows a dialog to remove a job which is queued and not running yet."""
+        self.CreateQueueJobSelector("Remove Queued Job", [RunQueue.QUEUED], "Remove", self.run_queue.remove)
+
+    def CreateRequeueJobWindow(self):
+        """Shows a dialog to queue again a job which was cancelled or failed, it is resumed."""
+        self.CreateQueueJobSelector("Queue Ended Job Again", [RunQueue.CANCELLED, RunQueue.FAILED],
+                                    "Queue", self.requeue_job)
+
+    def requeue_job(self, job_id):
+        """Queues again a job which ended, and starts the queue if no run is in progress."""
+        self.run_queue.requeue(job_id)
+        self.queue_runner.start()
+
     def update_progress(self, exe = None):
         if exe:
             line_b = self.process.readLine()
@@ -4850,7 +5153,10 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
 
     def finished_run(self):
         if self.run_succeeded:
-            self.result_widgets['run_entry'].addItem(self.rdvc_widgets['name_entry'].text())
+            run_name = self.rdvc_widgets['name_entry'].text()
+            # a resumed run may already be in the list
+            if self.result_widgets['run_entry'].findText(run_name) == -1:
+                self.result_widgets['run_entry'].addItem(run_name)
             self.show_run_pcs()
 
 
@@ -5105,6 +5411,8 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
         if not hasattr(self, 'should_really_close') or not self.should_really_close:
             event.ignore()
         else:
+            # the queued run is resumed when the app is started again
+            self.queue_runner.stop()
             event.accept()
 
     def CreateSaveWindow(self, cancel_text, event):
@@ -5176,6 +5484,13 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
     def SaveSession(self, text_value, compress, event):
         """Saves a software session. If raw files are created from nxs or TIFF input files"
         they are removed from the session folder."""
+        if os.path.abspath(tempfile.tempdir) in self.run_queue.pending_sessions():
+            # saving moves the session folder, which the queued runs write to
+            self.should_really_close = False
+            self.warningDialog(window_title="Run Queue",
+                message="Runs of this session are in the run queue. Save the session when they have finished, "
+                        "or cancel and remove them with the Run Queue menu.")
+            return
         # Save window geometry and state of dockwindows
         # https://doc.qt.io/qt-5/qwidget.html#saveGeometry
         g = self.saveGeometry()
@@ -5408,7 +5723,11 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
             self.progress_window.setMaximum(100)
             self.progress_window.setValue(98)
         #print("removed temp", tempfile.tempdir)
-        shutil.rmtree(tempfile.tempdir)
+        if os.path.abspath(tempfile.tempdir) in self.run_queue.pending_sessions():
+            # kept for the queued runs, which continue when the app is started again
+            print ("Session folder kept for the run queue:", tempfile.tempdir)
+        else:
+            shutil.rmtree(tempfile.tempdir)
 
         if hasattr(self, 'progress_window'):
             self.progress_window.setValue(100)
@@ -0,0 +1,131 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Helpers of the coarse-to-fine DVC pipeline.
+
+In the coarse stage, the DVC code runs on binned volumes with a sparse point cloud
+and a large search range. The displacements found in the coarse stage give the
+rigid body offset of each region of the full resolution point cloud, so the fine
+stage can run with a much smaller search range.
+'''
+
+import numpy as np
+
+from idvc.dvc_engine import partition_point_cloud, nearest_point, raw_dtype
+
+def binned_dims(dims, factor):
+    '''Returns the dimensions of a volume binned by factor, the remainder is cropped'''
+    return [int(d) // factor for d in dims]
+
+def bin_raw_volume(filename, binned_filename, dims, vol_bit_depth, vol_hdr_lngth=0, vol_endian="little",
+                   factor=2):
+    '''Bins a raw volume by averaging blocks of factor**3 voxels.
+
+    The volume is read factor slices at a time, so the memory needed is a small fraction of the volume.
+
+    Parameters
+    ----------
+    filename : str
+        the raw volume, x is the fastest varying axis.
+    binned_filename : str
+        the binned volume, written little endian with no header and the same bit depth.
+    dims : list of int
+        dimensions of the volume, x, y, z.
+    vol_bit_depth : int
+        8 or 16.
+    vol_hdr_lngth : int, default 0
+        length of the header of the volume, in bytes.
+    vol_endian : str, default "little"
+        byte ordering of the volume, "big" or "little".
+    factor : int, default 2
+        binning factor.
+
+    Returns
+    -------
+    list of int, the dimensions of the binned volume.
+    '''
+    dtype = raw_dtype(vol_bit_depth, vol_endian)
+    nx, ny, nz = [int(d) for d in dims]
+    bx, by, bz = binned_dims(dims, factor)
+    volume = np.memmap(filename, dtype=dtype, mode='r', offset=int(vol_hdr_lngth), shape=(nz, ny, nx))
+    out_dtype = dtype.newbyteorder('<')
+    with open(binned_filename, "wb") as binned:
+        for k in range(bz):
+            slab = np.asarray(volume[k * factor:(k + 1) * factor, :by * factor, :bx * factor], dtype=np.float32)
+            block = slab.reshape(factor, by, factor, bx, factor).mean(axis=(0, 2, 4))
+            binned.write(np.rint(block).astype(out_dtype).tobytes())
+    del volume
+    return [bx, by, bz]
+
+def to_coarse_coordinates(coordinates, factor):
+    '''Converts full resolution voxel coordinates to the coordinates of the binned volume'''
+    return (np.asarray(coordinates, dtype=float) - (factor - 1) / 2.) / factor
+
+def to_fine_coordinates(coordinates, factor):
+    '''Converts coordinates of the binned volume to full resolution voxel coordinates'''
+    return np.asarray(coordinates, dtype=float) * factor + (factor - 1) / 2.
+
+def sparse_point_cloud(points, num_points):
+    '''Returns a sparse point cloud evenly covering the extent of a point cloud.
+
+    The cloud is partitioned in num_points spatially coherent parts and the point
+    nearest to the centroid of each part is picked.'''
+    parts = partition_point_cloud(points, num_points)
+    picked = []
+    for indices in parts:
+        part = points[indices]
+        picked.append(indices[nearest_point(part, part[:, 1:4].mean(axis=0))])
+    return points[np.sort(np.asarray(picked, dtype=int))]
+
+def read_displacements(disp_filename):
+    '''Reads the positions and displacements of the points which converged from a .disp file.
+
+    Returns
+    -------
+    tuple of numpy.ndarray, positions and displacements (u, v, w) of the points with status 0.
+    '''
+    with open(disp_filename) as f:
+        header = f.readline().split()
+    data = np.loadtxt(disp_filename, skiprows=1, ndmin=2)
+    if data.size == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3))
+    columns = {name: i for i, name in enumerate(header)}
+    valid = data[:, columns['status']] == 0
+    positions = data[valid][:, [columns['x'], columns['y'], columns['z']]]
+    displacements = data[valid][:, [columns['u'], columns['v'], columns['w']]]
+    return positions, displacements
+
+def region_translation(region_points, positions, displacements, default, neighbours=5):
+    '''Returns the rigid body offset of a region of a point cloud from a displacement field.
+
+    The offset is the median of the displacements of the neighbours points of the field
+    nearest to the centroid of the region.
+
+    Parameters
+    ----------
+    region_points : numpy.ndarray
+        coordinates x, y, z of the points in the region.
+    positions : numpy.ndarray
+        coordinates of the points of the displacement field.
+    displacements : numpy.ndarray
+        displacements at positions.
+    default : list of float
+        offset returned if the field is empty.
+    neighbours : int, default 5
+        number of points of the field used.
+    '''
+    if len(positions) == 0:
+        return [float(value) for value in default]
+    centroid = np.asarray(region_points, dtype=float).mean(axis=0)
+    distance = np.sum((positions - centroid) ** 2, axis=1)
+    nearest = np.argsort(distance, kind='stable')[:neighbours]
+    return [float(value) for value in np.median(displacements[nearest], axis=0)]
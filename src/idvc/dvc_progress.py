@@ -0,0 +1,290 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Progress telemetry of the dvc processes.
+
+The output of the dvc executable is turned into ProgressEvent objects by a
+ProgressTracker, which also estimates the throughput and the time to completion
+of all the runs. The metrics of each run are logged by a RunMetricsLog in a json
+lines file in the run folder, so that the throughput of different runs and
+machines can be compared.
+'''
+
+import os
+import json
+import time
+import threading
+
+# name of the metrics file written in the folder of each run
+METRICS_FILENAME = "dvc_metrics.jsonl"
+
+def parse_progress_line(line):
+    '''Returns the number of points processed from a line of output of the dvc
+    executable, e.g. "100/2000", or None if the line does not report progress.'''
+    try:
+        return int(line.split('/')[0])
+    except ValueError:
+        return None
+
+
+class ProgressEvent(object):
+    '''An event in the output of a dvc process.
+
+    Parameters
+    ----------
+    kind : str
+        one of ProgressEvent.POINTS, ProgressEvent.INPUT_ERROR or ProgressEvent.OUTPUT.
+    run : DVCRun
+        the run which printed the line.
+    line : str
+        the line printed by the dvc executable.
+    points_done : int
+        number of points processed by all the runs.
+    points_per_second : float
+        smoothed throughput of all the runs, None until it can be estimated.
+    eta : float
+        estimated time to completion in seconds, None until it can be estimated.
+    '''
+    POINTS = 'points'
+    INPUT_ERROR = 'input_error'
+    OUTPUT = 'output'
+
+    def __init__(self, kind, run, line, points_done=0, points_per_second=None, eta=None):
+        self.kind = kind
+        self.run = run
+        self.line = line
+        self.points_done = points_done
+        self.points_per_second = points_per_second
+        self.eta = eta
+
+    def __repr__(self):
+        return "ProgressEvent({}, {}, points_done={}, points_per_second={}, eta={})".format(
+            self.kind, self.line.strip(), self.points_done, self.points_per_second, self.eta)
+
+
+class ProgressTracker(object):
+    '''Tracks the points processed by a set of runs and estimates the time to completion.
+
+    The throughput is measured over intervals of at least `sample_interval` seconds
+    and smoothed with an exponentially weighted moving average, so that the estimate
+    follows changes of throughput, e.g. when runs with larger subvolumes start,
+    without jumping at every line of output.
+
+    Parameters
+    ----------
+    total_points : int
+        number of points processed by all the runs.
+    alpha : float, default 0.3
+        weight of the latest throughput measurement in the moving average.
+    sample_interval : float, default 0.5
+        minimum time between two throughput measurements, in seconds.
+    '''
+    def __init__(self, total_points, alpha=0.3, sample_interval=0.5):
+        self.total_points = total_points
+        self.alpha = alpha
+        self.sample_interval = sample_interval
+        self.clock = time.time
+        self.start_time = self.clock()
+        self.points = {}
+        self.finished_points = 0
+        self.points_per_second = None
+        self._last_sample = (self.start_time, 0)
+
+    @property
+    def points_done(self):
+        return self.finished_points + sum(self.points.values())
+
+    def start(self, run):
+        self.points[run] = 0
+
+    def finish(self, run, succeeded):
+        '''Counts the points of a finished run as processed if it succeeded.'''
+        done = self.points.pop(run, 0)
+        self.finished_points += run.num_points if succeeded else done
+
+    def update(self, run, line):
+        '''Returns the ProgressEvent for a line of output of run.'''
+        if line.startswith("Input Error"):
+            return ProgressEvent(ProgressEvent.INPUT_ERROR, run, line, self.points_done,
+                                 self.points_per_second, self.eta())
+        num_processed_points = parse_progress_line(line)
+        if num_processed_points is None:
+            return ProgressEvent(ProgressEvent.OUTPUT, run, line, self.points_done,
+                                 self.points_per_second, self.eta())
+        self.points[run] = num_processed_points
+        self._sample()
+        return ProgressEvent(ProgressEvent.POINTS, run, line, self.points_done,
+                             self.points_per_second, self.eta())
+
+    def _sample(self):
+        now = self.clock()
+        last_time, last_points = self._last_sample
+        if now - last_time < self.sample_interval:
+            return
+        points_done = self.points_done
+        rate = (points_done - last_points) / (now - last_time)
+        if self.points_per_second is None:
+            self.points_per_second = rate
+        else:
+            self.points_per_second = self.alpha * rate + (1 - self.alpha) * self.points_per_second
+        self._last_sample = (now, points_done)
+
+    def percentage(self):
+        if self.total_points == 0:
+            return 0
+        return min(int(self.points_done / self.total_points * 100), 100)
+
+    def eta(self):
+        '''Estimated time to completion in seconds, or None if it cannot be estimated yet.'''
+        points_done = self.points_done
+        remaining = max(self.total_points - points_done, 0)
+        if self.points_per_second:
+            return remaining / self.points_per_second
+        if points_done > 0:
+            # linear extrapolation until the throughput is measured
+            elapsed = self.clock() - self.start_time
+            return elapsed * remaining / points_done
+        return None
+
+
+class RunMetricsLog(object):
+    '''Writes the metrics of a run to a json lines file.
+
+    A record is written when the run starts, at most every `interval` seconds while
+    it progresses and when it finishes. Each record has the keys "event", "time"
+    (unix time) and "elapsed" (seconds since the start of the run).
+
+    Parameters
+    ----------
+    filename : str
+        the json lines file, it is overwritten.
+    run : DVCRun
+        the run to log.
+    interval : float, default 1
+        minimum time between two progress records, in seconds.
+    '''
+    def __init__(self, filename, run, interval=1.):
+        self.filename = filename
+        self.run = run
+        self.interval = interval
+        self.clock = time.time
+        self.start_time = self.clock()
+        self._last_record = 0
+        self._file = open(filename, "w")
+        self.write("start", config=run.config_filename, num_points=run.num_points)
+
+    def write(self, event, **kwargs):
+        if self._file is None:
+            return
+        now = self.clock()
+        record = {"event": event, "time": now, "elapsed": now - self.start_time}
+        record.update(kwargs)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def progress(self, points_done):
+        now = self.clock()
+        if now - self._last_record < self.interval:
+            return
+        self._last_record = now
+        elapsed = now - self.start_time
+        self.write("progress", points=points_done,
+                   points_per_second=points_done / elapsed if elapsed > 0 else None)
+
+    def finish(self, succeeded, exit_code=None, points_done=None):
+        elapsed = self.clock() - self.start_time
+        if points_done is None:
+            points_done = self.run.num_points if succeeded else 0
+        self.write("finished", succeeded=succeeded, exit_code=exit_code, wall_time=elapsed,
+                   points=points_done, points_per_second=points_done / elapsed if elapsed > 0 else None)
+        self._file.close()
+        self._file = None
+
+
+class Throttle(object):
+    '''Limits the rate of an action, e.g. updating a progress window.
+
+    Parameters
+    ----------
+    interval : float
+        minimum time between two actions, in seconds.
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = None
+
+    def ready(self, force=False):
+        '''Returns True if the action can be performed now, and records it.'''
+        now = time.time()
+        if force or self._last is None or now - self._last >= self.interval:
+            self._last = now
+            return True
+        return False
+
+
+def read_metrics(run_folder):
+    '''Returns the records of the metrics files of the runs in run_folder, keyed by file name.'''
+    metrics = {}
+    for dirpath, dirnames, filenames in os.walk(run_folder):
+        if METRICS_FILENAME in filenames:
+            filename = os.path.join(dirpath, METRICS_FILENAME)
+            with open(filename) as f:
+                metrics[filename] = [json.loads(line) for line in f if line.strip()]
+    return metrics
+
+class SharedProgress(object):
+    '''Progress of several tasks run at the same time, e.g. the loading of the reference and
+    correlate volumes, reported as their mean through a single callback.
+
+    Each task reports its progress, from 0 to 100, through the callback returned by task().
+    The callbacks can be called from any thread.
+
+    Parameters
+    ----------
+    progress_callback : object
+        its emit method is called with the overall progress, when it changes.
+    num_tasks : int
+        the number of tasks.
+    start_progress, end_progress : int, default 0 and 100
+        the overall progress when no task has started and when all have finished.
+    '''
+    def __init__(self, progress_callback, num_tasks, start_progress=0, end_progress=100):
+        self.progress_callback = progress_callback
+        self.values = [0.] * num_tasks
+        self.start_progress = start_progress
+        self.end_progress = end_progress
+        self.last = None
+        self.lock = threading.Lock()
+
+    def update(self, index, value):
+        '''Sets the progress of a task, from 0 to 100'''
+        with self.lock:
+            self.values[index] = min(max(float(value), 0.), 100.)
+            mean = sum(self.values) / len(self.values)
+            value = int(self.start_progress + (self.end_progress - self.start_progress) * mean / 100)
+            if value == self.last:
+                return
+            self.last = value
+            self.progress_callback.emit(value)
+
+    def task(self, index):
+        '''Returns the progress callback of a task, an object with an emit method'''
+        return _TaskProgress(self, index)
+
+
+class _TaskProgress(object):
+    def __init__(self, shared, index):
+        self.shared = shared
+        self.index = index
+
+    def emit(self, value):
+        self.shared.update(self.index, value)
@@ -0,0 +1,169 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Persistent queue of DVC runs executed in the background.
+
+The jobs are stored in a JSON file, rewritten atomically at every change, so the
+queue survives a restart of the app. A job that was running when the app exited is
+queued again and resumed, running only the configurations without complete results.
+'''
+
+import os
+import json
+import time
+import uuid
+import threading
+
+QUEUE_FILENAME = "run_queue.json"
+
+
+class RunQueue(object):
+    '''Queue of run configurations, persisted in a JSON file.
+
+    Each job is a dictionary with the keys: id, name, run_config, session_folder,
+    hdf5_dataset_path, status, resume, added, started, ended and exit_code.
+
+    Parameters
+    ----------
+    filename : str
+        the JSON file the queue is stored in, created when the first job is added.
+    '''
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)['jobs']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def _save(self, jobs):
+        tmp_filename = "{}.tmp{}".format(self.filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump({'jobs': jobs}, f, indent=1)
+        os.replace(tmp_filename, self.filename)
+
+    def jobs(self):
+        '''Returns the list of the jobs, in the order they were added'''
+        with self.lock:
+            return self._load()
+
+    def add(self, run_config, session_folder, name=None, hdf5_dataset_path=None, resume=False):
+        '''Appends a job to the queue and returns it.
+
+        Parameters
+        ----------
+        run_config : str
+            the _run_config.json file of the run.
+        session_folder : str
+            the folder the paths in the run config are relative to.
+        name : str, optional
+            the name of the run, by default the name of the folder of the run config.
+        hdf5_dataset_path : str, optional
+            path of the dataset in HDF5/NeXus image files.
+        resume : bool, default False
+            only run the configurations without complete results in the run folder.
+        '''
+        job = {'id': uuid.uuid4().hex[:12],
+               'name': name if name is not None else os.path.basename(os.path.dirname(run_config)),
+               'run_config': os.path.abspath(run_config),
+               'session_folder': os.path.abspath(session_folder),
+               'hdf5_dataset_path': hdf5_dataset_path,
+               'status': self.QUEUED, 'resume': resume,
+               'added': time.time(), 'started': None, 'ended': None, 'exit_code': None}
+        with self.lock:
+            jobs = self._load()
+            jobs.append(job)
+            self._save(jobs)
+        return job
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            jobs = self._load()
+            for job in jobs:
+                if job['id'] == job_id:
+                    job.update(fields)
+                    self._save(jobs)
+                    return job
+        return None
+
+    def next_job(self):
+        '''Marks the first queued job as running and returns it, or None if no job is queued'''
+        with self.lock:
+            jobs = self._load()
+            for job in jobs:
+                if job['status'] == self.QUEUED:
+                    job['status'] = self.RUNNING
+                    job['started'] = time.time()
+                    self._save(jobs)
+                    return job
+        return None
+
+    def job_finished(self, job_id, exit_code):
+        '''Records the exit code of the job, 130 means it was cancelled'''
+        if exit_code == 0:
+            status = self.FINISHED
+        elif exit_code == 130:
+            status = self.CANCELLED
+        else:
+            status = self.FAILED
+        return self._update(job_id, status=status, exit_code=exit_code, ended=time.time())
+
+    def requeue(self, job_id):
+        '''Queues a job again, resuming it'''
+        return self._update(job_id, status=self.QUEUED, resume=True, exit_code=None, ended=None)
+
+    def recover(self):
+        '''Queues again the jobs left running when the app exited, returns their number.
+
+        Must be called before the queue is executed, e.g. when the app starts.'''
+        with self.lock:
+            jobs = self._load()
+            interrupted = [job for job in jobs if job['status'] == self.RUNNING]
+            for job in interrupted:
+                job['status'] = self.QUEUED
+                job['resume'] = True
+            if interrupted:
+                self._save(jobs)
+        return len(interrupted)
+
+    def remove(self, job_id):
+        '''Removes a job which is not running, returns True if it was removed'''
+        with self.lock:
+            jobs = self._load()
+            kept = [job for job in jobs if job['id'] != job_id or job['status'] == self.RUNNING]
+            if len(kept) == len(jobs):
+                return False
+            self._save(kept)
+        return True
+
+    def clear_ended(self):
+        '''Removes the jobs which finished, failed or were cancelled'''
+        with self.lock:
+            jobs = self._load()
+            self._save([job for job in jobs if job['status'] in [self.QUEUED, self.RUNNING]])
+
+    def pending(self):
+        '''Returns the jobs which are queued or running'''
+        return [job for job in self.jobs() if job['status'] in [self.QUEUED, self.RUNNING]]
+
+    def pending_sessions(self):
+        '''Returns the set of the session folders of the jobs which are queued or running'''
+        return {job['session_folder'] for job in self.pending()}
@@ -14,140 +14,73 @@
 #   Author: Edoardo Pasca (UKRI-STFC)
 
 import os
-import numpy as np
+import sys
+import signal
 from PySide2 import QtCore
-from datetime import datetime
 from PySide2.QtWidgets import QMessageBox
-import json
 import time
-import shutil
-import platform
-from .io import save_tiff_stack_as_raw, save_nxs_as_raw
-
-class PrintCallback(object):
-    '''Class to handle the emit call when no callback is provided'''
-    def emit(self, *args, **kwargs):
-        print (args, kwargs)
-
-count = 0
-runs_completed = 0
-
-blank_config = '''###############################################################################
-#																	
-#
-#		example dvc process control file		
-#
-#
-###############################################################################
-
-# all lines beginning with a # character are ignored
-# some parameters are conditionally required, depending on the setting of other parameters
-# for example, if subvol_thresh is off, the threshold description parameters are not required
-
-### file names
-
-reference_filename	{reference_filename}		### reference tomography image volume
-correlate_filename	{correlate_filename}		### correlation tomography image volume
-
-point_cloud_filename	{point_cloud_filename}	### file of search point locations
-output_filename		{output_filename}		### base name for output files
-
-### description of the image data files, all must be the same size and structure
-
-vol_bit_depth		{vol_bit_depth}			### 8 or 16
-vol_hdr_lngth		{vol_hdr_lngth}		### fixed-length header size, may be zero
-vol_wide		{vol_wide}			### width in pixels of each slice
-vol_high		{vol_high}			### height in pixels of each slice
-vol_tall		{vol_tall}			### number of slices in the stack
-vol_endian		{vol_endian}        ### big or little endian byte ordering
-
-### parameters defining the subvolumes that will be created at each search point
-
-subvol_geom		{subvol_geom}			### cube, sphere
-subvol_size		{subvol_size}			### side length or diameter, in voxels
-subvol_npts		{subvol_npts}			### number of points to distribute within the subvol
-
-subvol_thresh		{subvol_thresh}			### on or off, evaluate subvolumes based on threshold
-gray_thresh_min		{gray_thresh_min}			### lower limit of a gray threshold range if subvol_thresh is on
-gray_thresh_max		{gray_thresh_max}			### upper limit of a gray threshold range if subvol_thresh is on
-min_vol_fract		{min_vol_fract}			### only search if subvol fraction is greater than
-
-### required parameters defining the basic the search process
-
-disp_max		{disp_max}			### in voxels, used for range checking and global search limits
-num_srch_dof		{num_srch_dof}			### 3, 6, or 12
-obj_function		{obj_function}			### sad, ssd, zssd, nssd, znssd 
-interp_type		{interp_type}		### trilinear, tricubic
-
-### optional parameters tuning and refining the search process
-
-rigid_trans		{rigid_trans}		### rigid body offset of target volume, in voxels
-basin_radius		{basin_radius}			### coarse-search resolution, in voxels, 0.0 = none
-subvol_aspect		{subvol_aspect}		### subvolume aspect ratio
-num_points_to_process   {num_points_to_process}  ### Number of points in the point cloud to process
-starting_point  {starting_point}    ### x,y,z location of starting point for DVC analysis
-'''
-
-def update_progress(main_window, process, total_points, required_runs, run_succeeded, start_time, num_points_to_process):
-    # print("Required runs", required_runs)
+from functools import partial
+from .dvc_engine import PrintCallback, DVCEngine, DVCScheduler
+from .dvc_progress import ProgressEvent, Throttle
+from .dvc_autotune import Autotuner, autotune_settings_key
+from eqt.threading import Worker
+
+def update_progress(runner, process, force=False):
+    '''Reads the output of one of the running dvc processes and updates the
+    progress window with the progress aggregated over all the running processes.
+
+    All the available lines are parsed, the window is updated at most every
+    `runner.throttle.interval` seconds with the latest event, unless force is True
+    or the run is complete, so that the last event is always shown.'''
+    main_window = runner.main_window
+    run = runner.running[process]
+    event = None
     while(process.canReadLine()):
-        #print("READ")
         string = process.readLine()  
         line = str(string, "utf-8")
         
-        global count
-        count+=1
-        #print("{:.0f} \n".format(count/(total_points+3*required_runs)*100))
-        if hasattr(main_window, 'progress_window'):
-            #print(count/(total_points+3*required_runs)*100)
-            # main_window.progress_window.setValue(count/(total_points+3*required_runs)*100)
+        event = runner.scheduler.update(run, line)
 
-            try:
-                # try to infer the number of points processed from the output of the dvc executable
-                num_processed_points = int(string.split('/')[0])
-                etcs = 0
-                prog = 0
-                if num_processed_points > 0:
-                    prog = int(num_processed_points/num_points_to_process*100)-1
-                    etcs = ((time.time()-start_time) * num_points_to_process / num_processed_points) - (time.time()-start_time)
-                try:
-                    etc = time.strftime("%H:%M:%S s", time.gmtime(etcs))
-                except:
-                    etc = 'Error estimating time to completion'
-
-                ETC_line = "\nEstimated time to completion of this step {} ".format(etc)
-            except ValueError:
-                num_processed_points = 0
-                prog = 0
-                ETC_line = ''
-                
-            main_window.progress_window.setValue(prog)
-            label_text = main_window.progress_window.labelText().split("\n")[0]
-            main_window.progress_window.setLabelText(
-                    "{}\n{}{}".format(label_text, line, ETC_line))
-                
-        if line[:11] == "Input Error":
-            run_succeeded = False
+        if event.kind == ProgressEvent.INPUT_ERROR:
+            runner.run_succeeded = False
             if hasattr(main_window, 'progress_window'):
                 main_window.progress_window.setValue(100)
             if hasattr(main_window, 'alert'):
                 main_window.alert.close() #finish fn triggers before update_progress so has already made an alert saying it succeeded
+            runner.pending_event = None
             displayFileErrorDialog(main_window, line, "Error")
             process.kill()
             return
-    #sys.stdout.flush()
-
-def create_progress_window(main_window, title, text, max = 100, cancel = None):
-        main_window.progress_window = QProgressDialog(text, "Cancel", 0,max, main_window, QtCore.Qt.Window) 
-        main_window.progress_window.setWindowTitle(title)
-        main_window.progress_window.setWindowModality(QtCore.Qt.ApplicationModal) #This means the other windows can't be used while this is open
-        main_window.progress_window.setMinimumDuration(0.1)
-        main_window.progress_window.setWindowFlag(QtCore.Qt.WindowCloseButtonHint, False)
-        main_window.progress_window.setWindowFlag(QtCore.Qt.WindowMaximizeButtonHint, False)
-        if cancel is None:
-            main_window.progress_window.setCancelButton(None)
-        else:
-            main_window.progress_window.canceled.connect(cancel)
+
+    if event is None:
+        # e.g. the last event of a finished process, which the throttle dropped
+        event = runner.pending_event if force else None
+    if event is None or not hasattr(main_window, 'progress_window'):
+        return
+    force = force or runner.scheduler.tracker.percentage() >= 100
+    if runner.throttle.ready(force=force):
+        show_progress(runner, event)
+        runner.pending_event = None
+    else:
+        runner.pending_event = event
+
+def show_progress(runner, event):
+    '''Shows a ProgressEvent in the progress window'''
+    main_window = runner.main_window
+    prog = runner.scheduler.tracker.percentage()
+    ETC_line = ''
+    if event.eta is not None:
+        try:
+            etc = time.strftime("%H:%M:%S s", time.gmtime(event.eta))
+        except:
+            etc = 'Error estimating time to completion'
+        ETC_line = "\nEstimated time to completion {} ".format(etc)
+    if event.points_per_second is not None:
+        ETC_line += "\n{:.1f} points/s".format(event.points_per_second)
+
+    main_window.progress_window.setValue(max(prog - 1, 0))
+    main_window.progress_window.setLabelText(
+            "{}\n{}{}".format(runner.progress_label(), event.line, ETC_line))
 
 def displayFileErrorDialog(main_window, message, title):
     msg = QMessageBox(main_window)
@@ -157,385 +90,372 @@ def displayFileErrorDialog(main_window, message, title):
     #msg.setDetailedText(main_window.e.ErrorMessage())
     msg.exec_()
 
-def cancel_run(main_window, process, run_succeeded):
-    
-    if not run_succeeded:
-        # print ("run cancelled?")
-        process.kill()
-        main_window.alert = QMessageBox(QMessageBox.NoIcon,"Cancelled","The run was cancelled.", QMessageBox.Ok)  
-        main_window.alert.show()
-        run_succeeded = False
-    # else:
-    #     print ("all OK, all processes ended")
-
-
-def finished_run(main_window, exitCode, exitStatus, process = None, required_runs = 1, run_succeeded = False, finish_fn = None):
-    global runs_completed
-    runs_completed+=1
-    # print ("DVC command ended.", exitCode, exitStatus)
-    # print("Completed, ", runs_completed)
-
-    if run_succeeded:
-        if runs_completed == required_runs:
-            if hasattr(main_window, 'progress_window'):
-                main_window.progress_window.close()
-            main_window.alert = QMessageBox(QMessageBox.NoIcon,"Success","The DVC code ran successfully.", QMessageBox.Ok) 
-            main_window.alert.show()
-            if finish_fn is not None:
-                finish_fn()
-            runs_completed = 0
-            global count
-            count = 0
-    #print ("DVC command ended.", exitCode, exitStatus)
-    
-
-    # if( runs_completed >=  required_runs): #and  cancelled == False):
-    #     runs_completed = 0
-    # print("did")
-
 class DVC_runner(object):
-    def __init__(self, main_window, input_file, finish_fn, run_succeeded, session_folder):
-        # print("The session folder is", session_folder)
+    '''Runs the configurations of a DVCEngine with QProcess, showing the progress in the main window.
+
+    Parameters
+    ----------
+    main_window : MainWindow
+        the main window of the app.
+    input_file : str
+        the run config json file, created in dvc_interface create_run_config.
+    finish_fn : callable
+        called when all the runs have succeeded.
+    run_succeeded : bool
+        initial value of the success flag.
+    session_folder : str
+        the session folder, paths in the run config are relative to it.
+    resume : bool, default False
+        only run the configurations without complete results in the run folder.
+    '''
+    def __init__(self, main_window, input_file, finish_fn, run_succeeded, session_folder, resume=False):
         self.main_window = main_window
         self.input_file = input_file
         self.finish_fn = finish_fn
         self.run_succeeded = run_succeeded
         self.session_folder = session_folder
+        self.engine = DVCEngine(input_file, session_folder,
+                                getattr(main_window, 'hdf5_dataset_path', None), resume)
 
     def set_up(self, *args, **kwargs):
-        '''This function sets up the DVC run, creating the run configurations and setting up the run folders.
-        
+        '''Sets up the run folders and configurations, see DVCEngine.set_up.
+
         Parameters:
         -----------
         *args: not used
         **kwargs: 
             message_callback: callback function for messages
             progress_callback: callback function for progress updates
-
-        Returns:
-        --------
-        None
-
-        This function reads a json file containing the run configuration and creates the run configurations.
-        The json file contains the following:
-        - subvolume_points: list of number of points to process at each subvolume
-        - subvolume_sizes: list of subvolume sizes, if not an integer multiple runs will be created
-        - points: number of points to process in the point cloud
-        - roi_files: list of point cloud files
-        - reference_file: reference image volume
-        - correlate_file: correlation image volume
-        - vol_bit_depth: bit depth of the image volumes. If loading an image not of type int8 or int16, the image will be converted to uint16.
-        - vol_hdr_lngth: header length of the image volumes
-        - dims: dimensions of the image volumes
-        - subvol_geom: geometry of the subvolume, either cube or sphere
-        - subvol_npts: number of points in the subvolume, not used
-        - disp_max: maximum displacement in voxels
-        - dof: number of parameters in the optimisation, 3,6, or 12
-        - obj: objective function, either sad, ssd, zssd, nssd, or znssd
-        - interp_type: interpolation type, either trilinear or tricubic
-        - run_folder: folder to save the run results and configurations
-        - rigid_trans: rigid translation between the reference and correlation volumes
-        - point0_world_coordinate: world coordinates of the starting point for the DVC analysis
         '''
-        self.processes = []
-        self.process_num = 0
-        message_callback = kwargs.get('message_callback', PrintCallback())
-        progress_callback = kwargs.get('progress_callback', PrintCallback())  
-        
-        # created in dvc_interface create_run_config
-        with open(self.input_file) as tmp:
-            config = json.load(tmp)
-
-        subvolume_points = config['subvolume_points'] 
-        subvolume_sizes = config['subvolume_sizes']
-        points = int(config['points'])
-        num_points_to_process = points
-
-        roi_files = config['roi_files']
-        reference_file = config['reference_file']
-        correlate_file = config['correlate_file']
-        
-        progress_callback.emit(10)
-        # Convert to raw if files are a list of tiffs
-        if isinstance(reference_file, (list, tuple)):
-            base = os.path.abspath(self.session_folder)
-            results_folder = os.path.dirname(os.path.join(base, config['run_folder']))
-            raw_reference_file_fname = os.path.join(results_folder, 'reference.raw')
-            if not os.path.exists(raw_reference_file_fname):
-                message_callback.emit("Converting reference file to raw format")
-                save_tiff_stack_as_raw(reference_file, raw_reference_file_fname, progress_callback, 10, 50)
-            reference_file = raw_reference_file_fname
-        elif reference_file.endswith(('.nxs', '.h5', '.hdf5')):
-            base = os.path.abspath(self.session_folder)
-            results_folder = os.path.dirname(os.path.join(base, config['run_folder']))
-            raw_reference_file_fname = os.path.join(results_folder, 'reference.raw')
-            if not os.path.exists(raw_reference_file_fname):
-                message_callback.emit("Converting reference file to raw format")
-                save_nxs_as_raw(reference_file, self.main_window.hdf5_dataset_path, raw_reference_file_fname)
-            reference_file = raw_reference_file_fname
-        progress_callback.emit(50)
-
-        if isinstance(correlate_file, (list, tuple)):
-            base = os.path.abspath(self.session_folder)
-            results_folder = os.path.dirname(os.path.join(base, config['run_folder']))
-            raw_correlate_file_fname = os.path.join(results_folder, 'correlate.raw')
-            if not os.path.exists(raw_correlate_file_fname):
-                message_callback.emit("Converting correlate file to raw format")
-                save_tiff_stack_as_raw(correlate_file, raw_correlate_file_fname, progress_callback, 50, 90)
-            correlate_file = raw_correlate_file_fname
-
-        elif correlate_file.endswith(('.nxs', '.h5', '.hdf5')):
-            base = os.path.abspath(self.session_folder)
-            results_folder = os.path.dirname(os.path.join(base, config['run_folder']))
-            raw_correlate_file_fname = os.path.join(results_folder, 'correlate.raw')
-            if not os.path.exists(raw_correlate_file_fname):
-                message_callback.emit("Converting correlate file to raw format")
-                save_nxs_as_raw(correlate_file, self.main_window.hdf5_dataset_path, raw_correlate_file_fname)
-            correlate_file = raw_correlate_file_fname
-
-        progress_callback.emit(90)
-
-        message_callback.emit("Creating run configurations")
-        vol_bit_depth = int(config['vol_bit_depth'])
-        if vol_bit_depth not in [8, 16]:
-            # the data will be converted to 16 bit by save_tiff_stack_as_raw
-            # it won't work with other formats
-            vol_bit_depth = 16
-        vol_hdr_lngth = int(config['vol_hdr_lngth'])
-
-        if 'vol_endian' in config:
-            endian = config['vol_endian']
-        else:
-            endian = None
-
-        dims= config['dims'] #image dimensions
-
-        subvol_geom = config['subvol_geom']
-
-        subvol_npts = config['subvol_npts']
-
-        disp_max = int(config['disp_max'][0]) #TODO: need to change
-        dof = int(config['dof'])
-        obj = config['obj']
-        interp_type = config['interp_type']
-
-        rigid_trans = config['rigid_trans']
-        starting_point = config['point0_world_coordinate']
-
-        # Change directory into the folder where the run will be saved:
-        os.chdir(self.session_folder)
-        # this is the one directory we created where we will run the dvc command in
-        # we want to change this to create multiple directories first and then run through
-        # all the directory created https://github.com/TomographicImaging/iDVC/issues/37
-        # see also https://github.com/TomographicImaging/iDVC/pull/69
-        self.run_folder = config['run_folder']
-
-        #running the code:
-
-        # this should be renamed to num_optimisations
-        required_runs = len(subvolume_points)*len(subvolume_sizes)   
-
-        # check for the extension
-        if platform.system() in ['Linux', 'Darwin']:    
-            exe_file = 'dvc'
-        elif platform.system() == 'Windows':
-            exe_file = 'dvc.exe'
-        else:
-            raise ValueError('Not supported platform, ', platform.system())
-        
-        total_points = 0
-        for cloud in roi_files:
-            i=0
-            with open(cloud) as f:
-                for i, l in enumerate(f):
-                    pass
-            i+=1
-            if i < points:
-                total_points += i
-            else:
-                total_points += points
-
-        total_points = total_points * len(subvolume_points)
-
-        #print("Total points", total_points)
-
-        #process.readyRead.connect(lambda: update_progress(main_window, process, total_points, 
-        #    required_runs, run_succeeded))
-        
-
-        start_progress = 90
-        end_progress = 99
-        file_count = -1
-        # point0 = main_window.getPoint0WorldCoords()
-            
-        for roi_num, roi_file in enumerate(roi_files):
-            file_count +=1
-            subvolume_size = int(subvolume_sizes[file_count])
-            #print(roi_file)
-            distances = []
-
-            for subv_num, subvolume_point in enumerate(subvolume_points):
-                now = datetime.now()
-                # use a counter for both for loops
-                counter = subv_num + roi_num * len(subvolume_points)
-                
-                this_run_folder = os.path.join(self.run_folder, "dvc_result_{}".format(counter))
-                os.mkdir(this_run_folder)
-                output_filename = os.path.join(this_run_folder, "dvc_result_{}".format(counter))
-                config_filename = os.path.join(this_run_folder,"dvc_config.txt")
-                
-                grid_roi_fname = os.path.join(this_run_folder, "grid_input.roi")
-                # copies the pointcloud file as a whole in the run directory
-                try:
-                    shutil.copyfile(roi_file, grid_roi_fname)
-                except Exception as err:
-                    # this is not really a nice way to open an error message!
-                    self.main_window.displayFileErrorDialog(message=str(err), title="Error creating config files")
-                    return
-                
-                
-                config =  blank_config.format(
-                    reference_filename=  reference_file, # reference tomography image volume
-                    correlate_filename=  correlate_file, # correlation tomography image volume
-                    point_cloud_filename = grid_roi_fname,
-                    output_filename= output_filename,
-                    vol_bit_depth=  vol_bit_depth, # get from ref, 8 or 16
-                    vol_hdr_lngth=vol_hdr_lngth,# get from ref, fixed-length header size, may be zero
-                    vol_wide= dims[0], # number of x slices
-                    vol_high= dims[1], # number of y slices
-                    vol_tall= dims[2], #number of z slices
-                    vol_endian = endian,
-                    subvol_geom=  subvol_geom,
-                    subvol_size=  subvolume_size, 
-                    subvol_npts= subvolume_point,
-                    subvol_thresh='off',
-                    gray_thresh_min='27',
-                    gray_thresh_max='127',
-                    min_vol_fract='0.2',
-                    disp_max=  disp_max, #38 for test image
-                    num_srch_dof=  dof, #6 for test image
-                    obj_function=  obj, 
-                    interp_type=  interp_type, #tricubic for test image
-                    rigid_trans= rigid_trans, #translation between ref and cor - determined from image registration
-                    basin_radius='0.0',
-                    subvol_aspect='1.0 1.0 1.0',# image spacing
-                    num_points_to_process=num_points_to_process, 
-                    starting_point='{} {} {}'.format(*starting_point)) 
-                time.sleep(1)
-                with open(config_filename,"w") as config_file:
-                    config_file.write(config)
-            
-                #if run_count == len( subvolume_points):
-                # process.start( exe_file , [ param_file ] )          
-                cancelled=False
-
-                # TODO: 
-                # ideally we should start a new process from the main thread once the previous
-                # has finished
-                # wait for process to finish before doing next run
-                
-                # process.waitForFinished(msecs=2147483647)
-                self.processes.append( 
-                    (exe_file, [ config_filename ], required_runs, total_points, num_points_to_process)
-                )
-                progress_callback.emit(int(start_progress + (end_progress - start_progress) * (subv_num / len(roi_files))))
-            progress_callback.emit(100)
+        self.engine.set_up(kwargs.get('message_callback', PrintCallback()),
+                           kwargs.get('progress_callback', PrintCallback()))
         
     def run_dvc(self, **kwargs):
+        '''Runs the configurations set up by the engine.
+
+        Up to `dvc_processes` (from the settings) configurations are run at the same time,
+        the `omp_threads` in the settings are split between the running processes.
+        If `dvc_autotune` is set in the settings, the layout of processes and threads measured
+        by the autotuner for this machine and volume size is used instead, running the
+        autotuner first if there is no such layout yet.
+        Whenever a process finishes, the next configuration is started.'''
         main_window = self.main_window
-        input_file = self.input_file
-        finish_fn = self.finish_fn
-        run_succeeded = self.run_succeeded
-        
-        process = QtCore.QProcess()
-        
-        env = QtCore.QProcessEnvironment.systemEnvironment()
+
         try:
-            nthreads = main_window.settings.value('omp_threads')
+            total_threads = int(main_window.settings.value('omp_threads'))
         except Exception as err:
-            nthreads = '4'
+            total_threads = 4
+            print (err)
+        try:
+            max_concurrent = int(main_window.settings.value('dvc_processes'))
+        except Exception as err:
+            max_concurrent = 1
             print (err)
-        env.insert("OMP_NUM_THREADS", nthreads)
-        process.setProcessEnvironment(env)
 
-        # print("Processes: ", self.processes)
-        # print("num: ", self.process_num)        
+        if main_window.settings.value('dvc_autotune') == "true" and len(self.engine.runs) > 0:
+            layout = main_window.settings.value(autotune_settings_key(self.engine.volume_key))
+            if layout is None:
+                self.autotune(total_threads)
+                return
+            processes, threads = [int(value) for value in str(layout).split(",")]
+            total_threads, max_concurrent = processes * threads, processes
+        self.start_runs(total_threads, max_concurrent)
+
+    def autotune(self, total_threads):
+        '''Measures the throughput of the first configuration with several layouts of processes and
+        threads in a Worker, then stores the best in the settings and starts the runs.'''
+        main_window = self.main_window
+        self.autotuner = Autotuner(self.engine.runs[0], total_threads)
+        main_window.create_progress_window("Autotuning", "Measuring the throughput of the DVC code", 100, None)
+        worker = Worker(self.autotuner.tune)
+        worker.signals.message.connect(main_window.updateProgressDialogMessage)
+        worker.signals.progress.connect(main_window.progress)
+        worker.signals.result.connect(partial(self.autotune_finished, total_threads))
+        main_window.threadpool.start(worker)
+
+    def autotune_finished(self, total_threads, best):
+        main_window = self.main_window
+        main_window.progress_window.close()
+        print ("Autotuner results (processes, threads, points/s):", self.autotuner.results)
+        if best is None:
+            # all the measurements failed, run with the threads from the settings
+            self.start_runs(total_threads, 1)
+            return
+        processes, threads, points_per_second = best
+        main_window.settings.setValue(autotune_settings_key(self.engine.volume_key),
+                                      "{},{}".format(processes, threads))
+        self.start_runs(processes * threads, processes)
 
-        # start time
-        start_time = time.time()
+    def start_runs(self, total_threads, max_concurrent):
+        '''Creates the scheduler and starts the first processes'''
+        main_window = self.main_window
+        # kept for the next stage of the run
+        self.total_threads, self.max_concurrent = total_threads, max_concurrent
+        self.scheduler = DVCScheduler(self.engine.runs, total_threads, max_concurrent,
+                                      on_run_finished=self.engine.cache_result)
+        # maps the running QProcess to its DVCRun
+        self.running = {}
+        # coalesce the updates of the progress window
+        self.throttle = Throttle(0.25)
+        # the latest event which the throttle did not show
+        self.pending_event = None
+
+        main_window.create_progress_window("Running", self.progress_label(), 100, self.onCancel)
+
+        while self.start_next_process():
+            pass
+        if len(self.running) == 0:
+            # nothing to run: the set up failed or, when resuming, all the results are complete
+            self.finish()
+
+    def progress_label(self):
+        return "Running DVC code {}/{} ({} running)".format(
+            min(self.scheduler.next_index, len(self.scheduler.runs)), len(self.scheduler.runs),
+            len(self.scheduler.running))
+
+    def start_next_process(self):
+        '''Starts a QProcess for the next configuration given by the scheduler.
+
+        Returns False if no configuration can be started.'''
+        run = self.scheduler.next_run()
+        if run is None:
+            return False
 
-        exe_file, param_file, required_runs,\
-            total_points, num_points_to_process = self.processes[self.process_num]
+        process = QtCore.QProcess()
+        env = QtCore.QProcessEnvironment.systemEnvironment()
+        for key, value in self.scheduler.environment(run).items():
+            env.insert(key, value)
+        process.setProcessEnvironment(env)
 
         process.setWorkingDirectory(os.getcwd())
-        # process.finished.connect(partial(finished_run, main_window, 
-        #             process = process, required_runs = required_runs, 
-        #             run_succeeded = run_succeeded, finish_fn = finish_fn))
-        process.finished.connect(self.finished_run)
+        process.finished.connect(partial(self.finished_run, process))
         process.started.connect(self.onStarted)
-        if self.process_num == 0:
-            main_window.create_progress_window("Running", 
-                "Running DVC code {}/{}".format(self.process_num +1, len(self.processes)), 100,
-                #lambda: cancel_run(main_window, process, run_succeeded)
-                lambda: self.onCancel(process)
-                )
-        else:
-            main_window.progress_window.setLabelText(
-                "Running DVC code {}/{}".format(self.process_num +1, len(self.processes))
-            )
-            main_window.progress_window.canceled.connect(lambda: self.onCancel(process))
-        process.readyRead.connect(
-            lambda: update_progress(main_window, process, total_points, required_runs,\
-                                    run_succeeded, start_time, num_points_to_process))
-        # process.finished.connect(self.run_dvc())
-        process.start(exe_file , param_file )
+        process.readyRead.connect(partial(update_progress, self, process))
+        self.running[process] = run
+        self.main_window.progress_window.setLabelText(self.progress_label())
+        process.start(run.exe_file, run.args)
+        return True
 
     def onStarted(self):
         pass
 
-    def onCancel(self, process):
+    def onCancel(self):
+        '''Kills all the running processes and prevents new ones to be started.'''
         main_window = self.main_window
-        run_succeeded = self.run_succeeded
-        state = process.state()
-        # print ("Process state", state)
-        if state in [2,1]:
-            # print ("Cancelling run")
-            process.kill()
+        self.scheduler.cancel()
+        killed = False
+        for process in self.running:
+            if process.state() in [QtCore.QProcess.Starting, QtCore.QProcess.Running]:
+                process.kill()
+                killed = True
+        if killed:
             main_window.alert = QMessageBox(QMessageBox.NoIcon,"Cancelled","The run was cancelled.", QMessageBox.Ok)  
             main_window.alert.show()
             self.run_succeeded = False
-        elif state == 0:
+        else:
             print ("all OK, all processes ended")
 
-    def finished_run(self, exitCode, exitStatus):
-        main_window = self.main_window
-        input_file = self.input_file
-        finish_fn = self.finish_fn
-        run_succeeded = self.run_succeeded
-        required_runs = self.processes[self.process_num][2]
-
-        print("finished {}/{} (or {}) with {} {}"
-              .format(self.process_num + 1, required_runs,
-                len(self.processes), exitCode, exitStatus))
+    def finished_run(self, process, exitCode, exitStatus):
+        if process in self.running:
+            # the last lines of the output, which the throttle must not drop
+            update_progress(self, process, force=True)
+        run = self.running.pop(process, None)
+        # a process which exits normally with a non zero exit code failed too
+        succeeded = exitStatus == QtCore.QProcess.NormalExit and exitCode == 0
+        if run is not None:
+            self.scheduler.process_finished(run, exitCode, exitStatus == QtCore.QProcess.NormalExit)
+
+        print("finished {}/{} with {} {}"
+              .format(len(self.scheduler.completed), len(self.scheduler.runs), exitCode, exitStatus))
         
-        if exitStatus == 0:
-            self.run_succeeded = self.run_succeeded and True
-        else:
-            self.run_succeeded = self.run_succeeded and False
-            
-        if self.process_num == required_runs-1:
+        self.run_succeeded = self.run_succeeded and succeeded
+
+        while self.start_next_process():
+            pass
+        if not self.scheduler.finished:
+            return
+        self.finish()
+
+    def finish(self):
+        '''Merges the results, closes the progress window and reports the outcome of the run.'''
+        main_window = self.main_window
+        cancelled = self.scheduler.cancelled
+        if len(self.scheduler.runs) == 0 and self.engine.skipped_runs == 0 and self.engine.cached_runs == 0:
+            self.run_succeeded = False
+
+        if not cancelled and self.run_succeeded and self.engine.has_next_stage:
+            # e.g. the fine stage of a coarse-to-fine run, which needs the results of the coarse stage
             main_window.progress_window.close()
-            if self.run_succeeded:
-                main_window.alert = QMessageBox(QMessageBox.NoIcon,
-                    "Success","The DVC code ran successfully.", QMessageBox.Ok)
+            try:
+                self.engine.next_stage()
+            except (OSError, ValueError) as err:
+                print (err)
+                self.run_succeeded = False
             else:
-                main_window.alert = QMessageBox(QMessageBox.NoIcon,
-                    "Fail","The DVC code had some troubles.", QMessageBox.Ok) 
-            main_window.alert.show()
-            if finish_fn is not None:
-                finish_fn() 
-        else:
-            self.process_num += 1
-            self.run_dvc()
+                self.start_runs(self.total_threads, self.max_concurrent)
+                return
 
-            
\ No newline at end of file
+        if not cancelled and self.run_succeeded:
+            try:
+                self.engine.finalise()
+            except OSError as err:
+                print (err)
+                self.run_succeeded = False
+
+        # closing the progress window emits canceled, which calls onCancel
+        main_window.progress_window.close()
+        if cancelled:
+            return
+        if self.run_succeeded:
+            main_window.alert = QMessageBox(QMessageBox.NoIcon,
+                "Success","The DVC code ran successfully.", QMessageBox.Ok)
+        else:
+            main_window.alert = QMessageBox(QMessageBox.NoIcon,
+                "Fail","The DVC code had some troubles.", QMessageBox.Ok) 
+        main_window.alert.show()
+        if self.finish_fn is not None:
+            self.finish_fn()
+
+
+class QueueRunner(object):
+    '''Executes the jobs of a RunQueue one after the other in the background.
+
+    Each job runs in a separate idvc-run process, so the app can be used while it runs.
+    The progress reported by idvc-run is shown in the status bar of the main window.
+
+    Parameters
+    ----------
+    main_window : MainWindow
+        the main window of the app, its settings give the threads and processes of the runs.
+    queue : RunQueue
+        the queue of jobs.
+    finish_fn : callable, optional
+        called with the job and the exit code of idvc-run when a job ends.
+    '''
+    def __init__(self, main_window, queue, finish_fn=None):
+        self.main_window = main_window
+        self.queue = queue
+        self.finish_fn = finish_fn
+        self.process = None
+        self.job = None
+        self.cancelled = False
+        # set when the app exits, the running job is resumed at the next start
+        self.stopping = False
+
+    @property
+    def running(self):
+        return self.process is not None
+
+    def arguments(self, job):
+        '''Returns the arguments of idvc-run for a job'''
+        settings = self.main_window.settings
+        try:
+            total_threads = int(settings.value('omp_threads'))
+        except Exception as err:
+            total_threads = 4
+            print (err)
+        try:
+            max_concurrent = int(settings.value('dvc_processes'))
+        except Exception as err:
+            max_concurrent = 1
+            print (err)
+        args = ["-m", "idvc.idvc_run", job['run_config'], "--session-folder", job['session_folder'],
+                "--threads", str(total_threads), "--processes", str(max_concurrent)]
+        if job.get('hdf5_dataset_path'):
+            args += ["--dataset-path", job['hdf5_dataset_path']]
+        if job.get('resume'):
+            args.append("--resume")
+        if settings.value('dvc_autotune') == "true":
+            args.append("--autotune")
+        args += ["--stop-file", self.stop_filename(job)]
+        return args
+
+    def stop_filename(self, job):
+        '''Returns the file which stops idvc-run when it is created'''
+        return os.path.join(os.path.dirname(self.queue.filename), "run_queue_stop_{}".format(job['id']))
+
+    def remove_stop_file(self, job):
+        try:
+            os.remove(self.stop_filename(job))
+        except FileNotFoundError:
+            pass
+
+    def start(self):
+        '''Starts the next queued job, unless a job is running. Returns True if a job was started.'''
+        if self.running:
+            return False
+        job = self.queue.next_job()
+        if job is None:
+            self.show_message("Run queue: no runs queued")
+            return False
+        self.job = job
+        self.cancelled = False
+        self.remove_stop_file(job)
+        self.process = QtCore.QProcess()
+        self.process.setProcessChannelMode(QtCore.QProcess.MergedChannels)
+        self.process.setWorkingDirectory(job['session_folder'])
+        self.process.readyRead.connect(self.read_output)
+        self.process.finished.connect(self.finished_job)
+        self.process.start(sys.executable, self.arguments(job))
+        self.show_message("Run queue: started {}".format(job['name']))
+        return True
+
+    def read_output(self):
+        '''Shows the last progress line of idvc-run in the status bar'''
+        line = None
+        while self.process.canReadLine():
+            line = str(self.process.readLine(), "utf-8").strip()
+        if line:
+            self.show_message("Run queue: {} - {}".format(self.job['name'], line))
+
+    def finished_job(self, exitCode, exitStatus):
+        job, process = self.job, self.process
+        if process.canReadLine():
+            self.read_output()
+        self.remove_stop_file(job)
+        if self.stopping:
+            # left running in the queue, so that RunQueue.recover queues it again
+            return
+        if self.cancelled:
+            exitCode = 130
+        elif exitStatus != QtCore.QProcess.NormalExit:
+            exitCode = 1
+        self.queue.job_finished(job['id'], exitCode)
+        self.process = None
+        self.job = None
+        self.show_message("Run queue: {} {}".format(job['name'],
+            "finished" if exitCode == 0 else "cancelled" if exitCode == 130 else "failed"))
+        if self.finish_fn is not None:
+            self.finish_fn(job, exitCode)
+        self.start()
+
+    def interrupt(self):
+        '''Interrupts idvc-run, which kills its dvc processes.
+
+        On Windows, where idvc-run can't be sent a SIGINT, its stop file is created instead.
+        It is checked while the dvc processes run, so a job converting its volumes stops
+        when the conversion has finished.'''
+        if sys.platform.startswith('win'):
+            open(self.stop_filename(self.job), "w").close()
+        else:
+            os.kill(self.process.processId(), signal.SIGINT)
+
+    def cancel(self):
+        '''Stops the running job, which is recorded as cancelled. The next job is started.'''
+        if self.running:
+            self.cancelled = True
+            self.interrupt()
+
+    def stop(self, timeout=10000):
+        '''Stops the running job when the app exits, it is resumed when the queue is recovered.
+
+        idvc-run is killed if it doesn't exit within timeout milliseconds, which doesn't
+        stop its dvc processes on Windows.'''
+        if self.running:
+            self.stopping = True
+            self.interrupt()
+            if not self.process.waitForFinished(timeout):
+                self.process.kill()
+
+    def show_message(self, message):
+        self.main_window.statusBar().showMessage(message)
@@ -0,0 +1,181 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Adaptive sweep of the subvolume parameters of a bulk run, by successive halving.
+
+Every configuration of the bulk run is first run on a small, spatially stratified
+subset of the points. The configurations are ranked by the objective minimum and
+the spread of the displacements of the converged points, as in the statistics of the
+results tab. The configurations where too few points converged are ranked last.
+The best 1/eta go on to the next round, on eta times more points, until the subset
+would be as large as the point cloud. Only the configurations left are run on the
+full point cloud. The run folders of the others are moved to sweep/pruned, the
+results of the rounds are kept in sweep/round_<n>.
+'''
+
+import os
+import json
+import math
+import shutil
+
+import numpy as np
+
+SWEEP_FILENAME = "sweep.json"
+MIN_CONVERGED_FRACTION = 0.5
+MIN_CONVERGED_POINTS = 10
+
+def score_result(disp_filename):
+    '''Returns the statistics used to rank a configuration from its .disp file.
+
+    Returns
+    -------
+    tuple (mean objective minimum, mean standard deviation of the displacement components,
+    fraction of the points which converged, number of points which converged).
+    The first two are inf if no point converged.
+    '''
+    with open(disp_filename) as f:
+        header = f.readline().split()
+    data = np.loadtxt(disp_filename, skiprows=1, ndmin=2)
+    if data.size == 0:
+        return float('inf'), float('inf'), 0., 0
+    columns = {name: i for i, name in enumerate(header)}
+    converged = data[data[:, columns['status']] == 0]
+    if len(converged) == 0:
+        return float('inf'), float('inf'), 0., 0
+    objmin = float(np.mean(converged[:, columns['objmin']]))
+    displacements = converged[:, [columns['u'], columns['v'], columns['w']]]
+    spread = float(np.mean(np.std(displacements, axis=0)))
+    return objmin, spread, len(converged) / len(data), len(converged)
+
+def rank_configurations(scores, min_converged_fraction=MIN_CONVERGED_FRACTION,
+                        min_converged_points=MIN_CONVERGED_POINTS):
+    '''Returns the keys of scores ordered from the best to the worst configuration.
+
+    The configurations where less than min_converged_fraction of the points or less than
+    min_converged_points points converged are ranked last, by their converged fraction: the
+    spread of the displacements of a few converged points is small but meaningless.
+    The others are ranked by the sum of their ranks by objective minimum and by
+    displacement spread, lower is better for both. Ties are broken by the fraction of
+    points which converged.'''
+    reliable = [key for key in scores
+                if scores[key][2] >= min_converged_fraction and scores[key][3] >= min_converged_points]
+    unreliable = sorted((key for key in scores if key not in reliable), key=lambda k: -scores[k][2])
+    objmin_rank = {key: rank for rank, key in enumerate(sorted(reliable, key=lambda k: scores[k][0]))}
+    spread_rank = {key: rank for rank, key in enumerate(sorted(reliable, key=lambda k: scores[k][1]))}
+    return sorted(reliable, key=lambda k: (objmin_rank[k] + spread_rank[k], -scores[k][2])) + unreliable
+
+class AdaptiveSweep(object):
+    '''Runs the rounds of successive halving of the configurations of a bulk run.
+
+    The rounds are stages of the DVCEngine: first_round returns the runs of the first
+    round, and each round sets the next one in engine.next_stage_fn, the last round
+    returning the runs of the configurations kept on the full point cloud.
+
+    Parameters
+    ----------
+    engine : DVCEngine
+        the engine which set up the bulk run.
+    configurations : dict
+        for each configuration number, a dictionary with the keys 'num_points', the points of the
+        full run, 'runs', the runs on the full point cloud, 'run_folder' and the subvolume 'size'
+        and 'points', recorded in the sweep file.
+    write_sample_run : callable
+        write_sample_run(configuration, num_points, round_num) writes the configuration of a round
+        on a subset of num_points points. Returns the output filename and the DVCRun, or None if the
+        result is already complete.
+    sample_points : int, default 200
+        number of points of the first round.
+    eta : int, default 2
+        the fraction 1/eta of the configurations is kept at each round, on eta times more points.
+    '''
+    def __init__(self, engine, configurations, write_sample_run, sample_points=200, eta=2):
+        self.engine = engine
+        self.configurations = configurations
+        self.write_sample_run = write_sample_run
+        self.sample_points = int(sample_points)
+        self.eta = max(int(eta), 2)
+        self.kept = sorted(configurations)
+        self.round_num = 0
+        self.outputs = {}
+        self.rounds = []
+        self.pruned = {}
+
+    @property
+    def full_points(self):
+        return min(self.configurations[c]['num_points'] for c in self.kept)
+
+    def first_round(self):
+        '''Returns the runs of the first round, or of the full run if the point clouds are too small to sweep'''
+        if len(self.kept) <= 1 or self.sample_points >= self.full_points:
+            return self.final_round()
+        return self.sample_round()
+
+    def sample_round(self):
+        num_points = self.sample_points * self.eta ** self.round_num
+        runs = []
+        self.outputs = {}
+        for configuration in self.kept:
+            output_filename, run = self.write_sample_run(configuration, num_points, self.round_num)
+            self.outputs[configuration] = output_filename
+            if run is not None:
+                runs.append(run)
+        self.rounds.append({'points': num_points, 'configurations': list(self.kept)})
+        self.engine.next_stage_fn = self.next_round
+        return runs
+
+    def next_round(self):
+        '''Ranks the configurations of the round which finished and returns the runs of the next one'''
+        scores = {c: score_result(self.outputs[c] + ".disp") for c in self.kept}
+        ranked = rank_configurations(scores)
+        self.kept = sorted(ranked[:int(math.ceil(len(ranked) / self.eta))])
+        self.rounds[-1]['scores'] = {str(c): list(scores[c]) for c in ranked}
+        self.rounds[-1]['kept'] = list(self.kept)
+        self.round_num += 1
+        if len(self.kept) > 1 and self.sample_points * self.eta ** self.round_num < self.full_points:
+            runs = self.sample_round()
+        else:
+            runs = self.final_round()
+        self.save()
+        return runs
+
+    def final_round(self):
+        '''Moves the run folders of the configurations which were pruned to sweep/pruned, so that
+        they are not listed in the results, and returns the runs of the others'''
+        pruned = [c for c in self.configurations if c not in self.kept]
+        pruned_root = os.path.join(self.engine.run_folder, "sweep", "pruned")
+        for configuration in pruned:
+            run_folder = self.configurations[configuration]['run_folder']
+            destination = os.path.join(pruned_root, os.path.basename(run_folder))
+            if os.path.isdir(run_folder):
+                os.makedirs(pruned_root, exist_ok=True)
+                # left by a previous execution of the run, which is resumed
+                shutil.rmtree(destination, ignore_errors=True)
+                shutil.move(run_folder, destination)
+            self.pruned[configuration] = os.path.relpath(destination, self.engine.run_folder)
+        pruned_folders = [self.configurations[c]['run_folder'] for c in pruned]
+        self.engine.shard_groups = [group for group in self.engine.shard_groups
+                                    if os.path.dirname(group[0]) not in pruned_folders]
+        self.engine.next_stage_fn = None
+        runs = []
+        for configuration in self.kept:
+            runs += self.configurations[configuration]['runs']
+        return runs
+
+    def save(self):
+        '''Writes the rounds and the kept configurations in the run folder'''
+        record = {'eta': self.eta, 'sample_points': self.sample_points, 'rounds': self.rounds,
+                  'configurations': {str(c): {'size': v['size'], 'points': v['points']}
+                                     for c, v in self.configurations.items()},
+                  'kept': list(self.kept),
+                  'pruned': {str(c): folder for c, folder in self.pruned.items()}}
+        with open(os.path.join(self.engine.run_folder, SWEEP_FILENAME), "w") as f:
+            json.dump(record, f, indent=1)
@@ -0,0 +1,141 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Console entry point to run a DVC run configuration without the app.
+
+Usage:
+    idvc-run <session>/Results/<run name>/_run_config.json --threads 8 --processes 2
+
+The run config is created by the app when a run is set up. The run folder must
+not contain the results of a previous execution, unless --resume is passed.
+'''
+
+import os
+import sys
+import json
+import logging
+import argparse
+import multiprocessing
+
+from idvc.dvc_engine import DVCEngine, HeadlessRunner
+from idvc.dvc_autotune import Autotuner
+from idvc.dvc_progress import Throttle
+
+
+class NoOpCallback(object):
+    '''Callback ignoring the values emitted'''
+    def emit(self, *args, **kwargs):
+        pass
+
+
+class MessageCallback(object):
+    '''Callback printing the messages emitted on a stream'''
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+
+    def emit(self, message):
+        self.stream.write("{}\n".format(message))
+        self.stream.flush()
+
+
+class ProgressCallback(object):
+    '''Callback printing the percentages emitted on a stream, at most once per interval
+    in seconds, as HeadlessRunner reports the progress of the runs. 100% is always printed.'''
+    def __init__(self, stream=None, interval=1.):
+        self.stream = stream if stream is not None else sys.stdout
+        self.throttle = Throttle(interval)
+        self.last = None
+
+    def emit(self, value):
+        value = int(value)
+        if value == self.last or not self.throttle.ready(force=value >= 100):
+            return
+        self.last = value
+        self.stream.write("Progress: {}%\n".format(value))
+        self.stream.flush()
+
+
+def infer_session_folder(run_config_file):
+    '''Returns the session folder of a run config, which is saved in the run folder.'''
+    with open(run_config_file) as tmp:
+        run_folder = json.load(tmp)['run_folder']
+    folder = os.path.dirname(os.path.abspath(run_config_file))
+    for _ in os.path.normpath(run_folder).split(os.sep):
+        folder = os.path.dirname(folder)
+    return folder
+
+
+def main(argv=None):
+    '''Sets up and runs a run config. Returns 0 on success, 1 if a run failed,
+    2 if the input is not valid and 130 if interrupted.'''
+    parser = argparse.ArgumentParser(description='iDVC - run a DVC run configuration without the graphical interface')
+    parser.add_argument('run_config', type=str, help='the _run_config.json file created by the app')
+    parser.add_argument('--session-folder', type=str, default=None,
+                        help='folder the paths in the run config are relative to, by default inferred from the run config location')
+    parser.add_argument('--dataset-path', type=str, default=None,
+                        help='path of the dataset in HDF5/NeXus image files')
+    parser.add_argument('--threads', type=int, default=multiprocessing.cpu_count(),
+                        help='total number of OpenMP threads shared between the dvc processes')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='maximum number of dvc processes run at the same time')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume an interrupted run, running only the configurations without complete results')
+    parser.add_argument('--autotune', action='store_true',
+                        help='measure the throughput with several layouts of processes and threads on a sample of points, '
+                             'and run with the fastest, using --threads in total')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='memory the dvc processes may use in GB, by default 90%% of the memory available. '
+                             'Fewer processes are run at the same time if their volumes do not fit')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the cache of results, even if enabled in the run config')
+    parser.add_argument('--stop-file', type=str, default=None,
+                        help='the run is cancelled when this file is created, like with Ctrl+C')
+    parser.add_argument('--debug', type=str)
+    args = parser.parse_args(argv)
+
+    if args.debug in ['debug', 'info', 'warning', 'error', 'critical']:
+        level = eval(f'logging.{args.debug.upper()}')
+        logging.basicConfig(level=level)
+        logging.info(f"iDVC: Setting debugging level to {args.debug.upper()}")
+
+    run_config = os.path.abspath(args.run_config)
+    try:
+        session_folder = args.session_folder
+        if session_folder is None:
+            session_folder = infer_session_folder(run_config)
+        engine = DVCEngine(run_config, os.path.abspath(session_folder), args.dataset_path, args.resume,
+                           not args.no_cache)
+        engine.set_up(MessageCallback(), ProgressCallback())
+        if engine.skipped_runs > 0:
+            print("Resuming: {} configurations already have complete results".format(engine.skipped_runs))
+        if engine.cached_runs > 0:
+            print("{} configurations restored from the cache of results".format(engine.cached_runs))
+    except (OSError, ValueError, KeyError) as err:
+        print("Error setting up the run: {}".format(err), file=sys.stderr)
+        return 2
+
+    memory_limit = int(args.memory_limit * 1024**3) if args.memory_limit is not None else None
+    total_threads, max_concurrent = args.threads, args.processes
+    if args.autotune and len(engine.runs) > 0:
+        best = Autotuner(engine.runs[0], args.threads, memory_limit=memory_limit).tune(MessageCallback(), ProgressCallback())
+        if best is not None:
+            processes, threads, points_per_second = best
+            print("Autotuner: {} processes with {} threads, {:.1f} points/s".format(processes, threads, points_per_second))
+            total_threads, max_concurrent = processes * threads, processes
+
+    runner = HeadlessRunner(engine, total_threads, max_concurrent, memory_limit=memory_limit,
+                            stop_file=args.stop_file)
+    return runner.run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,15 +13,23 @@
 #   Author: Laura Murgatroyd (UKRI-STFC)
 #   Author: Edoardo Pasca (UKRI-STFC)
 
+import collections
 import imghdr
+import itertools
+import math
 import os
 import shutil
 import sys
+import tempfile
 import time
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
 import h5py
 import numpy
 import vtk
+from vtk.util import numpy_support
 from ccpi.viewer.utils import Converter
 from ccpi.viewer.utils.conversion import (cilHDF5CroppedReader,
                                           cilHDF5ResampleReader,
@@ -31,7 +39,6 @@ from ccpi.viewer.utils.conversion import (cilHDF5CroppedReader,
                                           cilMetaImageResampleReader,
                                           cilNumpyCroppedReader,
                                           cilNumpyResampleReader,
-                                          cilTIFFResampleReader,
                                           cilTIFFCroppedReader, 
                                           Converter)
 from ccpi.viewer.ui.dialogs import RawInputDialog, HDF5InputDialog
@@ -45,6 +52,11 @@ from PySide2.QtWidgets import (QComboBox, QDialog, QDialogButtonBox,
 import logging
 import warnings
 
+from idvc.dvc_progress import SharedProgress
+from idvc.utils.cache import FileCache, user_cache_dir, stat_fingerprint
+from idvc.utils.pyramid import (PYRAMID_FILENAME, PyramidWriter, bin_slab, choose_level, level_filename,
+                                pyramid_key, pyramid_size, read_pyramid)
+
 logger = logging.getLogger(__name__)
 # ImageCreator class
 
@@ -72,7 +84,8 @@ class ImageDataCreator(object):
 
         '''
 
-    def __init__(self,  main_window, image_files, output_image, info_var=None, resample=False, crop_image=False, target_size=0.125, origin=(0, 0, 0), target_z_extent=(0, 0)):
+    def __init__(self,  main_window, image_files, output_image, info_var=None, resample=False, crop_image=False, target_size=0.125, origin=(0, 0, 0), target_z_extent=(0, 0),
+                 target_extent=None, chunked_volume=None):
         """
         Parameters:
         -----------
@@ -92,6 +105,11 @@ class ImageDataCreator(object):
             The origin coordinates for cropping.
         target_z_extent : tuple, default=(0, 0))
             The Z extent for cropping.
+        target_extent : list, optional
+            The box to crop, x0, x1, y0, y1, z0, z1. Used with chunked_volume.
+        chunked_volume : str, optional
+            The chunked volume of the session for the image files, see write_chunked_volume. If given
+            with target_extent, the crop reads only the box from it, writing it first if needed.
         """
         self.main_window = main_window
         self.image_files = image_files
@@ -102,7 +120,10 @@ class ImageDataCreator(object):
         self.target_size = target_size
         self.origin = origin 
         self.target_z_extent = target_z_extent
-
+        self.target_extent = target_extent
+        self.chunked_volume = chunked_volume
+        self.pyramid_cache = None
+        self.cancel_event = None
 
         if len(self.image_files) == 1:
             self.image = self.getSingleImage()
@@ -140,38 +161,8 @@ class ImageDataCreator(object):
         
         if self.file_extension == None:
             return
-        
-        elif file_extension in ['.mha', '.mhd']:
-            createProgressWindow(main_window, "Converting", "Converting Image")
-            image_worker = Worker(loadMetaImage, main_window=main_window, image=self.image, output_image=self.output_image,
-                                  image_info=self.info_var, resample=self.resample, target_size=target_size, crop_image=self.crop_image, origin=origin,
-                                  target_z_extent=target_z_extent, convert_numpy=convert_numpy, convert_raw=convert_raw, output_dir=output_dir)
 
-        elif file_extension in ['.npy']:
-            createProgressWindow(main_window, "Converting", "Converting Image")
-            # image_file, output_image, image_info = None, resample = False, target_size = 0.125, crop_image = False,
-            # origin = (0,0,0), target_z_extent = (0,0), progress_callback=None
-            image_worker = Worker(loadNpyImage, image_file=self.image, output_image=self.output_image, image_info=self.info_var, resample=self.resample, target_size=target_size,
-                                  crop_image=self.crop_image, origin=origin, target_z_extent=target_z_extent)
-
-        elif file_extension in ['tif', 'tiff', '.tif', '.tiff']:
-            createProgressWindow(main_window, "Converting", "Converting Image")
-            # filenames, reader, output_image,   convert_numpy = False,  image_info = None, progress_callback=None
-            
-            image_worker = Worker(loadTif, self.image_files, self.output_image, convert_numpy=convert_numpy, 
-                                  image_info=self.info_var, resample=self.resample, crop_image=self.crop_image, target_size=target_size,
-                                  origin=origin, target_z_extent=target_z_extent)
-
-        elif file_extension in ['.nxs', '.h5', '.hdf5']:
-            if hasattr(self.main_window, 'hdf5_dataset_path'):
-                self.createProgressWindowAndNxsWorker()
-            else:
-                dialog = HDF5InputDialog(main_window, self.image)
-                dialog.onOk = lambda: self.HDF5InputDialog_onOk_redefined(dialog)
-                dialog.exec() 
-            image_worker = self.image_worker
-            
-        elif file_extension in ['.raw']:
+        if file_extension in ['.raw'] and not self.readsChunkedVolume():
             if 'file_type' in self.info_var and self.info_var['file_type'] == 'raw':
                 createConvertRawImageWorker(main_window, self.image, self.output_image, self.info_var,
                                             self.resample, target_size, self.crop_image, origin, target_z_extent, finish_fn)
@@ -184,6 +175,17 @@ class ImageDataCreator(object):
                 dialog = main_window.raw_import_dialog['dialog'].show()
                 return
 
+        image_worker = self.createWorker(convert_numpy=convert_numpy, convert_raw=convert_raw, output_dir=output_dir)
+        if image_worker is not None:
+            createProgressWindow(main_window, "Converting", "Converting Image",
+                                 cancel=self.cancel_event.set if self.cancel_event is not None else None)
+
+        elif file_extension in ['.nxs', '.h5', '.hdf5']:
+            dialog = HDF5InputDialog(main_window, self.image)
+            dialog.onOk = lambda: self.HDF5InputDialog_onOk_redefined(dialog)
+            dialog.exec() 
+            image_worker = self.image_worker
+
         else:
             error_title = "Error"
             error_text = "Error reading file: ({filename})".format(
@@ -211,6 +213,65 @@ class ImageDataCreator(object):
         main_window.threadpool.start(image_worker)
 
 
+    def readsChunkedVolume(self):
+        '''True if the crop is read from the chunked volume of the session, see loadVolumeBox'''
+        return self.crop_image and self.chunked_volume is not None and self.target_extent is not None
+
+    def createWorker(self, convert_numpy=False, convert_raw=True, output_dir=None):
+        """
+        Returns the worker which loads the image, not started, or None if the image can't be
+        loaded without asking the user, i.e. raw files without their dimensions, HDF5/NeXus
+        files without the dataset path, or unsupported formats.
+        """
+        main_window = self.main_window
+        file_extension = self.file_extension
+        target_size = self.target_size
+        origin = self.origin
+        target_z_extent = self.target_z_extent
+
+        # the display readers load the nearest level of the pyramid of the volume, if it is enabled
+        self.pyramid_cache = get_pyramid_cache(main_window) if self.resample else None
+
+        if file_extension is None:
+            return None
+
+        elif self.readsChunkedVolume():
+            return Worker(loadVolumeBox, image_files=self.image_files, output_image=self.output_image,
+                          chunked_volume=self.chunked_volume, target_extent=self.target_extent,
+                          image_info=self.info_var, dataset_path=getattr(main_window, 'hdf5_dataset_path', None))
+
+        elif file_extension in ['.mha', '.mhd']:
+            return Worker(loadMetaImage, main_window=main_window, image=self.image, output_image=self.output_image,
+                          image_info=self.info_var, resample=self.resample, target_size=target_size, crop_image=self.crop_image, origin=origin,
+                          target_z_extent=target_z_extent, convert_numpy=convert_numpy, convert_raw=convert_raw, output_dir=output_dir,
+                          pyramid_cache=self.pyramid_cache)
+
+        elif file_extension in ['.npy']:
+            # image_file, output_image, image_info = None, resample = False, target_size = 0.125, crop_image = False,
+            # origin = (0,0,0), target_z_extent = (0,0), progress_callback=None
+            return Worker(loadNpyImage, image_file=self.image, output_image=self.output_image, image_info=self.info_var, resample=self.resample, target_size=target_size,
+                          crop_image=self.crop_image, origin=origin, target_z_extent=target_z_extent,
+                          pyramid_cache=self.pyramid_cache)
+
+        elif file_extension in ['tif', 'tiff', '.tif', '.tiff']:
+            # filenames, reader, output_image,   convert_numpy = False,  image_info = None, progress_callback=None
+            # the resampling can be cancelled from the progress window
+            self.cancel_event = threading.Event() if self.resample else None
+            return Worker(loadTif, self.image_files, self.output_image, convert_numpy=convert_numpy, 
+                          image_info=self.info_var, resample=self.resample, crop_image=self.crop_image, target_size=target_size,
+                          origin=origin, target_z_extent=target_z_extent, pyramid_cache=self.pyramid_cache,
+                          cancel_event=self.cancel_event)
+
+        elif file_extension in ['.nxs', '.h5', '.hdf5'] and hasattr(main_window, 'hdf5_dataset_path'):
+            return Worker(self.loadNxs, dataset_path=main_window.hdf5_dataset_path)
+
+        elif file_extension in ['.raw'] and self.info_var is not None and self.info_var.get('file_type') == 'raw':
+            return Worker(loadRawImage, main_window=main_window, fname=self.image, output_image=self.output_image,
+                          info_var=self.info_var, resample=self.resample, target_size=target_size, crop_image=self.crop_image,
+                          origin=origin, target_z_extent=target_z_extent, pyramid_cache=self.pyramid_cache)
+
+        return None
+
     def HDF5InputDialog_onOk_redefined(self, dialog):
         """
         Redefines the ok button in the HDF5 input dialog. It returns if the file has been read before.
@@ -250,73 +311,122 @@ class ImageDataCreator(object):
             raise ValueError("dataset_path must be specified for NeXus file")
         progress_callback.emit(10)
 
-        with h5py.File(self.image, 'r') as f:
-            if dataset_path not in f:
-                raise KeyError(f"Dataset {dataset_path} not found in {self.image}")
-
-            data = f[dataset_path][()]
-            shape = data.shape
-
-            if self.resample:
-                reader = cilHDF5ResampleReader()
-                reader.SetFileName(self.image)
-                reader.SetDatasetName(dataset_path)
-                reader.SetTargetSize(int(self.target_size * 1024*1024*1024))
-                reader.AddObserver(vtk.vtkCommand.ProgressEvent, partial(
-                    getProgress, progress_callback=progress_callback))
-                reader.Update()
-                self.output_image.ShallowCopy(reader.GetOutput())
-
-                if image_info is not None:
-                    image_info['isBigEndian'] = reader.GetBigEndian()
-                    image_size = shape[0] * shape[1] * shape[2]
-                    if image_size <= self.target_size:
-                        image_info['sampled'] = False
-                    else:
-                        image_info['sampled'] = True
-
-            elif self.crop_image:
-                print(self.target_z_extent)
-                reader = cilHDF5CroppedReader()
-                reader.SetOrigin(tuple(self.origin))
-                reader.SetTargetZExtent(self.target_z_extent)
-                reader.SetDatasetName(dataset_path)
-
-                reader.AddObserver(vtk.vtkCommand.ProgressEvent, partial(
-                    getProgress, progress_callback=progress_callback))
-                reader.SetFileName(self.image)
-                reader.Update()
-
-                progress_callback.emit(80)
-                self.output_image.ShallowCopy(reader.GetOutput())
-                progress_callback.emit(90)
-
-                if image_info is not None:
+        # only the metadata is read, the readers load the voxels they need
+        volume_info = probe_hdf5(self.image, dataset_path)
+        shape = volume_info['shape']
+        dtype = volume_info['dtype']
+
+        factor = None
+        if self.resample:
+            factor = load_from_pyramid(self.pyramid_cache, [self.image], volume_info, self.output_image,
+                                       self.target_size, dataset_path, progress_callback)
+
+        if factor is not None:
+            if image_info is not None:
+                image_info['isBigEndian'] = volume_info['isBigEndian']
+                image_info['sampled'] = True
+
+        elif self.resample:
+            reader = cilHDF5ResampleReader()
+            reader.SetFileName(self.image)
+            reader.SetDatasetName(dataset_path)
+            reader.SetTargetSize(int(self.target_size * 1024*1024*1024))
+            reader.AddObserver(vtk.vtkCommand.ProgressEvent, partial(
+                getProgress, progress_callback=progress_callback))
+            reader.Update()
+            self.output_image.ShallowCopy(reader.GetOutput())
+
+            if image_info is not None:
+                image_info['isBigEndian'] = reader.GetBigEndian()
+                image_size = shape[0] * shape[1] * shape[2]
+                if image_size <= self.target_size:
                     image_info['sampled'] = False
-                    image_info['cropped'] = True
+                else:
+                    image_info['sampled'] = True
+
+        elif self.crop_image:
+            print(self.target_z_extent)
+            reader = cilHDF5CroppedReader()
+            reader.SetOrigin(tuple(self.origin))
+            reader.SetTargetZExtent(self.target_z_extent)
+            reader.SetDatasetName(dataset_path)
+
+            reader.AddObserver(vtk.vtkCommand.ProgressEvent, partial(
+                getProgress, progress_callback=progress_callback))
+            reader.SetFileName(self.image)
+            reader.Update()
+
+            progress_callback.emit(80)
+            self.output_image.ShallowCopy(reader.GetOutput())
+            progress_callback.emit(90)
 
-            else:
-                raise ValueError(f"Resampling or cropping must be performed when loading an image.")
-        
-            if data.dtype in ["int8", "uint8"]:
-                vol_bit_depth = 8
-            elif data.dtype in ["int16", "uint16", "int32", "uint32", "float32", "float64"]:
-                vol_bit_depth = 16
-            
-            if numpy.issubdtype(data.dtype , numpy.signedinteger) or numpy.issubdtype(data.dtype , numpy.floating):
-                warnings.warn(
-                f"Data of type {data.dtype} may contain negative values. "
-                f"Negative values will be reinterpreted as positive values when cast to uint16.",
-                RuntimeWarning
-                )
-         
             if image_info is not None:
-                image_info["vol_bit_depth"] = vol_bit_depth
-                image_info["shape"] = shape
+                image_info['sampled'] = False
+                image_info['cropped'] = True
+
+        else:
+            raise ValueError(f"Resampling or cropping must be performed when loading an image.")
+    
+        vol_bit_depth = volume_info['vol_bit_depth']
+        
+        if numpy.issubdtype(dtype , numpy.signedinteger) or numpy.issubdtype(dtype , numpy.floating):
+            warnings.warn(
+            f"Data of type {dtype} may contain negative values. "
+            f"Negative values will be reinterpreted as positive values when cast to uint16.",
+            RuntimeWarning
+            )
+     
+        if image_info is not None:
+            image_info["vol_bit_depth"] = vol_bit_depth
+            image_info["shape"] = shape
 
         progress_callback.emit(100)
         return 0
 
+def createImageDataConcurrently(main_window, image_data_creators, finish_fn, **create_kwargs):
+    '''Loads the images of several ImageDataCreators at the same time, e.g. the reference and
+    correlate images, so that the wait is the longest of the loads rather than their sum.
+
+    A single progress window shows the mean progress of the loads, and finish_fn is called when all
+    of them have succeeded. If an image can't be loaded without asking the user, see
+    ImageDataCreator.createWorker, the images are loaded one after the other instead.
+
+    Parameters
+    ----------
+    image_data_creators : list of ImageDataCreator
+    finish_fn : callable
+        called without arguments when all the images are loaded.
+    **create_kwargs : dict
+        convert_numpy, convert_raw and output_dir, as in ImageDataCreator.createImageData.
+    '''
+    workers = [creator.createWorker(**create_kwargs) for creator in image_data_creators]
+    if len(workers) == 1 or any(image_worker is None for image_worker in workers):
+        if len(image_data_creators) > 1:
+            next_fn = partial(createImageDataConcurrently, main_window, image_data_creators[1:], finish_fn, **create_kwargs)
+        else:
+            next_fn = finish_fn
+        image_data_creators[0].createImageData(finish_fn=next_fn, **create_kwargs)
+        return
+
+    createProgressWindow(main_window, "Converting", "Converting Images")
+    main_window.progress_window.setValue(10)
+    shared_progress = SharedProgress(ProgressWindowCallback(main_window.progress_window), len(workers), 10, 100)
+    results = [None] * len(workers)
+
+    def worker_finished(index, result):
+        results[index] = result
+        if all(value == 0 for value in results):
+            finish_fn()
+
+    main_window.threadpool = QThreadPool()
+    main_window.threadpool.setMaxThreadCount(max(len(workers), main_window.threadpool.maxThreadCount()))
+    for index, image_worker in enumerate(workers):
+        image_worker.signals.error.connect(partial(displayErrorDialogFromWorker, main_window))
+        image_worker.signals.progress.connect(partial(shared_progress.update, index))
+        image_worker.signals.result.connect(partial(worker_finished, index))
+    for image_worker in workers:
+        main_window.threadpool.start(image_worker)
+
 def runIfFinishedCorrectly(result, main_window=None, finish_fn=None, *args, **kwargs):
     if result is not None and result == 0:
         finish_fn(*args, **kwargs)
@@ -430,8 +540,21 @@ def loadMetaImage(**kwargs):
     convert_raw = kwargs.get('convert_raw', True)
     output_dir = kwargs.get('output_dir', None)
     progress_callback = kwargs.get('progress_callback', None)
+    pyramid_cache = kwargs.get('pyramid_cache', None)
 
+    volume_info = probe_metaimage(image)
+
+    factor = None
     if resample:
+        factor = load_from_pyramid(pyramid_cache, [image], volume_info, output_image, target_size,
+                                   progress_callback=progress_callback)
+
+    if factor is not None:
+        reader = None
+        if image_info is not None:
+            image_info['sampled'] = True
+
+    elif resample:
         reader = cilMetaImageResampleReader()
         #print("Target size: ", int(target_size * 1024*1024*1024))
         reader.SetTargetSize(int(target_size * 1024*1024*1024))
@@ -446,7 +569,7 @@ def loadMetaImage(**kwargs):
             image_info['sampled'] = False
             image_info['cropped'] = True
 
-    else:
+    elif volume_info['compressed']:
         reader = cilMetaImageResampleReader()
         # Forces use of resample reader but does not resample
         reader.SetTargetSize(int(1e12))
@@ -455,16 +578,24 @@ def loadMetaImage(**kwargs):
         if image_info is not None:
             image_info['sampled'] = False
 
-    reader.AddObserver("ErrorEvent", main_window.e)
+    else:
+        # the voxels are mapped from the file, not copied in memory
+        reader = None
+        load_volume_mapped(volume_info, output_image)
+        if image_info is not None:
+            image_info['sampled'] = False
 
-    reader.SetFileName(image)
-    reader.Update()
+    if reader is not None:
+        reader.AddObserver("ErrorEvent", main_window.e)
 
-    output_image.ShallowCopy(reader.GetOutput())
+        reader.SetFileName(image)
+        reader.Update()
+
+        output_image.ShallowCopy(reader.GetOutput())
 
     progress_callback.emit(90)
 
-    if resample:
+    if resample and reader is not None:
         loaded_image_size = reader.GetStoredArrayShape(
         )[0] * reader.GetStoredArrayShape()[1] * reader.GetStoredArrayShape()[2]
         resampled_image_size = reader.GetTargetSize()
@@ -474,46 +605,35 @@ def loadMetaImage(**kwargs):
             else:
                 image_info['sampled'] = True
 
-    loaded_shape = reader.GetStoredArrayShape()
+    if reader is not None:
+        loaded_shape = reader.GetStoredArrayShape()
 
-    if not reader.GetIsFortran():
-        loaded_shape = loaded_shape[::-1]
+        if not reader.GetIsFortran():
+            loaded_shape = loaded_shape[::-1]
+    else:
+        # MetaImage files are stored with x varying the fastest
+        loaded_shape = volume_info['shape']
 
     if image_info is not None:
         image_info['shape'] = loaded_shape
-        image_info['vol_bit_depth'] = str(reader.GetBytesPerElement()*8)
-        image_info['isBigEndian'] = reader.GetBigEndian()
+        image_info['vol_bit_depth'] = str(volume_info['dtype'].itemsize*8)
+        image_info['isBigEndian'] = volume_info['isBigEndian']
         image_info['header_length'] = 0
 
-    if convert_raw:
-        filename = reader.GetFileName()
-        if '.mha' in filename:
-            headerlength = reader.GetFileHeaderLength()
-            if output_dir is None:
-                new_filename = image[:-4] + ".raw"
-            else:
-                new_filename = os.path.relpath(os.path.join(
-                    output_dir, os.path.basename(image)[:-4] + ".raw"))
-
-            with open(image, "rb") as image_file_object:
-                end_slice = loaded_shape[2]
-                image_location = headerlength
-                with open(new_filename, "wb") as raw_file_object:
-                    image_file_object.seek(image_location)
-                    chunk = image_file_object.read()
-                    raw_file_object.write(chunk)
+    if convert_raw and volume_info['compressed']:
+        # the dvc code can't read compressed data: the voxels are decoded to a raw file
+        if output_dir is None:
+            new_filename = image[:-4] + ".raw"
         else:
-            # TODO: fix this?
-            file_ext = os.path.splitext(filename)[1]
-            if output_dir is not None:
-                new_filename = os.path.join(
-                    output_dir, os.path.basename(filename))
-                shutil.copyfile(filename, new_filename)
-            else:
-                new_filename = filename
+            new_filename = os.path.relpath(os.path.join(
+                output_dir, os.path.basename(image)[:-4] + ".raw"))
+        # decoded as a stream, the whole volume is not held in memory
+        save_volume_as_raw(image, new_filename, volume_info['dtype'].newbyteorder('='))
 
         image_info['raw_file'] = new_filename
         image_info['header_length'] = 0
+        image_info['isBigEndian'] = sys.byteorder == 'big'
+    # otherwise the file is passed in place to the dvc code, see DVCEngine.locate_voxels
 
     if convert_numpy:
         # this is for using in the dvc code
@@ -524,7 +644,7 @@ def loadMetaImage(**kwargs):
             filename = os.path.join(
                 output_dir, os.path.basename(image)[:-4] + ".npy")
         print(filename)
-        numpy_array = Converter.vtk2numpy(reader.GetOutput(), order="F")
+        numpy_array = Converter.vtk2numpy(output_image, order="F")
         numpy.save(filename, numpy_array)
 
         if image_info is not None:
@@ -549,7 +669,25 @@ def loadNpyImage(**kwargs):
     origin = kwargs.get('origin', (0, 0, 0))
     target_z_extent = kwargs.get('target_z_extent', (0, 0))
     progress_callback = kwargs.get('progress_callback', None)
+    pyramid_cache = kwargs.get('pyramid_cache', None)
+
+    factor = None
     if resample:
+        volume_info = probe_npy(image_file)
+        factor = load_from_pyramid(pyramid_cache, [image_file], volume_info, output_image, target_size,
+                                   progress_callback=progress_callback)
+
+    if factor is not None:
+        header_length = volume_info['header_length']
+        vol_bit_depth = volume_info['dtype'].itemsize * 8
+        shape = volume_info['shape']
+        if not volume_info['isFortran']:
+            shape = shape[::-1]
+        if image_info is not None:
+            image_info['isBigEndian'] = volume_info['isBigEndian']
+            image_info['sampled'] = True
+
+    elif resample:
         reader = cilNumpyResampleReader()
         reader.SetFileName(image_file)
         reader.SetTargetSize(int(target_size * 1024*1024*1024))
@@ -599,42 +737,35 @@ def loadNpyImage(**kwargs):
         time.sleep(0.1)
         progress_callback.emit(5)
 
-        with open(image_file, 'rb') as f:
-            header = f.readline()
-        header_length = len(header)
-        print("Length of header: ", len(header))
-
-        numpy_array = numpy.load(image_file)
-        shape = numpy.shape(numpy_array)
+        # the type is checked from the header, before the voxels are loaded
+        volume_info = probe_npy(image_file)
+        header_length = volume_info['header_length']
+        print("Length of header: ", header_length)
+        shape = volume_info['shape']
+        if not volume_info['isFortran']:
+            # as in the other branches, the dimensions are x, y, z
+            shape = shape[::-1]
 
-        if (isinstance(numpy_array[0][0][0], numpy.uint8)):
+        if volume_info['dtype'] == numpy.uint8:
             vol_bit_depth = '8'
-        elif(isinstance(numpy_array[0][0][0], numpy.uint16)):
+        elif volume_info['dtype'] == numpy.uint16:
             vol_bit_depth = '16'
         else:
             vol_bit_depth = None  # in this case we can't run the DVC code
             output_image = None
-            if numpy.issubdtype(numpy_array.dtype , numpy.signedinteger) or numpy.issubdtype(numpy_array.dtype , numpy.floating):
+            if numpy.issubdtype(volume_info['dtype'] , numpy.signedinteger) or numpy.issubdtype(volume_info['dtype'] , numpy.floating):
                 warnings.warn(
-                f"Cast data of type {numpy_array.dtype} to uint8 or uint16 before proceeding.",
+                f"Cast data of type {volume_info['dtype']} to uint8 or uint16 before proceeding.",
                 RuntimeWarning
                 )
             return
 
         if image_info is not None:
             image_info['sampled'] = False
-            if numpy_array.dtype.byteorder == '=':
-                if sys.byteorder == 'big':
-                    image_info['isBigEndian'] = True
-                else:
-                    image_info['isBigEndian'] = False
-            else:
-                image_info['isBigEndian'] = None
+            image_info['isBigEndian'] = volume_info['isBigEndian']
 
-                print(image_info['isBigEndian'])
-
-        Converter.numpy2vtkImage(
-            numpy_array, output=output_image)  # (3.2,3.2,1.5)
+        # the voxels are mapped from the file, not copied in memory
+        load_volume_mapped(volume_info, output_image)
         progress_callback.emit(80)
 
     progress_callback.emit(100)
@@ -665,6 +796,7 @@ def loadTif(*args, **kwargs):
         - target_size (float, default=0.125): Target size for resampling (in GB).
         - origin (tuple, default=(0, 0, 0)): The origin coordinates for cropping.
         - target_z_extent (tuple, default=(0, 0)): The Z extent for cropping.
+        - cancel_event (threading.Event, optional): Stops the resampling when set, None is then returned.
     """
     filenames, output_image = args
     image_info = kwargs.get('image_info', None)
@@ -675,34 +807,31 @@ def loadTif(*args, **kwargs):
     origin = kwargs.get('origin', (0, 0, 0))
     target_z_extent = kwargs.get('target_z_extent', (0, 0))
 
+    pyramid_cache = kwargs.get('pyramid_cache', None)
+
     # time.sleep(0.1) #required so that progress window displays
     # progress_callback.emit(10)
-    
+
+    factor = None
     if resample:
-        reader = cilTIFFResampleReader()
-        reader.SetFileName(filenames)
-        reader.SetTargetSize(int(target_size * 1024*1024*1024))
-        reader.AddObserver(vtk.vtkCommand.ProgressEvent, partial(
-            getProgress, progress_callback=progress_callback))
-        reader.Update()
-        output_image.ShallowCopy(reader.GetOutput())
+        volume_info = probe_tiff_stack(filenames)
+        factor = load_from_pyramid(pyramid_cache, filenames, volume_info, output_image, target_size,
+                                   progress_callback=progress_callback)
+        if factor is None:
+            factor = read_tiff_stack_binned(filenames, output_image, int(target_size * 1024**3), progress_callback,
+                                            0, 80, cancel_event=kwargs.get('cancel_event'))
+            if factor is None:
+                # cancelled
+                return None
         print("Spacing ", output_image.GetSpacing())
-        header_length = reader.GetFileHeaderLength()
-        print("Length of header: ", header_length)
-        
-        shape = reader.GetStoredArrayShape()
-        if not reader.GetIsFortran():
-            shape = shape[::-1]
-        if image_info is not None:
-            image_info['isBigEndian'] = reader.GetBigEndian()
 
-            image_size = reader.GetStoredArrayShape(
-            )[0] * reader.GetStoredArrayShape()[1]*reader.GetStoredArrayShape()[2]
-            target_size = reader.GetTargetSize()
-            if image_size <= target_size:
-                image_info['sampled'] = False
-            else:
-                image_info['sampled'] = True
+    if factor is not None:
+        reader = None
+        shape = volume_info['shape']
+        dtype = numpy_support.get_vtk_array_type(volume_info['dtype'])
+        if image_info is not None:
+            image_info['isBigEndian'] = volume_info['isBigEndian']
+            image_info['sampled'] = factor > 1
 
     elif crop_image:
         reader = cilTIFFCroppedReader()
@@ -732,7 +861,8 @@ def loadTif(*args, **kwargs):
 
         image_info['sampled'] = False
 
-    dtype = reader.GetOutputVTKType()
+    if reader is not None:
+        dtype = reader.GetOutputVTKType()
 
     if dtype in [vtk.VTK_CHAR, vtk.VTK_UNSIGNED_CHAR]:
         vol_bit_depth = 8
@@ -753,6 +883,14 @@ def loadTif(*args, **kwargs):
     # all good, return 0
     return 0
 
+class ProgressWindowCallback(object):
+    '''Sets the value of a progress window when emit is called, e.g. by a SharedProgress'''
+    def __init__(self, progress_window):
+        self.progress_window = progress_window
+
+    def emit(self, value):
+        progress(self.progress_window, value)
+
 def getProgress(caller, event, progress_callback):
     progress_callback.emit(caller.GetProgress()*80)
 
@@ -895,8 +1033,10 @@ def createRawImportDialog(main_window, fname, output_image, info_var, resample,
 def createConvertRawImageWorker(main_window, fname, output_image, info_var, resample, target_size, crop_image, origin, target_z_extent, finish_fn):
     createProgressWindow(main_window, "Converting", "Converting Image")
     main_window.progress_window.setValue(10)
+    pyramid_cache = get_pyramid_cache(main_window) if resample else None
     image_worker = Worker(saveRawImageData, main_window=main_window, fname=fname, output_image=output_image,
-                          info_var=info_var, resample=resample, target_size=target_size, crop_image=crop_image, origin=origin, target_z_extent=target_z_extent)
+                          info_var=info_var, resample=resample, target_size=target_size, crop_image=crop_image, origin=origin, target_z_extent=target_z_extent,
+                          pyramid_cache=pyramid_cache)
     image_worker.signals.progress.connect(
         partial(progress, main_window.progress_window))
     image_worker.signals.result.connect(
@@ -977,6 +1117,7 @@ def saveRawImageData(**kwargs):
     origin = kwargs.get('origin', (0, 0, 0))
     target_z_extent = kwargs.get('target_z_extent', (0, 0))
     progress_callback = kwargs.get('progress_callback', None)
+    pyramid_cache = kwargs.get('pyramid_cache', None)
     errors = {}
     #print ("File Name", fname)
 
@@ -1015,15 +1156,8 @@ def saveRawImageData(**kwargs):
         info_var['isBigEndian'] = isBigEndian
         info_var['typcode'] = typecode
 
-    if isFortran:
-        shape = (dimX, dimY)
-    else:
-        shape = (dimY, dimX)
-    if dimensionality == 3:
-        if isFortran:
-            shape = (dimX, dimY, dimZ)
-        else:
-            shape = (dimZ, dimY, dimX)
+    volume_info = probe_raw(fname, info_var['dimensions'], typecode, isFortran, isBigEndian)
+    shape = volume_info['shape']
 
     info_var["shape"] = shape
 
@@ -1034,27 +1168,22 @@ def saveRawImageData(**kwargs):
             info_var['vol_bit_depth'] = '16'
 
     # basic sanity check
-    file_size = os.stat(fname).st_size
-
-    expected_size = 1
-    for el in shape:
-        expected_size *= el
-
-    if typecode in [0, 1]:
-        mul = 1
-    elif typecode in [2, 3]:
-        mul = 2
-    elif typecode in [4, 5, 6]:
-        mul = 4
-    else:
-        mul = 8
-    expected_size *= mul
-    if file_size != expected_size:
-        errors = {"type": "size", "file_size": file_size,
-                  "expected_size": expected_size}
+    if volume_info['file_size'] != volume_info['expected_size']:
+        errors = {"type": "size", "file_size": volume_info['file_size'],
+                  "expected_size": volume_info['expected_size']}
         return (errors)
 
+    factor = None
     if resample:
+        factor = load_from_pyramid(pyramid_cache, [fname], volume_info, output_image, target_size,
+                                   progress_callback=progress_callback)
+
+    if factor is not None:
+        reader = None
+        if info_var is not None:
+            info_var['sampled'] = True
+
+    elif resample:
         reader = cilRawResampleReader()
         reader.AddObserver(vtk.vtkCommand.ProgressEvent, partial(
             getProgress, progress_callback=progress_callback))
@@ -1120,11 +1249,9 @@ def saveRawImageData(**kwargs):
         progress_callback.emit(50)
 
         # main_window.raw_import_dialog['dialog'].reject()
-        # expects to read a MetaImage File
-        reader = vtk.vtkMetaImageReader()
-        reader.AddObserver("ErrorEvent", main_window.e)
-        reader.SetFileName(hdrfname)
-        reader.Update()
+        # the voxels are mapped from the file, not copied in memory
+        reader = None
+        load_volume_mapped(volume_info, output_image)
         progress_callback.emit(80)
 
     # TODO: fix the error reporting - with the below included this error message shows up when we have a different downsampling rate- thsi is not necessary
@@ -1135,7 +1262,8 @@ def saveRawImageData(**kwargs):
         # image_data = vtk.vtkImageData()
         # image_data = reader.GetOutput()
         # output_image.DeepCopy(image_data)
-    output_image.ShallowCopy(reader.GetOutput())
+    if reader is not None:
+        output_image.ShallowCopy(reader.GetOutput())
 
     print("Finished saving")
 
@@ -1144,6 +1272,16 @@ def saveRawImageData(**kwargs):
     # main_window.setStatusTip('Ready')
 
 
+def loadRawImage(**kwargs):
+    '''Runs saveRawImageData for a raw file whose dimensions are in info_var, returns 0 or raises
+    an error if the size of the file does not match them. Used to load raw files with a Worker
+    which reports errors like the other loaders, see createImageDataConcurrently.'''
+    errors = saveRawImageData(**kwargs)
+    if errors:
+        raise ValueError("Expected Data Size does not match File size. Expected Data size: {}b, "
+                         "File Data size: {}b".format(errors['expected_size'], errors['file_size']))
+    return 0
+
 def generateMetaImageHeader(datafname, typecode, shape, isFortran, isBigEndian, header_size=0, spacing=(1, 1, 1), origin=(0, 0, 0)):
     '''create MetaImageHeader for datafname based on the specifications in parameters'''
     # __typeDict = {'0':'MET_CHAR',    # VTK_SIGNED_CHAR,     # int8
@@ -1198,89 +1336,835 @@ def generateMetaImageHeader(datafname, typecode, shape, isFortran, isBigEndian,
     header += 'ElementDataFile = {}'.format(os.path.basename(datafname))
     return header
 
-def save_tiff_stack_as_raw(filenames: list, output_fname: str, progress_callback, start_progress, end_progress) ->None :
-    '''Converts a TIFF stack to a raw file
-    
-    if the data is not uint8 or uint16, it will be scaled to uint16'''
+# numpy types of the type codes of the raw import dialog, see generateMetaImageHeader
+RAW_TYPECODES = ['int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'float32', 'float64']
+METAIMAGE_TYPES = {'MET_CHAR': 'int8', 'MET_UCHAR': 'uint8', 'MET_SHORT': 'int16', 'MET_USHORT': 'uint16',
+                   'MET_INT': 'int32', 'MET_UINT': 'uint32', 'MET_LONG': 'int64', 'MET_ULONG': 'uint64',
+                   'MET_FLOAT': 'float32', 'MET_DOUBLE': 'float64'}
+
+def dvc_bit_depth(dtype):
+    '''Returns the vol_bit_depth of the raw file for the dvc code: 8 for 8 bit data, otherwise 16,
+    as the other types are converted to uint16'''
+    return 8 if numpy.dtype(dtype).itemsize == 1 else 16
+
+def _volume_info(file_type, shape, dtype, is_big_endian, header_length, is_fortran, data_file, compressed=False):
+    dtype = numpy.dtype(dtype)
+    return {'file_type': file_type, 'shape': tuple(int(n) for n in shape), 'dtype': dtype,
+            'isBigEndian': is_big_endian, 'header_length': header_length, 'isFortran': is_fortran,
+            'data_file': data_file, 'compressed': compressed, 'vol_bit_depth': dvc_bit_depth(dtype)}
+
+def _stored_dtype(volume_info):
+    # the dtype of raw and MetaImage files is native, their byte order is in isBigEndian
+    return volume_info['dtype'].newbyteorder('>' if volume_info['isBigEndian'] else '<')
+
+def probe_raw(filename, dimensions, typecode, isFortran, isBigEndian, header_length=0):
+    '''Returns the metadata of a raw file from the parameters of the raw import dialog.
+
+    Besides the keys of probe_volume, 'file_size' and 'expected_size' are the sizes of the
+    file and of the header and data it should contain.'''
+    if len(dimensions) == 3:
+        shape = tuple(dimensions) if isFortran else tuple(dimensions[::-1])
+    else:
+        shape = tuple(dimensions) if isFortran else (dimensions[1], dimensions[0])
+    info = _volume_info('raw', shape, RAW_TYPECODES[typecode], isBigEndian, header_length, isFortran, filename)
+    info['file_size'] = os.stat(filename).st_size
+    info['expected_size'] = header_length + int(numpy.prod(shape)) * info['dtype'].itemsize
+    return info
+
+def probe_npy(filename):
+    '''Returns the metadata of a .npy file, read from its header'''
+    with open(filename, 'rb') as f:
+        version = numpy.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+        header_length = f.tell()
+    is_big_endian = dtype.byteorder == '>' or (dtype.byteorder == '=' and sys.byteorder == 'big')
+    return _volume_info('npy', shape, dtype, is_big_endian, header_length, fortran_order, filename)
+
+def probe_metaimage(filename):
+    '''Returns the metadata of a .mha or .mhd file, read from its header'''
+    fields = {}
+    header_length = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            header_length += len(line)
+            key, _, value = line.decode('latin-1').partition('=')
+            fields[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile':
+                break
+    if 'ElementDataFile' not in fields or 'DimSize' not in fields:
+        raise ValueError("{} is not a valid MetaImage header".format(filename))
+    shape = [int(n) for n in fields['DimSize'].split()]
+    dtype = numpy.dtype(METAIMAGE_TYPES[fields.get('ElementType', 'MET_UCHAR')])
+    msb = fields.get('ElementByteOrderMSB', fields.get('BinaryDataByteOrderMSB', 'False'))
+    compressed = fields.get('CompressedData', 'False').lower() == 'true'
+    if fields['ElementDataFile'] == 'LOCAL':
+        data_file = filename
+    else:
+        data_file = os.path.join(os.path.dirname(filename), fields['ElementDataFile'])
+        header_length = int(fields.get('HeaderSize', 0))
+        if header_length == -1:
+            # the data is at the end of the file
+            header_length = os.stat(data_file).st_size - int(numpy.prod(shape)) * dtype.itemsize
+    # the first dimension varies the fastest
+    info = _volume_info('metaimage', shape, dtype, msb.lower() == 'true', header_length, True, data_file, compressed)
+    if 'ElementSpacing' in fields:
+        info['spacing'] = tuple(float(v) for v in fields['ElementSpacing'].split())
+    for key in ['Offset', 'Position', 'Origin']:
+        if key in fields:
+            info['origin'] = tuple(float(v) for v in fields[key].split())
+            break
+    return info
+
+def probe_tiff_stack(filenames):
+    '''Returns the metadata of a TIFF stack, read from the header of its first file'''
     reader = vtk.vtkTIFFReader()
     reader.SetOrientationType(1) # TopLeft
+    reader.SetFileName(filenames[0])
+    reader.UpdateInformation()
+    extent = reader.GetDataExtent()
+    shape = (extent[1] - extent[0] + 1, extent[3] - extent[2] + 1, (extent[5] - extent[4] + 1) * len(filenames))
+    dtype = numpy_support.get_numpy_array_type(reader.GetDataScalarType())
+    # the slices are decoded by the reader
+    return _volume_info('tiff', shape, dtype, sys.byteorder == 'big', None, True, None, True)
+
+def probe_hdf5(filename, dataset_path):
+    '''Returns the metadata of a dataset of an HDF5/NeXus file, without reading its data.
+
+    The header_length is the offset of the data in the file if it is stored contiguously
+    and uncompressed, otherwise None.'''
+    with h5py.File(filename, 'r') as f:
+        if dataset_path not in f:
+            raise KeyError(f"Dataset {dataset_path} not found in {filename}")
+        data = f[dataset_path]
+        offset = data.id.get_offset() if data.chunks is None else None
+        dtype = data.dtype
+        is_big_endian = dtype.byteorder == '>' or (dtype.byteorder == '=' and sys.byteorder == 'big')
+        return _volume_info('hdf5', data.shape, dtype, is_big_endian, offset, False, filename,
+                            data.compression is not None)
+
+def probe_volume(image_files, dataset_path=None):
+    '''Returns the metadata of an image volume without reading its voxels.
+
+    Parameters
+    ----------
+    image_files : list of str
+        the image file, or the files of a TIFF stack. .npy, .mha, .mhd, TIFF, .nxs, .h5 and
+        .hdf5 files are supported; use probe_raw for .raw files.
+    dataset_path : str, optional
+        path of the dataset in HDF5/NeXus files.
+
+    Returns
+    -------
+    dict with the keys:
+        file_type, shape (of the stored array), dtype (numpy.dtype), isBigEndian, header_length
+        (offset of the voxels in data_file, None if they are not stored in place), isFortran
+        (True if the first dimension varies the fastest), data_file (the file with the voxels),
+        compressed (True if the voxels are encoded in the file, e.g. TIFF or compressed HDF5)
+        and vol_bit_depth (of the raw file for the dvc code).
+    '''
+    if isinstance(image_files, str):
+        image_files = [image_files]
+    extension = os.path.splitext(image_files[0])[1].lower()
+    if len(image_files) > 1 or extension in ['.tif', '.tiff']:
+        return probe_tiff_stack(image_files)
+    if extension == '.npy':
+        return probe_npy(image_files[0])
+    if extension in ['.mha', '.mhd']:
+        return probe_metaimage(image_files[0])
+    if extension in ['.nxs', '.h5', '.hdf5']:
+        return probe_hdf5(image_files[0], dataset_path)
+    raise ValueError("Can't read the metadata of {}".format(image_files[0]))
+
+def load_volume_mapped(volume_info, output_image):
+    '''Sets the voxels of output_image to a memory map of the file of a volume, without reading them.
+
+    The map is copy-on-write, the file is never modified. It is referenced by the scalars of
+    output_image, so it is kept while the image or a shallow copy of it exists. The voxels are
+    copied if their byte order is not the native one.
+
+    Parameters
+    ----------
+    volume_info : dict
+        the metadata of the volume, see probe_volume and probe_raw.
+    output_image : vtkImageData
+
+    Returns
+    -------
+    False if the voxels are not stored in place in the file, e.g. compressed, otherwise True.
+    '''
+    if volume_info['compressed'] or volume_info['header_length'] is None:
+        return False
+    shape = volume_info['shape']
+    order = 'F' if volume_info['isFortran'] else 'C'
+    mapped = numpy.memmap(volume_info['data_file'], dtype=_stored_dtype(volume_info), mode='c',
+                          offset=volume_info['header_length'], shape=shape, order=order)
+    # a view where x varies the fastest, as in vtkImageData
+    voxels = mapped.ravel(order=order)
+    if not voxels.dtype.isnative:
+        voxels = voxels.astype(voxels.dtype.newbyteorder('='))
+    dims = list(shape if volume_info['isFortran'] else shape[::-1]) + [1] * (3 - len(shape))
+    scalars = numpy_support.numpy_to_vtk(voxels, deep=False)
+    scalars.SetName('vtkarray')
+    output_image.SetDimensions(*dims)
+    output_image.SetSpacing(*(list(volume_info.get('spacing', ())) + [1.] * 3)[:3])
+    output_image.SetOrigin(*(list(volume_info.get('origin', ())) + [0.] * 3)[:3])
+    output_image.GetPointData().SetScalars(scalars)
+    return True
+
+def read_tiff_slice(filename, readers):
+    '''Reads a TIFF file with the vtkTIFFReader of the current thread, returns a numpy array.
+
+    readers is a threading.local where the reader of each thread is kept'''
+    reader = getattr(readers, 'reader', None)
+    if reader is None:
+        reader = readers.reader = vtk.vtkTIFFReader()
+        reader.SetOrientationType(1) # TopLeft
+    reader.SetFileName(filename)
+    reader.Update()
+    return Converter.vtk2numpy(reader.GetOutput())
+
+def save_tiff_stack_as_raw(filenames: list, output_fname: str, progress_callback, start_progress, end_progress,
+                           workers=None) ->None :
+    '''Converts a TIFF stack to a raw file
     
-    # find the global min and max
-    stats = vtk.vtkImageHistogramStatistics()
-    for i,el in enumerate(filenames):
-        reader.SetFileName(el)
-        reader.Update()
-        stats.SetInputConnection(reader.GetOutputPort())
-        stats.Update()
-        if i == 0:
-            m,M = stats.GetMinimum(), stats.GetMaximum()
-        else:
-            m = stats.GetMinimum() if stats.GetMinimum() < m else m
-            M = stats.GetMaximum() if stats.GetMaximum() > M else M
-    logger.debug(f"Min: {m}, Max: {M}")
-    if M-m == 0:
-        msg = "Data is constant, cannot scale to uint16"
-        logger.error(msg)
-        raise ValueError(msg)
-
-    with open(os.path.abspath(output_fname), 'wb') as f:
-        steps = len(filenames)
-        for el in filenames:
-            reader.SetFileName(el)
-            reader.Update()
-            slice_data = Converter.vtk2numpy(reader.GetOutput())
-            if slice_data.dtype not in [numpy.uint8, numpy.uint16]:
-                # scale to uint16
-                convert_to_dtype = numpy.uint16
-                # rescale as float32
-                slice_data = slice_data.astype(numpy.float32)
-                
-                slice_data = (slice_data - m) / (M - m) * numpy.iinfo(convert_to_dtype).max 
-                # finally cast to uint16
-                slice_data = slice_data.astype(numpy.uint16)
+    if the data is not uint8 or uint16, it will be scaled to uint16.
+
+    The slices are decoded by a pool of threads, each with its own vtkTIFFReader, and
+    written at their offset in the raw file. The global min and max are only computed if the
+    data has to be scaled.'''
+    readers = threading.local()
+    first_slice = read_tiff_slice(filenames[0], readers)
+    scale = first_slice.dtype not in [numpy.uint8, numpy.uint16]
+    dtype = numpy.dtype(numpy.uint16) if scale else first_slice.dtype
+    slice_size = first_slice.size
+    steps = len(filenames) * (2 if scale else 1)
+    completed = [0, None]
+
+    def report_progress():
+        completed[0] += 1
+        value = int(start_progress + (end_progress - start_progress) * (completed[0] / steps))
+        if value != completed[1]:
+            completed[1] = value
+            progress_callback.emit(value)
+
+    def slice_range(filename):
+        slice_data = read_tiff_slice(filename, readers)
+        return numpy.nanmin(slice_data), numpy.nanmax(slice_data)
+
+    lock = threading.Lock()
+    def write_slice(index, filename, f):
+        slice_data = read_tiff_slice(filename, readers)
+        if slice_data.size != slice_size:
+            raise ValueError("{} does not have the size of the other images of the stack".format(filename))
+        if scale:
+            # rescale as float32, then cast to uint16
+            slice_data = (slice_data.astype(numpy.float32) - m) / (M - m) * numpy.iinfo(numpy.uint16).max
+        slice_data = numpy.ascontiguousarray(slice_data, dtype=dtype)
+        with lock:
+            f.seek(index * slice_size * dtype.itemsize)
             f.write(slice_data.tobytes())
-            progress_callback.emit(int(start_progress + (end_progress - start_progress) * (filenames.index(el) / steps)))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        if scale:
+            # find the global min and max
+            m, M = numpy.inf, -numpy.inf
+            for future in as_completed([executor.submit(slice_range, el) for el in filenames]):
+                slice_min, slice_max = future.result()
+                m, M = min(m, slice_min), max(M, slice_max)
+                report_progress()
+            logger.debug(f"Min: {m}, Max: {M}")
+            if M-m == 0:
+                msg = "Data is constant, cannot scale to uint16"
+                logger.error(msg)
+                raise ValueError(msg)
+
+        with open(os.path.abspath(output_fname), 'wb') as f:
+            f.truncate(len(filenames) * slice_size * dtype.itemsize)
+            futures = [executor.submit(write_slice, i, el, f) for i, el in enumerate(filenames)]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    report_progress()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
     
-def save_nxs_as_raw(nexus_file, dataset_path, raw_file):
+# approximate size of the slabs of slices read by each worker when converting HDF5 files, in bytes
+HDF5_SLAB_BYTES = 64 * 1024**2
+# maximum number of slabs converted ahead of the one being written, which bounds the memory used
+HDF5_PENDING_SLABS = 4
+
+def hdf5_chunk_filters(data):
+    '''Returns the filters of the chunks of an HDF5 dataset if they can be decoded with zlib and numpy,
+    i.e. deflate and shuffle, otherwise None'''
+    if data.chunks is None:
+        return None
+    plist = data.id.get_create_plist()
+    filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+    if not all(code in [h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE] for code in filters):
+        return None
+    return filters
+
+def hdf5_slab_size(data):
+    '''Returns the number of slices along the first axis read at a time, a multiple of the chunk size'''
+    slice_bytes = max(int(numpy.prod(data.shape[1:])) * data.dtype.itemsize, 1)
+    step = data.chunks[0] if data.chunks is not None else 1
+    return step * max(HDF5_SLAB_BYTES // (step * slice_bytes), 1)
+
+def read_hdf5_slab(data, start, stop, filters=None):
+    '''Returns data[start:stop] of an HDF5 dataset.
+
+    If filters is given, see hdf5_chunk_filters, the raw chunks are read and decompressed
+    in the calling thread, so that several threads can decompress at the same time. start
+    must be a multiple of the chunk size along the first axis.'''
+    if filters is None:
+        return data[start:stop]
+    chunks = data.chunks
+    slab = numpy.empty((stop - start,) + data.shape[1:], dtype=data.dtype)
+    for offset in itertools.product(range(start, stop, chunks[0]),
+                                    *[range(0, n, c) for n, c in zip(data.shape[1:], chunks[1:])]):
+        region = tuple(slice(o, min(o + c, n)) for o, c, n in zip(offset, chunks, data.shape))
+        target = (slice(region[0].start - start, region[0].stop - start),) + region[1:]
+        try:
+            filter_mask, chunk_bytes = data.id.read_direct_chunk(offset)
+        except (KeyError, ValueError, OSError, RuntimeError):
+            # the chunk was never written, it has the fill value
+            slab[target] = data[region]
+            continue
+        for i, code in reversed(list(enumerate(filters))):
+            if filter_mask & (1 << i):
+                continue
+            if code == h5py.h5z.FILTER_DEFLATE:
+                chunk_bytes = zlib.decompress(chunk_bytes)
+            else:
+                chunk_bytes = numpy.frombuffer(chunk_bytes, numpy.uint8).reshape(data.dtype.itemsize, -1).T.tobytes()
+        chunk = numpy.frombuffer(chunk_bytes, dtype=data.dtype).reshape(chunks)
+        slab[target] = chunk[tuple(slice(0, r.stop - r.start) for r in region)]
+    return slab
+
+def hdf5_attribute_range(data):
+    '''Returns the min and max of a dataset stored in its attributes, or None'''
+    for low, high in [('min', 'max'), ('minimum', 'maximum'), ('valid_min', 'valid_max')]:
+        if low in data.attrs and high in data.attrs:
+            return float(numpy.ravel(data.attrs[low])[0]), float(numpy.ravel(data.attrs[high])[0])
+    if 'actual_range' in data.attrs:
+        values = numpy.ravel(data.attrs['actual_range'])
+        if len(values) == 2:
+            return float(values[0]), float(values[1])
+    return None
+
+def scale_to_uint16(voxels, m, M):
+    '''Returns voxels scaled from the range m, M to uint16.
+
+    NaNs, and values outside of the range, e.g. given by the attributes of an HDF5 dataset,
+    are mapped to 0 and 65535 instead of wrapping around when cast.'''
+    dtype_max = numpy.iinfo(numpy.uint16).max
+    scaled = ((voxels.astype(numpy.float32) - m) / (M - m)) * dtype_max
+    numpy.nan_to_num(scaled, copy=False, nan=0, posinf=dtype_max, neginf=0)
+    numpy.clip(scaled, 0, dtype_max, out=scaled)
+    return scaled.astype(numpy.uint16)
+
+def save_nxs_as_raw(nexus_file, dataset_path, raw_file, progress_callback=None, start_progress=0, end_progress=100,
+                    workers=None):
     """
     Converts a NeXus (.nxs) file to a raw binary file using the dataset path stored in 'dataset_path'.
     If the dataset is not uint8 or uint16, it will be scaled to uint16.
 
+    The dataset is read in slabs of slices aligned to its chunks. Chunks compressed with deflate
+    and shuffle are decompressed by a pool of threads, and the slabs are written in order. To scale
+    the data, the min and max are taken from the attributes of the dataset if present, otherwise
+    they are computed in a first pass.
+
     Parameters:
     -----------
     nexus_file: Path to the input NeXus file.
     dataset_path: str
         Internal path in the NeXus file to the dataset.
     raw_file: Path to the output RAW file.
+    progress_callback: optional, emits the progress from start_progress to end_progress.
+    workers: int, optional
+        number of threads, by default the number of CPUs.
     """
     with h5py.File(nexus_file, "r") as f:
         if dataset_path not in f:
             raise ValueError(f"Dataset '{dataset_path}' not found in {nexus_file}.")
         data = f[dataset_path]
         original_dtype = data.dtype
-
-        if original_dtype in [numpy.uint8, numpy.uint16]:
-            with open(os.path.abspath(raw_file), 'wb') as f:
-                for i in range(data.shape[0]):
-                    slice_data = data[i:i+1] 
-                    slice_data.tofile(f)
-            return
-        
-        else:
-            for i in range(data.shape[0]):
-                slice_data = data[i:i+1]
-                if i == 0:
-                    m, M = numpy.nanmin(slice_data), numpy.nanmax(slice_data)
+        scale = original_dtype not in [numpy.uint8, numpy.uint16]
+        filters = hdf5_chunk_filters(data)
+        step = hdf5_slab_size(data)
+        slabs = [(start, min(start + step, data.shape[0])) for start in range(0, data.shape[0], step)]
+        data_range = hdf5_attribute_range(data) if scale else None
+        steps = len(slabs) * (2 if scale and data_range is None else 1)
+        completed = [0]
+
+        def report_progress():
+            completed[0] += 1
+            if progress_callback is not None:
+                progress_callback.emit(int(start_progress + (end_progress - start_progress) * completed[0] / steps))
+
+        def slab_range(slab):
+            slab_data = read_hdf5_slab(data, slab[0], slab[1], filters)
+            return numpy.nanmin(slab_data), numpy.nanmax(slab_data)
+
+        def convert_slab(slab):
+            slab_data = read_hdf5_slab(data, slab[0], slab[1], filters)
+            if scale:
+                slab_data = scale_to_uint16(slab_data, m, M)
+            return slab_data
+
+        workers = workers or os.cpu_count()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            if scale:
+                if data_range is None:
+                    m, M = numpy.inf, -numpy.inf
+                    for future in as_completed([executor.submit(slab_range, slab) for slab in slabs]):
+                        slab_min, slab_max = future.result()
+                        m, M = min(m, slab_min), max(M, slab_max)
+                        report_progress()
                 else:
-                    m = min(m, numpy.nanmin(slice_data))
-                    M = max(M, numpy.nanmax(slice_data))
-            if M - m == 0:
-                raise ValueError("Data is constant, cannot scale to uint16")
-        
-            convert_to_dtype = numpy.uint16
-            with open(os.path.abspath(raw_file), 'wb') as f:
-                for i in range(data.shape[0]):
-                    slice_data = data[i:i+1]
-                    slice_data = ((slice_data.astype(numpy.float32) - m) / (M - m)) * numpy.iinfo(convert_to_dtype).max
-                    slice_data.astype(numpy.uint16).tofile(f)  
-    
\ No newline at end of file
+                    m, M = data_range
+                if M - m == 0:
+                    raise ValueError("Data is constant, cannot scale to uint16")
+
+            with open(os.path.abspath(raw_file), 'wb') as raw:
+                # at most HDF5_PENDING_SLABS slabs are converted ahead, and written in order
+                pending = collections.deque()
+                for slab in slabs:
+                    pending.append(executor.submit(convert_slab, slab))
+                    if len(pending) >= HDF5_PENDING_SLABS:
+                        pending.popleft().result().tofile(raw)
+                        report_progress()
+                while pending:
+                    pending.popleft().result().tofile(raw)
+                    report_progress()
+
+# size of the blocks of compressed MetaImage files read at a time, in bytes
+COMPRESSED_BLOCK_BYTES = 4 * 1024**2
+
+def iter_volume_slabs(image_files, volume_info, dataset_path=None, depth=8):
+    '''Yields the voxels of a volume in slabs of slices along z, as arrays indexed z, y, x.
+
+    Mapped and compressed volumes are read depth slices at a time, HDF5 datasets in slabs aligned
+    to their chunks and TIFF stacks one file at a time, the files being decoded ahead by a
+    pool of threads.
+
+    Parameters
+    ----------
+    image_files : list of str
+        the image file, or the files of a TIFF stack.
+    volume_info : dict
+        the metadata of the volume, see probe_volume and probe_raw.
+    '''
+    shape = volume_info['shape']
+    nx, ny, nz = shape if volume_info['isFortran'] else shape[::-1]
+    if volume_info['file_type'] == 'tiff':
+        readers = threading.local()
+        workers = os.cpu_count()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for filename in image_files:
+                pending.append(executor.submit(read_tiff_slice, filename, readers))
+                if len(pending) > 2 * workers:
+                    yield pending.popleft().result().reshape(-1, ny, nx)
+            while pending:
+                yield pending.popleft().result().reshape(-1, ny, nx)
+    elif volume_info['file_type'] == 'hdf5':
+        with h5py.File(image_files[0], 'r') as f:
+            data = f[dataset_path]
+            filters = hdf5_chunk_filters(data)
+            step = hdf5_slab_size(data)
+            for start in range(0, data.shape[0], step):
+                yield read_hdf5_slab(data, start, min(start + step, data.shape[0]), filters)
+    elif volume_info['compressed']:
+        # the zlib stream of a compressed MetaImage file is decoded a slab at a time
+        dtype = _stored_dtype(volume_info)
+        slab_bytes = depth * ny * nx * dtype.itemsize
+        decompressor = zlib.decompressobj()
+        pending = bytearray()
+        with open(volume_info['data_file'], 'rb') as f:
+            f.seek(volume_info['header_length'])
+            while True:
+                data = decompressor.unconsumed_tail or f.read(COMPRESSED_BLOCK_BYTES)
+                if not data:
+                    break
+                pending += decompressor.decompress(data, slab_bytes - len(pending))
+                if len(pending) == slab_bytes:
+                    yield numpy.frombuffer(bytes(pending), dtype=dtype).reshape(-1, ny, nx)
+                    pending = bytearray()
+        pending += decompressor.flush()
+        if len(pending) != (nz % depth) * ny * nx * dtype.itemsize:
+            raise ValueError("{} does not have the voxels of its header".format(volume_info['data_file']))
+        if pending:
+            yield numpy.frombuffer(bytes(pending), dtype=dtype).reshape(-1, ny, nx)
+    else:
+        order = 'F' if volume_info['isFortran'] else 'C'
+        mapped = numpy.memmap(volume_info['data_file'], dtype=_stored_dtype(volume_info), mode='r',
+                              offset=volume_info['header_length'], shape=shape, order=order)
+        # indexed z, y, x in both orders
+        voxels = mapped.T if volume_info['isFortran'] else mapped
+        for start in range(0, nz, depth):
+            yield numpy.asarray(voxels[start:start + depth])
+        del voxels, mapped
+
+def save_volume_as_raw(image_file, raw_file, dtype, progress_callback=None, start_progress=0, end_progress=100):
+    '''Converts a .npy or MetaImage file to a raw file with x varying the fastest, e.g. when the
+    dvc executable can't read it in place.
+
+    The voxels are read in slabs, see iter_volume_slabs, so compressed files are decoded as a
+    stream. They are cast to dtype, which sets the byte order of the raw file. If dtype is uint8
+    or uint16 and the voxels are of another type, they are scaled to uint16, the min and max
+    being computed in a first pass.'''
+    volume_info = probe_volume([image_file])
+    dtype = numpy.dtype(dtype)
+    shape = volume_info['shape']
+    nz = shape[-1] if volume_info['isFortran'] else shape[0]
+    scale = dtype.name in ['uint8', 'uint16'] and volume_info['dtype'] not in [numpy.uint8, numpy.uint16]
+    if scale:
+        dtype = numpy.dtype(numpy.uint16).newbyteorder(dtype.byteorder)
+    steps = nz * (2 if scale else 1)
+    completed = [0]
+
+    def report_progress(slab):
+        completed[0] += len(slab)
+        if progress_callback is not None:
+            progress_callback.emit(int(start_progress + (end_progress - start_progress) * completed[0] / steps))
+
+    if scale:
+        m, M = numpy.inf, -numpy.inf
+        for slab in iter_volume_slabs([image_file], volume_info):
+            m, M = min(m, numpy.nanmin(slab)), max(M, numpy.nanmax(slab))
+            report_progress(slab)
+        if M - m == 0:
+            raise ValueError("Data is constant, cannot scale to uint16")
+    with open(os.path.abspath(raw_file), 'wb') as f:
+        for slab in iter_volume_slabs([image_file], volume_info):
+            if scale:
+                slab = scale_to_uint16(slab, m, M)
+            numpy.asarray(slab, dtype=dtype).tofile(f)
+            report_progress(slab)
+
+def get_pyramid_cache(main_window):
+    '''Returns the user level cache of the pyramids of the volumes, or None if it is disabled
+    in the settings, with 'pyramid_cache_size' in GB'''
+    settings = getattr(main_window, 'settings', None)
+    size = settings.value('pyramid_cache_size') if settings is not None else None
+    if size is None or float(size) <= 0:
+        return None
+    return FileCache(user_cache_dir('pyramids'), int(float(size) * 1024**3))
+
+def build_volume_pyramid(image_files, volume_info, folder, dataset_path=None, progress_callback=None,
+                         start_progress=0, end_progress=100):
+    '''Writes the pyramid of a volume in folder, see idvc.utils.pyramid. Returns the names of its files'''
+    shape = volume_info['shape']
+    dims = shape if volume_info['isFortran'] else shape[::-1]
+    writer = PyramidWriter(folder, dims, volume_info['dtype'])
+    done = 0
+    try:
+        for slab in iter_volume_slabs(image_files, volume_info, dataset_path):
+            writer.add_slab(slab)
+            done += slab.shape[0]
+            if progress_callback is not None:
+                progress_callback.emit(int(start_progress + (end_progress - start_progress) * done / dims[2]))
+    finally:
+        files = writer.close()
+    return files
+
+def binned_geometry(volume_info, factor):
+    '''Returns the spacing and origin of a volume binned by factor: the spacing is multiplied by the
+    factor and the origin is the centre of the first block of voxels'''
+    spacing = (list(volume_info.get('spacing', ())) + [1.] * 3)[:3]
+    origin = (list(volume_info.get('origin', ())) + [0.] * 3)[:3]
+    return [s * factor for s in spacing], [o + s * (factor - 1) / 2 for o, s in zip(origin, spacing)]
+
+def binning_factor(dims, itemsize, target_size):
+    '''Returns the smallest binning factor of a volume of dimensions dims which fits in target_size bytes'''
+    factor = 1
+    while factor < max(dims) and int(numpy.prod([int(d) // factor for d in dims])) * itemsize > target_size:
+        factor += 1
+    return factor
+
+def read_tiff_stack_binned(filenames, output_image, target_size, progress_callback=None, start_progress=0,
+                           end_progress=100, workers=None, cancel_event=None):
+    '''Reads a TIFF stack binned by the smallest factor which fits in target_size bytes.
+
+    The files are decoded in groups of whole blocks of slices by a pool of threads, each thread
+    averaging the blocks of factor**3 voxels of its group with bin_slab, and the binned slabs are
+    written at their place in the output as they arrive. At most 2 groups per thread are read
+    ahead. As in the pyramid, the remainder of the volume is cropped and integers are rounded,
+    the spacing and origin are given by binned_geometry.
+
+    Parameters
+    ----------
+    filenames : list of str
+        the files of the stack, in order.
+    output_image : vtkImageData
+    target_size : int
+        the maximum size of the output in bytes.
+    workers : int, optional
+        the number of threads, by default the number of cores.
+    cancel_event : threading.Event, optional
+        the reading stops as soon as possible once it is set.
+
+    Returns
+    -------
+    The binning factor, or None if the reading was cancelled.
+    '''
+    volume_info = probe_tiff_stack(filenames)
+    nx, ny, nz = volume_info['shape']
+    dtype = volume_info['dtype']
+    factor = binning_factor((nx, ny, nz), dtype.itemsize, target_size)
+    slices_per_file = nz // len(filenames)
+    # the groups of files start at a block of slices
+    files_per_group = factor // math.gcd(factor, slices_per_file)
+    binned = numpy.empty((nz // factor, ny // factor, nx // factor), dtype=dtype)
+    readers = threading.local()
+
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    def read_group(start):
+        if cancelled():
+            return 0
+        slab = numpy.concatenate([read_tiff_slice(filename, readers).reshape(-1, ny, nx)
+                                  for filename in filenames[start:start + files_per_group]])
+        decoded = slab.shape[0]
+        blocks = decoded // factor
+        z = start * slices_per_file // factor
+        if factor == 1:
+            binned[z:z + blocks] = slab
+        elif blocks > 0:
+            slab = bin_slab(slab[:blocks * factor], factor)
+            binned[z:z + blocks] = numpy.rint(slab) if numpy.issubdtype(dtype, numpy.integer) else slab
+        return decoded
+
+    done = [0, None]
+    def wait_next(pending):
+        done[0] += pending.popleft().result()
+        value = int(start_progress + (end_progress - start_progress) * done[0] / nz)
+        if progress_callback is not None and value != done[1]:
+            done[1] = value
+            progress_callback.emit(value)
+
+    workers = workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        try:
+            for start in range(0, len(filenames), files_per_group):
+                if cancelled():
+                    break
+                pending.append(executor.submit(read_group, start))
+                if len(pending) > 2 * workers:
+                    wait_next(pending)
+            while pending:
+                wait_next(pending)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+    if cancelled():
+        return None
+
+    scalars = numpy_support.numpy_to_vtk(binned.ravel(), deep=False)
+    scalars.SetName('vtkarray')
+    spacing, origin = binned_geometry(volume_info, factor)
+    output_image.SetDimensions(*binned.shape[::-1])
+    output_image.SetSpacing(*spacing)
+    output_image.SetOrigin(*origin)
+    output_image.GetPointData().SetScalars(scalars)
+    return factor
+
+def load_from_pyramid(pyramid_cache, image_files, volume_info, output_image, target_size, dataset_path=None,
+                      progress_callback=None):
+    '''Loads the level of the pyramid of a volume which fits in target_size in output_image.
+
+    The pyramid is built and stored in pyramid_cache the first time, reading the volume once;
+    afterwards the level is memory mapped from the cache, whatever the target size. The spacing of
+    the level is the binning factor, and its origin the centre of the first block of voxels.
+
+    Parameters
+    ----------
+    pyramid_cache : FileCache or None
+        the cache of the pyramids, see get_pyramid_cache.
+    target_size : float
+        the maximum size of the loaded image in GB.
+
+    Returns
+    -------
+    The binning factor of the level, or None if the volume must be read otherwise: the cache is
+    disabled or too small, the volume fits in target_size or its coarsest level does not.
+    '''
+    if pyramid_cache is None:
+        return None
+    shape = volume_info['shape']
+    dims = shape if volume_info['isFortran'] else shape[::-1]
+    itemsize = volume_info['dtype'].itemsize
+    factor = choose_level(dims, itemsize, target_size * 1024**3)
+    if factor is None or factor == 1 or pyramid_size(dims, itemsize) > pyramid_cache.max_size:
+        return None
+    key = pyramid_key(image_files, dataset_path)
+    files = pyramid_cache.get(key)
+    if files is None:
+        folder = tempfile.mkdtemp(dir=pyramid_cache.folder)
+        try:
+            names = build_volume_pyramid(image_files, volume_info, folder, dataset_path, progress_callback, 0, 70)
+            pyramid_cache.put(key, {name: os.path.join(folder, name) for name in names}, link=True)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        files = pyramid_cache.get(key)
+        if files is None:
+            return None
+    pyramid = read_pyramid(files[PYRAMID_FILENAME])
+    level_info = _volume_info('raw', pyramid['levels'][factor], pyramid['dtype'], False, 0, True,
+                              files[level_filename(factor)])
+    level_info['spacing'], level_info['origin'] = binned_geometry(volume_info, factor)
+    load_volume_mapped(level_info, output_image)
+    if progress_callback is not None:
+        progress_callback.emit(80)
+    return factor
+
+# edge of the cubic chunks of the chunked volumes of the sessions, in voxels
+CHUNKED_VOLUME_CHUNK = 64
+CHUNKED_VOLUME_DATASET = 'volume'
+
+def probe_image(image_files, image_info=None, dataset_path=None):
+    '''Returns the metadata of an image volume, see probe_volume. The dimensions of .raw files
+    are taken from image_info, as filled by the raw import dialog.'''
+    if len(image_files) == 1 and image_files[0].lower().endswith('.raw'):
+        return probe_raw(image_files[0], image_info['dimensions'], image_info['typcode'],
+                         image_info['isFortran'], image_info['isBigEndian'])
+    return probe_volume(image_files, dataset_path)
+
+def chunked_volume_is_current(filename, image_files, dataset_path=None):
+    '''Returns True if filename is a chunked volume written from the current image files'''
+    try:
+        with h5py.File(filename, 'r') as f:
+            source = f[CHUNKED_VOLUME_DATASET].attrs.get('source')
+    except (OSError, KeyError):
+        return False
+    return source == stat_fingerprint(image_files, dataset_path=dataset_path)
+
+def write_chunked_volume(image_files, volume_info, filename, dataset_path=None, compression='lzf',
+                         progress_callback=None, start_progress=0, end_progress=100):
+    '''Writes an image volume to an HDF5 file with cubic chunks, so that boxes of voxels can
+    be read touching only the chunks they intersect, see read_volume_box.
+
+    The volume is read once in slabs, see iter_volume_slabs, and written a layer of chunks at
+    a time. The dataset, indexed z, y, x, has the type of the volume and records the fingerprint
+    of the image files it was written from.
+
+    Parameters
+    ----------
+    compression : str, default 'lzf'
+        HDF5 filter of the chunks, e.g. 'lzf', 'gzip' or None.
+    '''
+    shape = volume_info['shape']
+    nx, ny, nz = shape if volume_info['isFortran'] else shape[::-1]
+    dtype = volume_info['dtype'].newbyteorder('=')
+    chunks = tuple(min(CHUNKED_VOLUME_CHUNK, n) for n in (nz, ny, nx))
+    tmp_filename = "{}.tmp{}".format(filename, os.getpid())
+    try:
+        with h5py.File(tmp_filename, 'w') as f:
+            data = f.create_dataset(CHUNKED_VOLUME_DATASET, shape=(nz, ny, nx), dtype=dtype, chunks=chunks,
+                                    compression=compression)
+            data.attrs['source'] = stat_fingerprint(image_files, dataset_path=dataset_path)
+            # the chunks are written a whole layer at a time, so that each is compressed once
+            pending, start = [], 0
+            for slab in iter_volume_slabs(image_files, volume_info, dataset_path):
+                pending.append(numpy.asarray(slab, dtype=dtype))
+                buffered = sum(len(s) for s in pending)
+                if buffered < chunks[0]:
+                    continue
+                voxels = numpy.concatenate(pending)
+                count = buffered // chunks[0] * chunks[0]
+                data[start:start + count] = voxels[:count]
+                start += count
+                pending = [voxels[count:]]
+                if progress_callback is not None:
+                    progress_callback.emit(int(start_progress + (end_progress - start_progress) * start / nz))
+            if start < nz:
+                data[start:] = numpy.concatenate(pending)
+    except BaseException:
+        # a partial file is as large as the volume
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+def read_volume_box(filename, extent):
+    '''Returns the voxels of a chunked volume in a box, as an array indexed z, y, x.
+
+    Only the chunks which intersect the box are read and decompressed.
+
+    Parameters
+    ----------
+    filename : str
+        a chunked volume, see write_chunked_volume.
+    extent : list of int
+        the box, x0, x1, y0, y1, z0, z1, inclusive as a VTK extent. It is clipped to the volume.
+
+    Returns
+    -------
+    The voxels and the clipped extent.
+    '''
+    with h5py.File(filename, 'r') as f:
+        data = f[CHUNKED_VOLUME_DATASET]
+        nz, ny, nx = data.shape
+        clipped = []
+        for (low, high), n in zip([extent[0:2], extent[2:4], extent[4:6]], (nx, ny, nz)):
+            clipped += [max(int(low), 0), min(int(high), n - 1)]
+        x0, x1, y0, y1, z0, z1 = clipped
+        return data[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1], clipped
+
+def loadVolumeBox(**kwargs):
+    '''Loads a box of voxels of a full resolution image volume in output_image, from the chunked
+    volume of the session, which is written from the image files if it is missing or outdated.
+
+    The extent of output_image is the box, so its voxels keep the indices they have in the volume.
+
+    Parameters
+    ----------
+    **kwargs : dict
+        - image_files (list): the image file, or the files of a TIFF stack.
+        - output_image (vtkImageData): The VTK image object where the output will be stored.
+        - chunked_volume (str): the chunked volume of the image files.
+        - target_extent (list): the box, x0, x1, y0, y1, z0, z1.
+        - image_info (dict, optional): A dictionary to store metadata about the image.
+        - dataset_path (str, optional): path of the dataset in HDF5/NeXus files.
+        - progress_callback (callable, optional): Function to emit progress updates.
+    '''
+    image_files = kwargs.get('image_files')
+    output_image = kwargs.get('output_image')
+    chunked_volume = kwargs.get('chunked_volume')
+    image_info = kwargs.get('image_info', None)
+    dataset_path = kwargs.get('dataset_path', None)
+    progress_callback = kwargs.get('progress_callback', None)
+
+    volume_info = probe_image(image_files, image_info, dataset_path)
+    if not chunked_volume_is_current(chunked_volume, image_files, dataset_path):
+        os.makedirs(os.path.dirname(os.path.abspath(chunked_volume)), exist_ok=True)
+        write_chunked_volume(image_files, volume_info, chunked_volume, dataset_path,
+                             progress_callback=progress_callback, start_progress=0, end_progress=80)
+    voxels, extent = read_volume_box(chunked_volume, kwargs.get('target_extent'))
+    if progress_callback is not None:
+        progress_callback.emit(90)
+
+    scalars = numpy_support.numpy_to_vtk(voxels.ravel(), deep=True)
+    scalars.SetName('vtkarray')
+    output_image.SetExtent(*extent)
+    output_image.GetPointData().SetScalars(scalars)
+
+    shape = volume_info['shape']
+    if image_info is not None:
+        image_info['shape'] = shape if volume_info['isFortran'] else shape[::-1]
+        image_info['vol_bit_depth'] = volume_info['vol_bit_depth']
+        image_info['isBigEndian'] = volume_info['isBigEndian']
+        image_info['sampled'] = False
+        image_info['cropped'] = True
+    if progress_callback is not None:
+        progress_callback.emit(100)
+    return 0
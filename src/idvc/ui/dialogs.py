@@ -84,9 +84,140 @@ class SettingsWindow(FormDialog):
         self.omp_threads_entry.setRange(1, n_cores)
         self.omp_threads_entry.setSingleStep(1)
         self.omp_threads_label = QLabel("OMP Threads: ")
+        self.omp_threads_entry.setToolTip("Total number of threads used by the DVC runs.\n"
+            "They are split between the runs executed at the same time.")
 
         self.addWidget(self.omp_threads_entry, self.omp_threads_label, 'use_omp')
 
+        self.dvc_processes_entry = QSpinBox(self)
+        self.dvc_processes_entry.setRange(1, n_cores)
+        self.dvc_processes_entry.setSingleStep(1)
+        if self.parent.settings.value("dvc_processes") is not None:
+            self.dvc_processes_entry.setValue(int(self.parent.settings.value("dvc_processes")))
+        else:
+            self.dvc_processes_entry.setValue(1)
+        self.dvc_processes_label = QLabel("Concurrent DVC runs: ")
+        self.dvc_processes_entry.setToolTip("Maximum number of configurations of a bulk run executed at the same time.")
+
+        self.addWidget(self.dvc_processes_entry, self.dvc_processes_label, 'dvc_processes')
+
+        self.dvc_shards_entry = QSpinBox(self)
+        self.dvc_shards_entry.setRange(1, n_cores)
+        self.dvc_shards_entry.setSingleStep(1)
+        if self.parent.settings.value("dvc_shards") is not None:
+            self.dvc_shards_entry.setValue(int(self.parent.settings.value("dvc_shards")))
+        else:
+            self.dvc_shards_entry.setValue(1)
+        self.dvc_shards_label = QLabel("Point cloud shards per run: ")
+        self.dvc_shards_entry.setToolTip("Number of spatially coherent parts each point cloud is split into.\n"
+            "Each part is run as a separate process and the results are merged at the end of the run.")
+
+        self.addWidget(self.dvc_shards_entry, self.dvc_shards_label, 'dvc_shards')
+
+        self.result_cache_entry = QDoubleSpinBox(self)
+        self.result_cache_entry.setRange(0.0, 1024.0)
+        self.result_cache_entry.setSingleStep(0.5)
+        if self.parent.settings.value("result_cache_size") is not None:
+            self.result_cache_entry.setValue(float(self.parent.settings.value("result_cache_size")))
+        else:
+            self.result_cache_entry.setValue(0.0)
+        self.result_cache_label = QLabel("Result cache size (GB): ")
+        self.result_cache_entry.setToolTip("Results of the DVC runs are kept in a cache in the user folder.\n"
+            "Runs with the same images, point cloud and parameters take the results from the cache.\n"
+            "Set to 0 to disable the cache.")
+
+        self.addWidget(self.result_cache_entry, self.result_cache_label, 'result_cache_size')
+
+        self.volume_cache_entry = QDoubleSpinBox(self)
+        self.volume_cache_entry.setRange(0.0, 4096.0)
+        self.volume_cache_entry.setSingleStep(1.0)
+        if self.parent.settings.value("volume_cache_size") is not None:
+            self.volume_cache_entry.setValue(float(self.parent.settings.value("volume_cache_size")))
+        else:
+            self.volume_cache_entry.setValue(0.0)
+        self.volume_cache_label = QLabel("Converted volume cache size (GB): ")
+        self.volume_cache_entry.setToolTip("TIFF stacks and HDF5/NeXus files converted to raw for the DVC runs are kept in a cache\n"
+            "in the user folder, and reused by the sessions on the same files.\n"
+            "Set to 0 to disable the cache.")
+
+        self.addWidget(self.volume_cache_entry, self.volume_cache_label, 'volume_cache_size')
+
+        self.pyramid_cache_entry = QDoubleSpinBox(self)
+        self.pyramid_cache_entry.setRange(0.0, 4096.0)
+        self.pyramid_cache_entry.setSingleStep(1.0)
+        if self.parent.settings.value("pyramid_cache_size") is not None:
+            self.pyramid_cache_entry.setValue(float(self.parent.settings.value("pyramid_cache_size")))
+        else:
+            self.pyramid_cache_entry.setValue(0.0)
+        self.pyramid_cache_label = QLabel("Image pyramid cache size (GB): ")
+        self.pyramid_cache_entry.setToolTip("The images are binned by 2, 4 and 8 the first time they are displayed, and the\n"
+            "binned images are kept in a cache in the user folder. The image is then displayed from the\n"
+            "binned image which fits in the maximum visualisation size, without reading the full image.\n"
+            "Set to 0 to disable the cache.")
+
+        self.addWidget(self.pyramid_cache_entry, self.pyramid_cache_label, 'pyramid_cache_size')
+
+        self.chunked_volumes_checkbox = QCheckBox("Store the images in chunks in the session")
+        self.chunked_volumes_checkbox.setToolTip("The first time a full resolution region of the images is needed, e.g. for the registration,\n"
+            "the images are written in the session folder in compressed 64x64x64 chunks.\n"
+            "The regions are then read from the chunks they intersect, instead of whole slices of the images.")
+        self.chunked_volumes_checkbox.setChecked(self.parent.settings.value("chunked_volumes") == "true")
+        self.addWidget(self.chunked_volumes_checkbox, '', 'chunked_volumes')
+
+        self.coarse_to_fine_entry = QComboBox(self)
+        self.coarse_to_fine_entry.addItem("Off", 1)
+        self.coarse_to_fine_entry.addItem("Binning 2", 2)
+        self.coarse_to_fine_entry.addItem("Binning 4", 4)
+        if self.parent.settings.value("coarse_to_fine") is not None:
+            index = self.coarse_to_fine_entry.findData(int(self.parent.settings.value("coarse_to_fine")))
+            self.coarse_to_fine_entry.setCurrentIndex(max(index, 0))
+        self.coarse_to_fine_label = QLabel("Coarse-to-fine: ")
+        self.coarse_to_fine_entry.setToolTip("Runs the DVC code on binned volumes with a sparse point cloud first.\n"
+            "The coarse displacements give the rigid body offset of each region of the point cloud,\n"
+            "so the full resolution runs search a smaller range.")
+        self.addWidget(self.coarse_to_fine_entry, self.coarse_to_fine_label, 'coarse_to_fine')
+
+        self.coarse_regions_entry = QSpinBox(self)
+        self.coarse_regions_entry.setRange(1, 512)
+        self.coarse_regions_entry.setSingleStep(1)
+        if self.parent.settings.value("coarse_regions") is not None:
+            self.coarse_regions_entry.setValue(int(self.parent.settings.value("coarse_regions")))
+        else:
+            self.coarse_regions_entry.setValue(8)
+        self.coarse_regions_label = QLabel("Coarse-to-fine regions: ")
+        self.coarse_regions_entry.setToolTip("Number of regions of the point cloud with their own rigid body offset.")
+        self.addWidget(self.coarse_regions_entry, self.coarse_regions_label, 'coarse_regions')
+
+        self.adaptive_sweep_checkbox = QCheckBox("Adaptive bulk sweep")
+        self.adaptive_sweep_checkbox.setToolTip("The configurations of a bulk run are first run on a sample of the points,\n"
+            "and only the best half is run again on twice as many points, until the configurations left\n"
+            "are run on the full point cloud. Not used with coarse-to-fine.\n"
+            "Only the configurations kept are listed in the results, the others are in the sweep folder of the run.")
+        self.adaptive_sweep_checkbox.setChecked(self.parent.settings.value("adaptive_sweep") == "true")
+        self.addWidget(self.adaptive_sweep_checkbox, '', 'adaptive_sweep')
+
+        self.sweep_sample_points_entry = QSpinBox(self)
+        self.sweep_sample_points_entry.setRange(10, 100000)
+        self.sweep_sample_points_entry.setSingleStep(50)
+        if self.parent.settings.value("sweep_sample_points") is not None:
+            self.sweep_sample_points_entry.setValue(int(self.parent.settings.value("sweep_sample_points")))
+        else:
+            self.sweep_sample_points_entry.setValue(200)
+        self.sweep_sample_points_label = QLabel("Adaptive sweep sample points: ")
+        self.sweep_sample_points_entry.setToolTip("Number of points of the first round of the adaptive bulk sweep.")
+        self.addWidget(self.sweep_sample_points_entry, self.sweep_sample_points_label, 'sweep_sample_points')
+
+        self.dvc_autotune_checkbox = QCheckBox("Autotune the DVC processes and threads")
+        self.dvc_autotune_checkbox.setToolTip("Before the first run with a volume size on this machine, the DVC code is run\n"
+            "on a sample of points with several numbers of processes and threads, and the fastest is used\n"
+            "instead of the OMP threads and concurrent DVC runs above.")
+        self.dvc_autotune_checkbox.setChecked(self.parent.settings.value("dvc_autotune") == "true")
+        self.addWidget(self.dvc_autotune_checkbox, '', 'dvc_autotune')
+
+        self.clear_autotune_button = QPushButton("Clear autotuned layouts")
+        self.clear_autotune_button.clicked.connect(self.clearAutotune)
+        self.addWidget(self.clear_autotune_button, '', 'clear_autotune')
+
 
     def onOk(self):
         default_font_family = PySide2.QtWidgets.QApplication.font().family() 
@@ -113,10 +244,25 @@ class SettingsWindow(FormDialog):
             self.parent.settings.setValue("first_app_load", "False")
             
         self.parent.settings.setValue("omp_threads", str(self.omp_threads_entry.value()))
+        self.parent.settings.setValue("dvc_processes", str(self.dvc_processes_entry.value()))
+        self.parent.settings.setValue("dvc_shards", str(self.dvc_shards_entry.value()))
+        self.parent.settings.setValue("result_cache_size", str(self.result_cache_entry.value()))
+        self.parent.settings.setValue("volume_cache_size", str(self.volume_cache_entry.value()))
+        self.parent.settings.setValue("pyramid_cache_size", str(self.pyramid_cache_entry.value()))
+        self.parent.settings.setValue("chunked_volumes", "true" if self.chunked_volumes_checkbox.isChecked() else "false")
+        self.parent.settings.setValue("coarse_to_fine", str(self.coarse_to_fine_entry.currentData()))
+        self.parent.settings.setValue("coarse_regions", str(self.coarse_regions_entry.value()))
+        self.parent.settings.setValue("adaptive_sweep", "true" if self.adaptive_sweep_checkbox.isChecked() else "false")
+        self.parent.settings.setValue("sweep_sample_points", str(self.sweep_sample_points_entry.value()))
+        self.parent.settings.setValue("dvc_autotune", "true" if self.dvc_autotune_checkbox.isChecked() else "false")
         self.close()
 
 
         #print(self.parent.settings.value("copy_files"))
+    def clearAutotune(self):
+        '''Removes the layouts stored by the autotuner, so that it runs again'''
+        self.parent.settings.remove("dvc_autotune_layouts")
+
     def onCancel(self):
         if self.parent.settings.value("first_app_load") != "False":
             self.parent.CreateSessionSelector("new window")
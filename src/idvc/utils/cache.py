@@ -0,0 +1,198 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''User level cache of files, with size bounded least recently used eviction.'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+def user_cache_dir(name):
+    '''Returns the folder of the user level cache `name`, e.g. ~/.cache/idvc/<name> on Linux.
+
+    The IDVC_CACHE_DIR environment variable overrides the base folder.'''
+    base = os.environ.get('IDVC_CACHE_DIR')
+    if base is None:
+        if sys.platform.startswith('win'):
+            base = os.path.join(os.environ.get('LOCALAPPDATA', os.path.expanduser('~')), 'idvc', 'cache')
+        elif sys.platform == 'darwin':
+            base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches', 'idvc')
+        else:
+            base = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'idvc')
+    return os.path.join(base, name)
+
+def hash_file(filename, chunk_size=2**24):
+    '''Returns the sha256 hex digest of the content of a file'''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def stat_fingerprint(filenames, **parameters):
+    '''Returns a sha256 hex digest of the paths, sizes and modification times of files
+    and of the keyword parameters, which must be JSON serialisable.
+
+    Unlike hash_file, the content of the files is not read, so it is suitable for large
+    inputs which are replaced rather than modified in place.'''
+    sources = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        sources.append([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+    record = json.dumps({'sources': sources, 'parameters': parameters}, sort_keys=True)
+    return hashlib.sha256(record.encode()).hexdigest()
+
+
+class FileCache(object):
+    '''A folder of cache entries, each a set of files stored under a key.
+
+    The entries are evicted, least recently used first, when the total size of
+    the cache exceeds max_size. The digests of large input files are memoised by
+    path, size and modification time, so that unchanged files are hashed only once.
+
+    Parameters
+    ----------
+    folder : str
+        the cache folder, created if it does not exist.
+    max_size : int
+        maximum size of the cache, in bytes.
+    '''
+    ENTRY_FILENAME = 'entry.json'
+    DIGESTS_FILENAME = 'digests.json'
+    MAX_DIGESTS = 1000
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def entry_folder(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key):
+        '''Returns a dictionary of the names and paths of the files stored under key,
+        or None if the key is not in the cache.'''
+        folder = self.entry_folder(key)
+        try:
+            with open(os.path.join(folder, self.ENTRY_FILENAME)) as f:
+                entry = json.load(f)
+            # the modification time of the entry file records the last access
+            os.utime(os.path.join(folder, self.ENTRY_FILENAME))
+        except (OSError, ValueError):
+            return None
+        files = {name: os.path.join(folder, name) for name in entry['files']}
+        if not all(os.path.exists(path) for path in files.values()):
+            return None
+        return files
+
+    def put(self, key, files, link=False):
+        '''Stores files under key.
+
+        Parameters
+        ----------
+        key : str
+            the key of the entry, a hex digest.
+        files : dict
+            names of the files in the entry and paths of the files to store.
+        link : bool, default False
+            hard link the files in the cache instead of copying them, if they are on the
+            same file system. The files must not be modified in place afterwards.
+        '''
+        folder = self.entry_folder(key)
+        if os.path.exists(os.path.join(folder, self.ENTRY_FILENAME)):
+            return
+        os.makedirs(os.path.dirname(folder), exist_ok=True)
+        # unique to the call, the same key may be stored at the same time by another thread
+        tmp_folder = tempfile.mkdtemp(prefix="{}.tmp".format(os.path.basename(folder)), dir=os.path.dirname(folder))
+        size = 0
+        for name, path in files.items():
+            destination = os.path.join(tmp_folder, name)
+            if link:
+                try:
+                    os.link(path, destination)
+                except OSError:
+                    # e.g. on another file system
+                    link = False
+            if not link:
+                shutil.copyfile(path, destination)
+            size += os.path.getsize(path)
+        with open(os.path.join(tmp_folder, self.ENTRY_FILENAME), 'w') as f:
+            json.dump({'files': sorted(files), 'size': size, 'created': time.time()}, f)
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            # stored at the same time by another thread or process
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        '''Returns a list of (last access time, size, folder) of the entries in the cache'''
+        entries = []
+        for prefix in os.listdir(self.folder):
+            prefix_folder = os.path.join(self.folder, prefix)
+            if not os.path.isdir(prefix_folder):
+                continue
+            for key in os.listdir(prefix_folder):
+                entry_filename = os.path.join(prefix_folder, key, self.ENTRY_FILENAME)
+                try:
+                    with open(entry_filename) as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(entry_filename), size, os.path.join(prefix_folder, key)))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return entries
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache fits in max_size'''
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_size:
+            _, size, folder = entries.pop(0)
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= size
+
+    def file_digest(self, filename):
+        '''Returns the sha256 digest of the content of filename, memoised by path, size and modification time.'''
+        stat = os.stat(filename)
+        key = "{}|{}|{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        digests_filename = os.path.join(self.folder, self.DIGESTS_FILENAME)
+        with self.lock:
+            try:
+                with open(digests_filename) as f:
+                    digests = json.load(f)
+            except (OSError, ValueError):
+                digests = {}
+            if key in digests:
+                return digests[key]
+        digest = hash_file(filename)
+        with self.lock:
+            try:
+                with open(digests_filename) as f:
+                    digests = json.load(f)
+            except (OSError, ValueError):
+                digests = {}
+            # forget the digests of files which changed or were removed
+            digests = {k: v for k, v in digests.items() if not k.startswith(os.path.abspath(filename) + "|")}
+            digests[key] = digest
+            if len(digests) > self.MAX_DIGESTS:
+                digests = dict(list(digests.items())[-self.MAX_DIGESTS:])
+            tmp_filename = "{}.tmp{}".format(digests_filename, os.getpid())
+            with open(tmp_filename, 'w') as f:
+                json.dump(digests, f)
+            os.replace(tmp_filename, digests_filename)
+        return digest
@@ -12,6 +12,9 @@
 
 #   Author: Danica sugic (UKRI-STFC)
 
+import os
+import json
+import hashlib
 import numpy as np
 
 def extract_point_cloud_from_inp_file(inp_file_path):
@@ -33,4 +36,22 @@ def extract_point_cloud_from_inp_file(inp_file_path):
             i, x, y, z = ln.split(",")
             nodes.append((int(i.strip()), float(x.strip()), float(y.strip()), float(z.strip())))
         nodes = np.array(nodes)
-    return nodes
\ No newline at end of file
+    return nodes
+
+def point_cloud_generation_key(parameters):
+    """Returns a digest of the parameters a point cloud is generated with.
+
+    parameters is a dict, which must be JSON serialisable, e.g. with the digest of the mask
+    and the subvolume size, shape, overlap and rotation. The order of its keys does not matter."""
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+def reusable_point_cloud(generated_point_clouds, key, session_folder):
+    """Returns the file of the point cloud generated with key and its number of points, or None
+    if none was generated or its file was removed, so that it must be generated again.
+
+    generated_point_clouds maps the generation keys to the point cloud files, relative to the
+    session_folder, and their number of points."""
+    generated = generated_point_clouds.get(key)
+    if generated is None or not os.path.exists(os.path.join(session_folder, generated[0])):
+        return None
+    return generated
@@ -0,0 +1,124 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Multi-resolution pyramid of image volumes, used to display large volumes.
+
+The levels of the pyramid are the volume binned by 2, 4 and 8, averaging blocks of
+voxels as dvc_multiresolution.bin_raw_volume does, the remainder being cropped. They
+are written in a single pass over the volume, each level from the previous one, as raw
+files described by pyramid.json. The full resolution level is the volume itself.
+'''
+
+import os
+import json
+
+import numpy as np
+
+from idvc.utils.cache import stat_fingerprint
+
+PYRAMID_FACTORS = (2, 4, 8)
+PYRAMID_FILENAME = "pyramid.json"
+# version of the files of the pyramid, part of its key
+PYRAMID_VERSION = 1
+
+def level_filename(factor):
+    return "level_{}.raw".format(factor)
+
+def pyramid_key(image_files, dataset_path=None):
+    '''Returns the key of the pyramid of a volume, from the paths, sizes and modification
+    times of its files'''
+    return stat_fingerprint(image_files, dataset_path=dataset_path, version=PYRAMID_VERSION)
+
+def pyramid_size(dims, itemsize, factors=PYRAMID_FACTORS):
+    '''Returns the size in bytes of the levels of the pyramid of a volume of dimensions dims'''
+    return sum(int(np.prod([int(d) // factor for d in dims])) * itemsize for factor in factors)
+
+def choose_level(dims, itemsize, target_size, factors=PYRAMID_FACTORS):
+    '''Returns the binning factor of the finest level which fits in target_size bytes.
+
+    Returns 1 if the full resolution volume fits, None if not even the coarsest level does.'''
+    for factor in (1,) + tuple(factors):
+        if int(np.prod([int(d) // factor for d in dims])) * itemsize <= target_size:
+            return factor
+    return None
+
+def bin_slab(slab, factor):
+    '''Returns the average of the blocks of factor**3 voxels of a slab indexed z, y, x.
+
+    The number of slices of the slab must be a multiple of factor.'''
+    nz, ny, nx = slab.shape
+    by, bx = ny // factor, nx // factor
+    blocks = slab[:, :by * factor, :bx * factor].reshape(nz // factor, factor, by, factor, bx, factor)
+    return blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+class PyramidWriter(object):
+    '''Writes the levels of the pyramid of a volume, given in slabs of slices along z.
+
+    The slices which do not fill a block of a level are kept until the next slab, so the
+    slabs can have any number of slices. The levels are stored little endian, with the
+    type of the volume, integers being rounded.
+
+    Parameters
+    ----------
+    folder : str
+        the folder the levels and pyramid.json are written to.
+    dims : list of int
+        dimensions of the volume, x, y, z.
+    dtype : numpy.dtype
+        type of the voxels.
+    factors : tuple of int, default PYRAMID_FACTORS
+        binning factors of the levels, each a multiple of the previous one.
+    '''
+    def __init__(self, folder, dims, dtype, factors=PYRAMID_FACTORS):
+        self.folder = folder
+        self.dims = [int(d) for d in dims]
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.factors = tuple(factors)
+        self.files = {factor: open(os.path.join(folder, level_filename(factor)), "wb") for factor in self.factors}
+        # slices of the previous level which were not binned yet
+        self.pending = {factor: None for factor in self.factors}
+
+    def add_slab(self, slab):
+        '''Adds the next slices of the volume, an array indexed z, y, x'''
+        data = np.asarray(slab, dtype=np.float32)
+        previous = 1
+        for factor in self.factors:
+            step = factor // previous
+            if self.pending[factor] is not None:
+                data = np.concatenate([self.pending[factor], data])
+            complete = data.shape[0] // step * step
+            self.pending[factor] = data[complete:] if complete < data.shape[0] else None
+            data = bin_slab(data[:complete], step)
+            if np.issubdtype(self.dtype, np.integer):
+                self.files[factor].write(np.rint(data).astype(self.dtype).tobytes())
+            else:
+                self.files[factor].write(data.astype(self.dtype).tobytes())
+            previous = factor
+
+    def close(self):
+        '''Closes the levels and writes pyramid.json, returns the names of the files of the pyramid'''
+        for f in self.files.values():
+            f.close()
+        record = {'dims': self.dims, 'dtype': self.dtype.str,
+                  'levels': {str(factor): [d // factor for d in self.dims] for factor in self.factors}}
+        with open(os.path.join(self.folder, PYRAMID_FILENAME), "w") as f:
+            json.dump(record, f)
+        return [PYRAMID_FILENAME] + [level_filename(factor) for factor in self.factors]
+
+def read_pyramid(filename):
+    '''Returns the description of a pyramid written by PyramidWriter'''
+    with open(filename) as f:
+        record = json.load(f)
+    record['dtype'] = np.dtype(record['dtype'])
+    record['levels'] = {int(factor): dims for factor, dims in record['levels'].items()}
+    return record
@@ -0,0 +1,97 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from idvc.utils.cache import FileCache, stat_fingerprint
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = os.path.join(self.folder, "data.txt")
+        with open(self.data, "w") as f:
+            f.write("x" * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_put_get(self):
+        cache = FileCache(os.path.join(self.folder, "cache"), 1000)
+        self.assertIsNone(cache.get("aa11"))
+        cache.put("aa11", {"result.disp": self.data})
+        files = cache.get("aa11")
+        with open(files["result.disp"]) as f:
+            self.assertEqual(f.read(), "x" * 100)
+
+    def test_evict_least_recently_used(self):
+        cache = FileCache(os.path.join(self.folder, "cache"), 250)
+        cache.put("aa11", {"result.disp": self.data})
+        cache.put("bb22", {"result.disp": self.data})
+        # make aa11 the most recently used entry
+        time.sleep(0.01)
+        cache.get("aa11")
+        cache.put("cc33", {"result.disp": self.data})
+        self.assertIsNotNone(cache.get("aa11"))
+        self.assertIsNone(cache.get("bb22"))
+        self.assertIsNotNone(cache.get("cc33"))
+
+    def test_file_digest(self):
+        cache = FileCache(os.path.join(self.folder, "cache"), 1000)
+        digest = cache.file_digest(self.data)
+        self.assertEqual(cache.file_digest(self.data), digest)
+        with open(self.data, "w") as f:
+            f.write("y" * 100)
+        self.assertNotEqual(cache.file_digest(self.data), digest)
+
+    def test_put_link(self):
+        cache = FileCache(os.path.join(self.folder, "cache"), 1000)
+        key = stat_fingerprint([self.data], dataset_path=None)
+        self.assertNotEqual(stat_fingerprint([self.data], dataset_path="/entry/data"), key)
+        cache.put(key, {"volume.raw": self.data}, link=True)
+        # the volume stays in the cache when the file of the session is removed
+        os.remove(self.data)
+        with open(cache.get(key)["volume.raw"]) as f:
+            self.assertEqual(f.read(), "x" * 100)
+
+    def test_put_concurrently(self):
+        # e.g. the reference and correlate volumes converted from the same source
+        cache = FileCache(os.path.join(self.folder, "cache"), 10000)
+        errors = []
+
+        def put():
+            try:
+                cache.put("aa11", {"volume.raw": self.data}, link=True)
+            except Exception as err:
+                errors.append(err)
+
+        for i in range(10):
+            threads = [threading.Thread(target=put) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            with open(cache.get("aa11")["volume.raw"]) as f:
+                self.assertEqual(f.read(), "x" * 100)
+            # no staging folder is left behind
+            self.assertEqual(os.listdir(os.path.dirname(cache.entry_folder("aa11"))), ["aa11"])
+            shutil.rmtree(cache.entry_folder("aa11"))
+
+
+if __name__ == '__main__':
+    unittest.main()
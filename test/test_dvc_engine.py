@@ -0,0 +1,499 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import io
+import json
+import unittest
+import numpy as np
+import os
+import shutil
+import tempfile
+import types
+from unittest import mock
+from functools import partial
+from idvc.utils.cache import FileCache
+from idvc.dvc_engine import (DVCEngine, split_thread_budget, partition_point_cloud, parse_progress_line,
+                             DVCRun, DVCScheduler, HeadlessRunner, set_config_fields, read_config_fields,
+                             available_memory, estimate_run_memory, PROCESS_MEMORY_OVERHEAD,
+                             merge_shard_results, run_results_complete, voxels_in_place,
+                             PointCloudStore, link_or_copy)
+from idvc.dvc_progress import ProgressTracker, ProgressEvent, SharedProgress, read_metrics, METRICS_FILENAME
+from idvc.dvc_autotune import candidate_layouts
+from idvc.dvc_multiresolution import (bin_raw_volume, to_coarse_coordinates, to_fine_coordinates,
+                                      region_translation)
+from idvc.dvc_sweep import score_result, rank_configurations, AdaptiveSweep, SWEEP_FILENAME
+
+
+class TestDVCEngine(unittest.TestCase):
+
+    def test_split_thread_budget(self):
+        self.assertEqual(split_thread_budget(8, 4, 2), (2, 4))
+        self.assertEqual(split_thread_budget(8, 1, 4), (1, 8))
+        self.assertEqual(split_thread_budget(2, 4, 4), (2, 1))
+
+    def test_partition_point_cloud(self):
+        points = np.zeros((100, 4))
+        points[:, 0] = np.arange(1, 101)
+        points[:, 1:] = np.random.rand(100, 3)
+        shards = partition_point_cloud(points, 3)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sorted(np.concatenate(shards).tolist()), list(range(100)))
+
+    def test_point_cloud_store(self):
+        folder = tempfile.mkdtemp()
+        try:
+            store = PointCloudStore(os.path.join(folder, "store"))
+            points = np.array([[1, 10., 20., 30.], [2, 11., 21., 31.]])
+            roi_file = os.path.join(folder, "grid_input.roi")
+            np.savetxt(roi_file, points, '%d\t%.3f\t%.3f\t%.3f')
+            # identical point clouds are stored once, keyed on their content
+            stored = store.add_file(roi_file)
+            self.assertEqual(store.add_file(roi_file), stored)
+            self.assertEqual(store.add_points(points), stored)
+            self.assertNotEqual(store.add_points(points[:1]), stored)
+            self.assertEqual(len(os.listdir(store.folder)), 2)
+            run_folders = [os.path.join(folder, "dvc_result_{}".format(i)) for i in range(2)]
+            for run_folder in run_folders:
+                os.mkdir(run_folder)
+                link_or_copy(stored, os.path.join(run_folder, "grid_input.roi"))
+            # the point cloud is on disk once, linked in the run folders
+            self.assertEqual(os.stat(stored).st_nlink, 3)
+            np.testing.assert_array_equal(np.loadtxt(os.path.join(run_folders[1], "grid_input.roi")), points)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_link_or_copy_fallback(self):
+        folder = tempfile.mkdtemp()
+        try:
+            source = os.path.join(folder, "source.roi")
+            with open(source, "w") as f:
+                f.write("1\t10\t20\t30\n")
+            with mock.patch('os.link', side_effect=OSError):
+                link_or_copy(source, os.path.join(folder, "symlink.roi"))
+                self.assertTrue(os.path.islink(os.path.join(folder, "symlink.roi")))
+                with mock.patch('os.symlink', side_effect=OSError):
+                    link_or_copy(source, os.path.join(folder, "copy.roi"))
+            copy = os.path.join(folder, "copy.roi")
+            self.assertFalse(os.path.islink(copy))
+            self.assertEqual(os.stat(copy).st_nlink, 1)
+            for destination in ["symlink.roi", "copy.roi"]:
+                with open(os.path.join(folder, destination)) as f:
+                    self.assertEqual(f.read(), "1\t10\t20\t30\n")
+        finally:
+            shutil.rmtree(folder)
+
+    def test_merge_shard_results(self):
+        folder = tempfile.mkdtemp()
+        try:
+            shards = [os.path.join(folder, "shard_{}".format(i)) for i in range(2)]
+            for i, shard in enumerate(shards):
+                with open(shard + ".disp", "w") as f:
+                    f.write("n\tx\ty\tz\n{}\t0\t0\t0\n".format(i + 1))
+                with open(shard + ".stat", "w") as f:
+                    f.write("output_filename\t{}\nnum_points_to_process\t{}\nstarting_point\t1 2 3\n"
+                            "points_processed\t{}\npoints_converged\t{}\nrun_time\t{}\n"
+                            .format(shard, 10 + i, 10 + i, 9 - i, [2.5, 4.25][i]))
+            output = os.path.join(folder, "merged")
+            merge_shard_results(shards, output)
+            with open(output + ".disp") as f:
+                self.assertEqual(f.read(), "n\tx\ty\tz\n1\t0\t0\t0\n2\t0\t0\t0\n")
+            with open(output + ".stat") as f:
+                # the counts are summed, the run time is the longest of the shards
+                self.assertEqual(f.read(), "output_filename\t{}\nnum_points_to_process\t21\nstarting_point\t1 2 3\n"
+                                 "points_processed\t21\npoints_converged\t17\nrun_time\t4.250\n".format(shards[0]))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_sharded_run_config(self):
+        folder = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            dims = (16, 16, 16)
+            np.zeros(dims, dtype=np.uint8).tofile(os.path.join(folder, "reference.raw"))
+            np.zeros(dims, dtype=np.uint8).tofile(os.path.join(folder, "correlate.raw"))
+            run_folder = os.path.join("Results", "run")
+            os.makedirs(os.path.join(folder, run_folder))
+            points = np.column_stack([np.arange(1, 21), np.random.default_rng(0).uniform(4, 12, size=(20, 3))])
+            np.savetxt(os.path.join(folder, run_folder, "_10.roi"), points, '%d\t%.3f\t%.3f\t%.3f')
+            config = {'subvolume_points': [100], 'subvolume_sizes': [10], 'points': 20,
+                      'roi_files': [os.path.join(run_folder, "_10.roi")], 'reference_file': "reference.raw",
+                      'correlate_file': "correlate.raw", 'vol_bit_depth': 8, 'vol_hdr_lngth': 0,
+                      'vol_endian': 'little', 'dims': list(dims), 'subvol_geom': 'cube', 'subvol_npts': [100],
+                      'disp_max': [5], 'dof': 6, 'obj': 'znssd', 'interp_type': 'tricubic',
+                      'rigid_trans': '0.0 0.0 0.0', 'run_folder': run_folder, 'point0': [8, 8, 8],
+                      'point0_world_coordinate': [8, 8, 8], 'shards': 2, 'result_cache_size': 0}
+            run_config = os.path.join(folder, run_folder, "_run_config.json")
+            with open(run_config, "w") as f:
+                json.dump(config, f)
+            engine = DVCEngine(run_config, folder, use_cache=False)
+            engine.set_up(types.SimpleNamespace(emit=print), types.SimpleNamespace(emit=lambda value: None))
+            self.assertEqual(len(engine.runs), 2)
+            # the run folder has the configuration of the merged run, on the whole point cloud
+            result_folder = os.path.join(run_folder, "dvc_result_0")
+            with open(os.path.join(folder, result_folder, "dvc_config.txt")) as f:
+                fields = read_config_fields(f.read())
+            self.assertEqual(fields['point_cloud_filename'], os.path.join(result_folder, "grid_input.roi"))
+            self.assertEqual(fields['output_filename'], os.path.join(result_folder, "dvc_result_0"))
+            self.assertEqual(fields['num_points_to_process'], "20")
+            shard_points = 0
+            for run in engine.runs:
+                with open(run.config_filename) as f:
+                    shard_points += int(read_config_fields(f.read())['num_points_to_process'])
+            self.assertEqual(shard_points, 20)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(folder)
+
+    def test_merge_shard_stats(self):
+        # laid out as the .stat files of the dvc executable are read by RunResults
+        with open(os.path.join(os.path.dirname(__file__), "data", "dvc_result_0.stat")) as f:
+            stat = f.read()
+        folder = tempfile.mkdtemp()
+        try:
+            run_folder = os.path.join(folder, "dvc_result_0")
+            shards = [os.path.join(run_folder, "shard_{}".format(i), "dvc_result_0") for i in range(2)]
+            for i, shard in enumerate(shards):
+                os.makedirs(os.path.dirname(shard))
+                with open(shard + ".disp", "w") as f:
+                    f.write("n\tx\ty\tz\tstatus\tobjmin\tu\tv\tw\n{}\t0\t0\t0\t0\t0.1\t1\t2\t3\n".format(i + 1))
+                with open(shard + ".stat", "w") as f:
+                    f.write(stat if i == 0 else stat.replace("total_time\t13.750", "total_time\t15.000")
+                                                    .replace("num_successful\t57", "num_successful\t60"))
+            output = os.path.join(run_folder, "dvc_result_0")
+            merge_shard_results(shards, output)
+            with open(output + ".stat") as f:
+                merged = dict(line.rstrip("\n").split("\t", 1) for line in f if "\t" in line)
+            # the parameters of the run are kept, the counts summed and the times the longest
+            self.assertEqual((merged['subvol_size'], merged['starting_point'], merged['run_date']),
+                             ("30", "80\t80\t80", "2023-10-09 15:02:11"))
+            self.assertEqual((merged['num_points_to_process'], merged['points_processed'], merged['points_in_cloud']),
+                             ("120", "120", "200"))
+            self.assertEqual((merged['num_successful'], merged['num_range_fail'], merged['num_convg_fail']),
+                             ("117", "4", "2"))
+            self.assertEqual((merged['total_time'], merged['mean_objmin']), ("15.000", "0.0123"))
+            try:
+                from idvc.utilities import RunResults
+            except ImportError:
+                return
+            result = RunResults(run_folder)
+            self.assertEqual((result.subvol_geom.strip(), result.subvol_size, result.subvol_points, result.disp_max),
+                             ("sphere", 30, 1000, 10))
+            self.assertEqual(result.rigid_trans, [0, 0, 0])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_run_results_complete(self):
+        folder = tempfile.mkdtemp()
+        try:
+            run_config = {'run_folder': "Results/run", 'roi_files': ["a.roi", "b.roi"], 'subvolume_points': [10]}
+            for c in range(2):
+                output_filename = os.path.join(folder, "Results", "run", "dvc_result_{}".format(c), "dvc_result_{}".format(c))
+                os.makedirs(os.path.dirname(output_filename))
+                self.assertFalse(run_results_complete(run_config, folder))
+                for extension in [".disp", ".stat"]:
+                    with open(output_filename + extension, "w") as f:
+                        f.write("result\n")
+            self.assertTrue(run_results_complete(run_config, folder))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_voxels_in_place(self):
+        info = {'compressed': False, 'header_length': 128, 'dtype': np.dtype('<u2'), 'isBigEndian': False,
+                'shape': (4, 5, 6), 'isFortran': False}
+        self.assertTrue(voxels_in_place(info, 16, "little", [6, 5, 4]))
+        self.assertTrue(voxels_in_place(dict(info, shape=(6, 5, 4), isFortran=True), 16, "little", [6, 5, 4]))
+        # the layout, type and byte order of the run config
+        self.assertFalse(voxels_in_place(info, 16, "little", [4, 5, 6]))
+        self.assertFalse(voxels_in_place(info, 8, "little", [6, 5, 4]))
+        self.assertFalse(voxels_in_place(info, 16, "big", [6, 5, 4]))
+        self.assertFalse(voxels_in_place(dict(info, dtype=np.dtype('<i2')), 16, "little", [6, 5, 4]))
+        self.assertFalse(voxels_in_place(dict(info, compressed=True), 16, "little", [6, 5, 4]))
+        self.assertTrue(voxels_in_place(dict(info, dtype=np.dtype('u1'), isBigEndian=True), 8, "little", [6, 5, 4]))
+
+    def test_parse_progress_line(self):
+        self.assertEqual(parse_progress_line("10/200\n"), 10)
+        self.assertIsNone(parse_progress_line("Input Error\n"))
+
+    def test_scheduler(self):
+        runs = [DVCRun('dvc', 'config_{}'.format(i), 'out_{}'.format(i), 10) for i in range(3)]
+        scheduler = DVCScheduler(runs, total_threads=4, max_concurrent=2, log_metrics=False)
+        self.assertEqual(scheduler.environment(runs[0]), {"OMP_NUM_THREADS": "2"})
+        first, second = scheduler.next_run(), scheduler.next_run()
+        self.assertIsNone(scheduler.next_run())
+        scheduler.update(first, "5/10")
+        self.assertEqual(scheduler.progress()[0], 16)
+        scheduler.run_finished(first, True)
+        third = scheduler.next_run()
+        scheduler.run_finished(second, True)
+        scheduler.run_finished(third, True)
+        self.assertTrue(scheduler.finished)
+        self.assertTrue(scheduler.succeeded)
+
+    def test_headless_stop_file(self):
+        folder = tempfile.mkdtemp()
+        try:
+            stop_file = os.path.join(folder, "stop")
+            open(stop_file, "w").close()
+            runs = [DVCRun('dvc', 'config', os.path.join(folder, 'out'), 10)]
+            engine = types.SimpleNamespace(runs=runs, cache_result=None, has_next_stage=False)
+            stream = io.StringIO()
+            runner = HeadlessRunner(engine, stream=stream, stop_file=stop_file)
+            self.assertEqual(runner.run(), 130)
+            self.assertEqual(runner.processes, {})
+            self.assertIn("cancelled", stream.getvalue())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_failed_run_not_cached(self):
+        folder = tempfile.mkdtemp()
+        try:
+            engine = types.SimpleNamespace(cache=FileCache(os.path.join(folder, "cache"), 10**6))
+            runs = []
+            for i in range(3):
+                output_filename = os.path.join(folder, "out_{}".format(i))
+                for extension in [".disp", ".stat"]:
+                    with open(output_filename + extension, "w") as f:
+                        f.write("result\n")
+                runs.append(DVCRun('dvc', 'config_{}'.format(i), output_filename, 10, fingerprint="{:064x}".format(i)))
+            scheduler = DVCScheduler(runs, total_threads=3, max_concurrent=3, log_metrics=False,
+                                     on_run_finished=partial(DVCEngine.cache_result, engine))
+            for run in runs:
+                scheduler.next_run()
+            self.assertTrue(scheduler.process_finished(runs[0], 0))
+            # exited normally with an error, and crashed
+            self.assertFalse(scheduler.process_finished(runs[1], 1))
+            self.assertFalse(scheduler.process_finished(runs[2], 0, normal_exit=False))
+            self.assertIsNotNone(engine.cache.get(runs[0].fingerprint))
+            self.assertIsNone(engine.cache.get(runs[1].fingerprint))
+            self.assertIsNone(engine.cache.get(runs[2].fingerprint))
+            self.assertFalse(scheduler.succeeded)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_restore_cached_volume(self):
+        folder = tempfile.mkdtemp()
+        try:
+            engine = types.SimpleNamespace(volume_cache=FileCache(os.path.join(folder, "cache"), 10**6))
+            converted = os.path.join(folder, "converted.raw")
+            with open(converted, "wb") as f:
+                f.write(b"voxels")
+            engine.volume_cache.put("a" * 64, {"volume.raw": converted})
+            for name, link in [("linked.raw", os.link), ("copied.raw", mock.Mock(side_effect=OSError))]:
+                raw_fname = os.path.join(folder, name)
+                with mock.patch("os.link", link):
+                    self.assertEqual(DVCEngine.restore_cached_volume(engine, "a" * 64, raw_fname), raw_fname)
+            # the volumes passed to the dvc executable are kept when the cache entry is evicted
+            shutil.rmtree(engine.volume_cache.entry_folder("a" * 64))
+            for name in ["linked.raw", "copied.raw"]:
+                with open(os.path.join(folder, name), "rb") as f:
+                    self.assertEqual(f.read(), b"voxels")
+            self.assertIsNone(DVCEngine.restore_cached_volume(engine, "a" * 64, os.path.join(folder, "missing.raw")))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_memory_admission(self):
+        folder = tempfile.mkdtemp()
+        try:
+            meminfo = os.path.join(folder, "meminfo")
+            with open(meminfo, "w") as f:
+                f.write("MemTotal:       16000000 kB\nMemAvailable:    8000000 kB\n")
+            self.assertEqual(available_memory(meminfo, folder), 8000000 * 1024)
+            # the memory left in the cgroup is lower
+            with open(os.path.join(folder, "memory.max"), "w") as f:
+                f.write("3000000000\n")
+            with open(os.path.join(folder, "memory.current"), "w") as f:
+                f.write("1000000000\n")
+            self.assertEqual(available_memory(meminfo, folder), 2000000000)
+
+            config = "vol_bit_depth\t16\nvol_wide\t100\nvol_high\t100\nvol_tall\t50\n"
+            memory = estimate_run_memory(config)
+            self.assertEqual(memory, 2 * 100 * 100 * 50 * 2 + PROCESS_MEMORY_OVERHEAD)
+            runs = []
+            for i in range(3):
+                config_filename = os.path.join(folder, "config_{}".format(i))
+                with open(config_filename, "w") as f:
+                    f.write(config)
+                runs.append(DVCRun('dvc', config_filename, 'out_{}'.format(i), 10))
+            scheduler = DVCScheduler(runs, total_threads=6, max_concurrent=3, log_metrics=False,
+                                     memory_limit=2.5 * memory)
+            # two processes fit in memory, they share the threads
+            self.assertEqual((scheduler.concurrent, scheduler.threads_per_process), (2, 3))
+            first, second = scheduler.next_run(), scheduler.next_run()
+            self.assertIsNotNone(first)
+            self.assertIsNotNone(second)
+            self.assertIsNot(first, second)
+            self.assertIsNone(scheduler.next_run())
+            # the first run is started even if it does not fit
+            scheduler = DVCScheduler(runs, total_threads=6, max_concurrent=3, log_metrics=False,
+                                     memory_limit=memory / 2)
+            self.assertIsNotNone(scheduler.next_run())
+            self.assertIsNone(scheduler.next_run())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_metrics_log(self):
+        folder = tempfile.mkdtemp()
+        try:
+            runs = [DVCRun('dvc', 'config', os.path.join(folder, 'run_{}'.format(i), 'out'), 10) for i in range(2)]
+            for run in runs:
+                os.mkdir(os.path.dirname(run.output_filename))
+            scheduler = DVCScheduler(runs, total_threads=2, max_concurrent=2)
+            first, second = scheduler.next_run(), scheduler.next_run()
+            scheduler.update(first, "10/10")
+            scheduler.run_finished(first, True, 0)
+            scheduler.run_finished(second, False, 1)
+            metrics = read_metrics(folder)
+            self.assertEqual(sorted(metrics), [os.path.join(folder, 'run_{}'.format(i), METRICS_FILENAME)
+                                               for i in range(2)])
+            records = metrics[os.path.join(folder, 'run_0', METRICS_FILENAME)]
+            self.assertEqual([records[0]['event'], records[-1]['event']], ["start", "finished"])
+            self.assertEqual((records[-1]['succeeded'], records[-1]['points']), (True, 10))
+            records = metrics[os.path.join(folder, 'run_1', METRICS_FILENAME)]
+            self.assertEqual((records[-1]['succeeded'], records[-1]['exit_code']), (False, 1))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_progress_tracker(self):
+        run = DVCRun('dvc', 'config', 'out', 100)
+        tracker = ProgressTracker(100, alpha=0.5, sample_interval=1)
+        now = [tracker.start_time]
+        tracker.clock = lambda: now[0]
+        tracker.start(run)
+        now[0] += 1
+        event = tracker.update(run, "10/100")
+        self.assertEqual(event.kind, ProgressEvent.POINTS)
+        self.assertEqual(event.points_per_second, 10)
+        self.assertEqual(event.eta, 9)
+        now[0] += 1
+        event = tracker.update(run, "40/100")
+        # the throughput is smoothed: 0.5 * 30 + 0.5 * 10
+        self.assertEqual(event.points_per_second, 20)
+        self.assertEqual(tracker.update(run, "Input Error").kind, ProgressEvent.INPUT_ERROR)
+
+    def test_shared_progress(self):
+        class Callback(object):
+            values = []
+            def emit(self, value):
+                self.values.append(value)
+        callback = Callback()
+        progress = SharedProgress(callback, 2, 10, 90)
+        progress.task(0).emit(50)
+        progress.task(1).emit(50)
+        # unchanged values are not emitted
+        progress.task(0).emit(50.2)
+        progress.task(1).emit(100)
+        progress.task(0).emit(100)
+        self.assertEqual(callback.values, [30, 50, 70, 90])
+
+    def test_autotune_layouts(self):
+        self.assertEqual(candidate_layouts(8), [(1, 8), (2, 4), (4, 2), (8, 1)])
+        self.assertEqual(candidate_layouts(6, max_processes=2), [(1, 6), (1, 4), (2, 2), (2, 1)])
+        config = "# comment num_points_to_process\nnum_points_to_process   100  ### comment\nobj_function\tznssd\n"
+        self.assertEqual(set_config_fields(config, num_points_to_process=10),
+                         "# comment num_points_to_process\nnum_points_to_process\t10\nobj_function\tznssd\n")
+        self.assertEqual(read_config_fields(config), {'num_points_to_process': '100', 'obj_function': 'znssd'})
+
+
+class TestMultiresolution(unittest.TestCase):
+
+    def test_bin_raw_volume(self):
+        folder = tempfile.mkdtemp()
+        try:
+            volume = np.arange(5 * 4 * 4, dtype='>u2').reshape(5, 4, 4)
+            filename = os.path.join(folder, "volume.raw")
+            with open(filename, "wb") as f:
+                f.write(b"header" + volume.tobytes())
+            binned_filename = os.path.join(folder, "binned.raw")
+            dims = bin_raw_volume(filename, binned_filename, [4, 4, 5], 16, 6, "big", 2)
+            # the last slice is cropped
+            self.assertEqual(dims, [2, 2, 2])
+            binned = np.fromfile(binned_filename, dtype='<u2').reshape(2, 2, 2)
+            expected = volume[:4].astype(float).reshape(2, 2, 2, 2, 2, 2).mean(axis=(1, 3, 5))
+            np.testing.assert_array_equal(binned, np.rint(expected))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_coordinates(self):
+        points = np.array([[0.5, 10, 3]])
+        np.testing.assert_allclose(to_fine_coordinates(to_coarse_coordinates(points, 4), 4), points)
+        np.testing.assert_allclose(to_coarse_coordinates([1.5, 3.5, 5.5], 4), [0, 0.5, 1])
+
+    def test_region_translation(self):
+        positions = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [50, 50, 50]], dtype=float)
+        displacements = np.array([[1, 2, 3], [1, 2, 5], [3, 2, 3], [9, 9, 9]], dtype=float)
+        region = np.array([[0, 0, 0], [1, 1, 0]], dtype=float)
+        self.assertEqual(region_translation(region, positions, displacements, [0, 0, 0], neighbours=3), [1, 2, 3])
+        self.assertEqual(region_translation(region, np.zeros((0, 3)), np.zeros((0, 3)), [1, 1, 1]), [1., 1., 1.])
+
+
+class TestAdaptiveSweep(unittest.TestCase):
+
+    def test_score_result(self):
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, "result.disp")
+            with open(filename, "w") as f:
+                f.write("n\tx\ty\tz\tstatus\tobjmin\tu\tv\tw\n")
+                f.write("1\t0\t0\t0\t0\t0.1\t1\t2\t3\n")
+                f.write("2\t0\t0\t0\t0\t0.3\t3\t2\t3\n")
+                f.write("3\t0\t0\t0\t-1\t0.9\t9\t9\t9\n")
+            objmin, spread, converged, num_converged = score_result(filename)
+            self.assertAlmostEqual(objmin, 0.2)
+            self.assertAlmostEqual(spread, 1 / 3.)
+            self.assertAlmostEqual(converged, 2 / 3.)
+            self.assertEqual(num_converged, 2)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_rank_configurations(self):
+        scores = {0: (0.3, 2., 1., 200), 1: (0.1, 1., 1., 200), 2: (0.2, 3., 1., 200),
+                  3: (float('inf'), float('inf'), 0., 0)}
+        self.assertEqual(rank_configurations(scores), [1, 0, 2, 3])
+        # equal rank sums are ordered by the converged fraction
+        self.assertEqual(rank_configurations({0: (0.1, 2., 0.5, 100), 1: (0.2, 1., 0.9, 180)}), [1, 0])
+
+    def test_rank_low_convergence_last(self):
+        # a configuration where few points converged has a small spread but is ranked last
+        scores = {0: (0.05, 1.0, 0.995, 199), 1: (0.04, 0.0, 0.005, 1), 2: (0.06, 0.8, 1.0, 200)}
+        self.assertEqual(rank_configurations(scores), [2, 0, 1])
+        # so is a configuration with too few converged points, even if most of them converged
+        scores = {0: (0.05, 1.0, 0.9, 180), 1: (0.04, 0.0, 1.0, 5), 2: (0.03, 0.1, 0.2, 40)}
+        self.assertEqual(rank_configurations(scores), [0, 1, 2])
+
+    def test_pruned_folders_kept(self):
+        folder = tempfile.mkdtemp()
+        try:
+            configurations = {}
+            for c in range(2):
+                run_folder = os.path.join(folder, "dvc_result_{}".format(c))
+                os.mkdir(run_folder)
+                open(os.path.join(run_folder, "dvc_config.txt"), "w").close()
+                configurations[c] = {'num_points': 1000, 'runs': ['run_{}'.format(c)], 'run_folder': run_folder,
+                                     'size': 10 * (c + 1), 'points': 100}
+            engine = types.SimpleNamespace(run_folder=folder, shard_groups=[], next_stage_fn=None)
+            sweep = AdaptiveSweep(engine, configurations, None)
+            sweep.kept = [0]
+            self.assertEqual(sweep.final_round(), ['run_0'])
+            sweep.save()
+            # the pruned run folder is moved out of the results, not removed
+            self.assertFalse(os.path.exists(configurations[1]['run_folder']))
+            self.assertTrue(os.path.exists(os.path.join(folder, "sweep", "pruned", "dvc_result_1", "dvc_config.txt")))
+            self.assertTrue(os.path.exists(configurations[0]['run_folder']))
+            with open(os.path.join(folder, SWEEP_FILENAME)) as f:
+                record = json.load(f)
+            self.assertEqual(record['pruned'], {"1": os.path.join("sweep", "pruned", "dvc_result_1")})
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
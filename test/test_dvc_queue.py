@@ -0,0 +1,75 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from idvc.dvc_queue import RunQueue
+
+
+class TestRunQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "run_queue.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_order_and_status(self):
+        queue = RunQueue(self.filename)
+        first = queue.add(os.path.join(self.folder, "Results", "a", "_run_config.json"), self.folder)
+        second = queue.add(os.path.join(self.folder, "Results", "b", "_run_config.json"), self.folder)
+        self.assertEqual(first['name'], "a")
+        job = queue.next_job()
+        self.assertEqual(job['id'], first['id'])
+        self.assertEqual(job['status'], RunQueue.RUNNING)
+        queue.job_finished(job['id'], 0)
+        self.assertEqual(queue.next_job()['id'], second['id'])
+        queue.job_finished(second['id'], 130)
+        self.assertIsNone(queue.next_job())
+        self.assertEqual([job['status'] for job in queue.jobs()], [RunQueue.FINISHED, RunQueue.CANCELLED])
+        queue.clear_ended()
+        self.assertEqual(queue.jobs(), [])
+
+    def test_recover(self):
+        queue = RunQueue(self.filename)
+        job = queue.add(os.path.join(self.folder, "_run_config.json"), self.folder)
+        queue.add(os.path.join(self.folder, "_run_config.json"), self.folder)
+        queue.next_job()
+        self.assertFalse(queue.remove(job['id']))
+        # the app exited while the job was running
+        queue = RunQueue(self.filename)
+        self.assertEqual(queue.recover(), 1)
+        job = queue.next_job()
+        self.assertTrue(job['resume'])
+        self.assertEqual(queue.pending_sessions(), {os.path.abspath(self.folder)})
+
+    def test_remove_and_requeue(self):
+        queue = RunQueue(self.filename)
+        first = queue.add(os.path.join(self.folder, "Results", "a", "_run_config.json"), self.folder)
+        second = queue.add(os.path.join(self.folder, "Results", "b", "_run_config.json"), self.folder)
+        self.assertTrue(queue.remove(second['id']))
+        self.assertFalse(queue.remove(second['id']))
+        job = queue.next_job()
+        queue.job_finished(job['id'], 130)
+        self.assertEqual(queue.pending(), [])
+        queue.requeue(first['id'])
+        job = queue.next_job()
+        self.assertEqual(job['id'], first['id'])
+        self.assertTrue(job['resume'])
+        self.assertIsNone(job['exit_code'])
+
+
+if __name__ == '__main__':
+    unittest.main()
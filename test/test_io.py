@@ -0,0 +1,560 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import h5py
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from idvc.io import (save_tiff_stack_as_raw, hdf5_chunk_filters, read_hdf5_slab, hdf5_attribute_range,
+                     save_nxs_as_raw, probe_raw, probe_npy, probe_metaimage, probe_tiff_stack, probe_hdf5,
+                     probe_volume, load_volume_mapped, iter_volume_slabs, save_volume_as_raw,
+                     write_chunked_volume, read_volume_box, loadVolumeBox, chunked_volume_is_current,
+                     binned_geometry, binning_factor, read_tiff_stack_binned)
+
+
+def write_metaimage(filename, volume, big_endian=False, data_file=None, **fields):
+    '''Writes a volume indexed z, y, x to a MetaImage file, with the voxels in data_file if given'''
+    header = ["ObjectType = Image", "NDims = 3",
+              "DimSize = {} {} {}".format(*volume.shape[::-1]),
+              "ElementType = {}".format({'uint8': 'MET_UCHAR', 'uint16': 'MET_USHORT', 'float32': 'MET_FLOAT'}[volume.dtype.name]),
+              "ElementByteOrderMSB = {}".format(big_endian)]
+    header += ["{} = {}".format(key, value) for key, value in fields.items()]
+    header.append("ElementDataFile = {}".format(os.path.basename(data_file) if data_file else "LOCAL"))
+    header = ("\n".join(header) + "\n").encode('latin-1')
+    voxels = volume.astype(volume.dtype.newbyteorder('>' if big_endian else '<')).tobytes()
+    with open(filename, 'wb') as f:
+        f.write(header)
+        if data_file is None:
+            f.write(voxels)
+    if data_file is not None:
+        with open(data_file, 'wb') as f:
+            f.write(voxels)
+    return len(header)
+
+
+class EmitRecorder(object):
+    def __init__(self):
+        self.values = []
+
+    def emit(self, value):
+        self.values.append(value)
+
+
+def write_tiff_stack(folder, volume):
+    '''Writes each slice of a volume indexed z, y, x to a TIFF file, returns the file names'''
+    filenames = []
+    for z, voxels in enumerate(volume):
+        image = vtk.vtkImageData()
+        image.SetDimensions(volume.shape[2], volume.shape[1], 1)
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels.ravel(), deep=True))
+        writer = vtk.vtkTIFFWriter()
+        writer.SetFileName(os.path.join(folder, "slice_{:03d}.tif".format(z)))
+        writer.SetInputData(image)
+        writer.Write()
+        filenames.append(writer.GetFileName())
+    return filenames
+
+
+def read_tiff_stack_serially(filenames):
+    '''Returns the voxels of a TIFF stack read one file at a time, in the order of the raw files'''
+    slices = []
+    for filename in filenames:
+        reader = vtk.vtkTIFFReader()
+        reader.SetOrientationType(1) # TopLeft
+        reader.SetFileName(filename)
+        reader.Update()
+        slices.append(numpy_support.vtk_to_numpy(reader.GetOutput().GetPointData().GetScalars()))
+    return np.stack(slices)
+
+
+class TestTIFFStackToRaw(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def convert(self, filenames, workers):
+        raw_file = os.path.join(self.folder, "stack_{}.raw".format(workers))
+        progress = EmitRecorder()
+        save_tiff_stack_as_raw(filenames, raw_file, progress, 0, 100, workers=workers)
+        self.assertEqual(progress.values[-1], 100)
+        with open(raw_file, 'rb') as f:
+            return f.read()
+
+    def check_stack(self, volume, expected_dtype):
+        filenames = write_tiff_stack(self.folder, volume)
+        voxels = read_tiff_stack_serially(filenames)
+        if expected_dtype != volume.dtype:
+            # the same float32 operations as the conversion
+            voxels = voxels.astype(np.float32)
+            m, M = np.nanmin(voxels), np.nanmax(voxels)
+            voxels = ((voxels - m) / (M - m) * np.iinfo(np.uint16).max).astype(np.uint16)
+        expected = np.ascontiguousarray(voxels, dtype=expected_dtype).tobytes()
+        for workers in (1, 3):
+            self.assertEqual(self.convert(filenames, workers), expected)
+
+    def test_uint8(self):
+        rng = np.random.default_rng(0)
+        self.check_stack(rng.integers(0, 256, size=(7, 11, 13), dtype=np.uint8), np.uint8)
+
+    def test_uint16(self):
+        rng = np.random.default_rng(1)
+        self.check_stack(rng.integers(0, 65536, size=(7, 11, 13), dtype=np.uint16), np.uint16)
+
+    def test_scaled_float(self):
+        rng = np.random.default_rng(2)
+        self.check_stack(rng.normal(5, 3, size=(7, 11, 13)).astype(np.float32), np.uint16)
+
+    def test_slice_size_mismatch(self):
+        filenames = write_tiff_stack(self.folder, np.zeros((2, 11, 13), dtype=np.uint8))
+        other = os.path.join(self.folder, "other")
+        os.mkdir(other)
+        filenames += write_tiff_stack(other, np.zeros((1, 5, 13), dtype=np.uint8))
+        with self.assertRaises(ValueError):
+            save_tiff_stack_as_raw(filenames, os.path.join(self.folder, "stack.raw"), EmitRecorder(), 0, 100)
+
+
+class TestHDF5Slabs(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "volume.nxs")
+        rng = np.random.default_rng(3)
+        self.volume = rng.integers(0, 65536, size=(8, 9, 10), dtype=np.uint16)
+        with h5py.File(self.filename, "w") as f:
+            # the chunks do not divide the shape, so that the chunks on the edges are partial
+            f.create_dataset("shuffled", data=self.volume, chunks=(3, 4, 5), compression='gzip', shuffle=True)
+            f.create_dataset("deflated", data=self.volume.astype(np.float32), chunks=(3, 9, 4), compression='gzip')
+            f.create_dataset("chunked", data=self.volume.astype(np.int32), chunks=(2, 5, 10))
+            f.create_dataset("contiguous", data=self.volume)
+            f.create_dataset("lzf", data=self.volume, chunks=(3, 4, 5), compression='lzf')
+            # the chunks which are not written have the fill value
+            sparse = f.create_dataset("sparse", shape=self.volume.shape, dtype=np.uint16, chunks=(3, 4, 5),
+                                      compression='gzip', shuffle=True, fillvalue=7)
+            sparse[3:6, :4, 5:] = self.volume[3:6, :4, 5:]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_chunk_filters(self):
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(hdf5_chunk_filters(f["shuffled"]), [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE])
+            self.assertEqual(hdf5_chunk_filters(f["deflated"]), [h5py.h5z.FILTER_DEFLATE])
+            self.assertEqual(hdf5_chunk_filters(f["chunked"]), [])
+            self.assertIsNone(hdf5_chunk_filters(f["contiguous"]))
+            self.assertIsNone(hdf5_chunk_filters(f["lzf"]))
+
+    def test_read_slab(self):
+        with h5py.File(self.filename, "r") as f:
+            for name in ["shuffled", "deflated", "chunked", "contiguous", "lzf", "sparse"]:
+                data = f[name]
+                filters = hdf5_chunk_filters(data)
+                step = data.chunks[0] if data.chunks is not None else 1
+                for stop_step in [step, 2 * step]:
+                    # the last slab is partial
+                    for start in range(0, data.shape[0], stop_step):
+                        stop = min(start + stop_step, data.shape[0])
+                        slab = read_hdf5_slab(data, start, stop, filters)
+                        self.assertEqual(slab.dtype, data.dtype)
+                        np.testing.assert_array_equal(slab, data[start:stop], err_msg=name)
+
+    def test_attribute_range(self):
+        with h5py.File(self.filename, "a") as f:
+            data = f["deflated"]
+            self.assertIsNone(hdf5_attribute_range(data))
+            data.attrs['actual_range'] = np.array([1.5, 10.0])
+            self.assertEqual(hdf5_attribute_range(data), (1.5, 10.0))
+            data.attrs['valid_min'], data.attrs['valid_max'] = np.float32(-1), np.array([2], dtype=np.int16)
+            self.assertEqual(hdf5_attribute_range(data), (-1.0, 2.0))
+            data.attrs['min'], data.attrs['max'] = 0, 65535
+            self.assertEqual(hdf5_attribute_range(data), (0.0, 65535.0))
+
+    def test_save_as_raw(self):
+        raw_file = os.path.join(self.folder, "volume.raw")
+        for name in ["shuffled", "sparse"]:
+            save_nxs_as_raw(self.filename, name, raw_file, workers=3)
+            with h5py.File(self.filename, "r") as f:
+                self.assertEqual(np.fromfile(raw_file, dtype=np.uint16).tobytes(), f[name][...].tobytes())
+        save_nxs_as_raw(self.filename, "deflated", raw_file, workers=3)
+        scaled = np.fromfile(raw_file, dtype=np.uint16).reshape(self.volume.shape)
+        voxels = self.volume.astype(np.float32)
+        m, M = voxels.min(), voxels.max()
+        expected = ((voxels - m) / (M - m) * np.iinfo(np.uint16).max).astype(np.uint16)
+        np.testing.assert_array_equal(scaled, expected)
+
+
+    def test_save_clipped(self):
+        voxels = np.linspace(-1, 2, 8 * 9 * 10, dtype=np.float32).reshape(8, 9, 10)
+        voxels[0, 0, 0] = np.nan
+        with h5py.File(self.filename, "a") as f:
+            data = f.create_dataset("clipped", data=voxels, chunks=(3, 4, 5), compression='gzip', shuffle=True)
+            data.attrs['min'], data.attrs['max'] = 0.0, 1.0
+        raw_file = os.path.join(self.folder, "volume.raw")
+        save_nxs_as_raw(self.filename, "clipped", raw_file, workers=3)
+        scaled = np.fromfile(raw_file, dtype=np.uint16).reshape(voxels.shape)
+        # NaNs and the values outside of the range of the attributes do not wrap around
+        self.assertEqual(scaled[0, 0, 0], 0)
+        np.testing.assert_array_equal(scaled[voxels < 0], 0)
+        np.testing.assert_array_equal(scaled[voxels > 1], 65535)
+
+
+class TestProbes(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.volume = np.arange(4 * 5 * 6, dtype=np.uint16).reshape(4, 5, 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check_info(self, info, file_type, shape, dtype, big_endian, header_length, fortran, compressed, bit_depth=16):
+        self.assertEqual(info['file_type'], file_type)
+        self.assertEqual(info['shape'], shape)
+        self.assertEqual(info['dtype'], np.dtype(dtype))
+        self.assertEqual(info['isBigEndian'], big_endian)
+        self.assertEqual(info['header_length'], header_length)
+        self.assertEqual(info['isFortran'], fortran)
+        self.assertEqual(info['compressed'], compressed)
+        self.assertEqual(info['vol_bit_depth'], bit_depth)
+
+    def test_probe_raw(self):
+        filename = os.path.join(self.folder, "volume.raw")
+        self.volume.astype('>u2').tofile(filename)
+        # dimensions are x, y, z, the typecode is an index in RAW_TYPECODES
+        info = probe_raw(filename, [6, 5, 4], 3, False, True)
+        self.check_info(info, 'raw', (4, 5, 6), np.uint16, True, 0, False, False)
+        self.assertEqual(info['file_size'], info['expected_size'])
+        info = probe_raw(filename, [6, 5, 4], 1, True, False, header_length=16)
+        self.check_info(info, 'raw', (6, 5, 4), np.uint8, False, 16, True, False, bit_depth=8)
+        self.assertEqual(info['expected_size'], 16 + self.volume.size)
+
+    def test_probe_npy(self):
+        filename = os.path.join(self.folder, "volume.npy")
+        for dtype, fortran in [('<u2', False), ('>u2', False), ('<f4', True), ('|u1', True)]:
+            volume = self.volume.astype(dtype)
+            np.save(filename, np.asfortranarray(volume) if fortran else volume)
+            info = probe_volume(filename)
+            # the header is padded, the voxels follow it
+            self.assertEqual(os.path.getsize(filename), info['header_length'] + volume.nbytes)
+            self.check_info(info, 'npy', (4, 5, 6), dtype, dtype.startswith('>'), info['header_length'], fortran,
+                            False, bit_depth=8 if dtype == '|u1' else 16)
+            self.assertEqual(info['data_file'], filename)
+            self.assertEqual(info, probe_npy(filename))
+
+    def test_probe_metaimage(self):
+        filename = os.path.join(self.folder, "volume.mha")
+        header_length = write_metaimage(filename, self.volume, big_endian=True,
+                                        ElementSpacing="1 2 3", Offset="4 5 6")
+        info = probe_volume(filename)
+        self.check_info(info, 'metaimage', (6, 5, 4), np.uint16, True, header_length, True, False)
+        self.assertEqual(info['data_file'], filename)
+        self.assertEqual(info['spacing'], (1.0, 2.0, 3.0))
+        self.assertEqual(info['origin'], (4.0, 5.0, 6.0))
+
+        # the voxels in a separate file, after a header
+        filename = os.path.join(self.folder, "volume.mhd")
+        data_file = os.path.join(self.folder, "volume.dat")
+        write_metaimage(filename, self.volume.astype(np.uint8), data_file=data_file, HeaderSize=-1)
+        with open(data_file, 'rb') as f:
+            voxels = f.read()
+        with open(data_file, 'wb') as f:
+            f.write(b"header" + voxels)
+        info = probe_metaimage(filename)
+        self.check_info(info, 'metaimage', (6, 5, 4), np.uint8, False, 6, True, False, bit_depth=8)
+        self.assertEqual(info['data_file'], data_file)
+
+        writer = vtk.vtkMetaImageWriter()
+        image = vtk.vtkImageData()
+        image.SetDimensions(6, 5, 4)
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(self.volume.ravel(), deep=True))
+        filename = os.path.join(self.folder, "compressed.mha")
+        writer.SetFileName(filename)
+        writer.SetInputData(image)
+        writer.SetCompression(True)
+        writer.Write()
+        self.assertTrue(probe_volume(filename)['compressed'])
+
+        with open(filename, 'wb') as f:
+            f.write(b"NDims = 3\n")
+        with self.assertRaises(ValueError):
+            probe_metaimage(filename)
+
+    def test_probe_tiff_stack(self):
+        filenames = write_tiff_stack(self.folder, self.volume.astype(np.float32))
+        info = probe_volume(filenames)
+        self.check_info(info, 'tiff', (6, 5, 4), np.float32, sys.byteorder == 'big', None, True, True)
+        self.assertEqual(info, probe_tiff_stack(filenames))
+        self.assertEqual(probe_volume(filenames[:1])['shape'], (6, 5, 1))
+
+    def test_probe_hdf5(self):
+        filename = os.path.join(self.folder, "volume.nxs")
+        with h5py.File(filename, "w") as f:
+            f.create_dataset("entry/contiguous", data=self.volume.astype('>u2'))
+            f.create_dataset("entry/compressed", data=self.volume, chunks=(2, 5, 6), compression='gzip')
+            offset = f["entry/contiguous"].id.get_offset()
+        info = probe_volume(filename, "entry/contiguous")
+        self.check_info(info, 'hdf5', (4, 5, 6), '>u2', True, offset, False, False)
+        # the voxels are stored in place
+        self.assertEqual(np.fromfile(filename, dtype='>u2', count=self.volume.size, offset=offset).tobytes(),
+                         self.volume.astype('>u2').tobytes())
+        info = probe_hdf5(filename, "entry/compressed")
+        self.check_info(info, 'hdf5', (4, 5, 6), np.uint16, sys.byteorder == 'big', None, False, True)
+        with self.assertRaises(KeyError):
+            probe_hdf5(filename, "entry/missing")
+
+    def test_probe_unknown(self):
+        with self.assertRaises(ValueError):
+            probe_volume(os.path.join(self.folder, "volume.raw"))
+
+
+class TestLoadVolumeMapped(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(4)
+        # indexed z, y, x
+        self.volume = rng.integers(0, 65536, size=(4, 5, 6), dtype=np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def load(self, volume_info):
+        '''Returns a shallow copy of the mapped image, the image itself being garbage collected'''
+        image = vtk.vtkImageData()
+        self.assertTrue(load_volume_mapped(volume_info, image))
+        image_copy = vtk.vtkImageData()
+        image_copy.ShallowCopy(image)
+        del image
+        gc.collect()
+        return image_copy
+
+    def check_image(self, image, spacing=(1, 1, 1), origin=(0, 0, 0)):
+        self.assertEqual(image.GetDimensions(), (6, 5, 4))
+        self.assertEqual(image.GetSpacing(), spacing)
+        self.assertEqual(image.GetOrigin(), origin)
+        # allocate, so that freed memory would be reused
+        arrays = [np.full(self.volume.size, 7, dtype=np.uint16) for i in range(100)]
+        voxels = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+        self.assertEqual(voxels.dtype, np.uint16)
+        np.testing.assert_array_equal(voxels, self.volume.ravel())
+
+    def test_npy(self):
+        filename = os.path.join(self.folder, "volume.npy")
+        for dtype in ['<u2', '>u2']:
+            for fortran in [False, True]:
+                # a Fortran order array indexed x, y, z has the voxels in the same order
+                volume = self.volume.T if fortran else self.volume
+                np.save(filename, np.asfortranarray(volume, dtype=dtype) if fortran else volume.astype(dtype))
+                self.check_image(self.load(probe_volume(filename)))
+
+    def test_metaimage(self):
+        filename = os.path.join(self.folder, "volume.mha")
+        write_metaimage(filename, self.volume, ElementSpacing="1 2 3", Offset="4 5 6")
+        self.check_image(self.load(probe_volume(filename)), spacing=(1, 2, 3), origin=(4, 5, 6))
+        write_metaimage(filename, self.volume, big_endian=True)
+        self.check_image(self.load(probe_volume(filename)))
+
+    def test_raw(self):
+        filename = os.path.join(self.folder, "volume.raw")
+        with open(filename, 'wb') as f:
+            f.write(b"header")
+            f.write(self.volume.astype('>u2').tobytes())
+        image = self.load(probe_raw(filename, [6, 5, 4], 3, False, True, header_length=6))
+        self.check_image(image)
+        with open(filename, 'wb') as f:
+            f.write(self.volume.tobytes())
+        image = self.load(probe_raw(filename, [6, 5, 4], 3, False, False))
+        self.check_image(image)
+        # the map is copy-on-write
+        numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())[:] = 0
+        del image
+        gc.collect()
+        np.testing.assert_array_equal(np.fromfile(filename, dtype=np.uint16), self.volume.ravel())
+
+    def test_not_in_place(self):
+        filenames = write_tiff_stack(self.folder, self.volume)
+        self.assertFalse(load_volume_mapped(probe_volume(filenames), vtk.vtkImageData()))
+
+
+class TestSaveVolumeAsRaw(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.raw_file = os.path.join(self.folder, "volume.raw")
+        rng = np.random.default_rng(5)
+        # indexed z, y, x
+        self.volume = rng.integers(0, 65536, size=(11, 5, 6), dtype=np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_compressed(self, volume):
+        image = vtk.vtkImageData()
+        image.SetDimensions(volume.shape[2], volume.shape[1], volume.shape[0])
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(volume.ravel(), deep=True))
+        filename = os.path.join(self.folder, "compressed.mha")
+        writer = vtk.vtkMetaImageWriter()
+        writer.SetFileName(filename)
+        writer.SetInputData(image)
+        writer.SetCompression(True)
+        writer.Write()
+        return filename
+
+    def test_compressed_slabs(self):
+        filename = self.write_compressed(self.volume)
+        volume_info = probe_volume(filename)
+        for depth in [1, 4, 11, 20]:
+            slabs = list(iter_volume_slabs([filename], volume_info, depth=depth))
+            self.assertEqual([len(slab) for slab in slabs[:-1]], [depth] * (len(slabs) - 1))
+            np.testing.assert_array_equal(np.concatenate(slabs), self.volume)
+
+    def test_byte_order_and_layout(self):
+        progress = EmitRecorder()
+        save_volume_as_raw(self.write_compressed(self.volume), self.raw_file, '>u2', progress, 10, 90)
+        self.assertEqual(progress.values[-1], 90)
+        self.assertEqual(np.fromfile(self.raw_file, dtype='>u2').tobytes(), self.volume.astype('>u2').tobytes())
+
+        # x varies the fastest in the raw file
+        filename = os.path.join(self.folder, "volume.npy")
+        np.save(filename, np.asfortranarray(self.volume.T))
+        save_volume_as_raw(filename, self.raw_file, '<u2')
+        np.testing.assert_array_equal(np.fromfile(self.raw_file, dtype='<u2'), self.volume.ravel())
+
+    def test_scaled(self):
+        filename = os.path.join(self.folder, "volume.mha")
+        volume = self.volume.astype(np.float32) / 7
+        write_metaimage(filename, volume, big_endian=True)
+        save_volume_as_raw(filename, self.raw_file, '<u2')
+        m, M = volume.min(), volume.max()
+        expected = ((volume - m) / (M - m) * np.iinfo(np.uint16).max).astype(np.uint16)
+        np.testing.assert_array_equal(np.fromfile(self.raw_file, dtype='<u2'), expected.ravel())
+
+
+class TestChunkedVolume(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(6)
+        # more than a chunk along z and x, so that the chunks on the edges are partial
+        self.volume = rng.integers(0, 65536, size=(70, 9, 66), dtype=np.uint16)
+        self.image_file = os.path.join(self.folder, "volume.npy")
+        np.save(self.image_file, self.volume.astype('>u2'))
+        self.chunked_volume = os.path.join(self.folder, "chunked", "volume.h5")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_read_box(self):
+        os.mkdir(os.path.dirname(self.chunked_volume))
+        progress = EmitRecorder()
+        write_chunked_volume([self.image_file], probe_volume(self.image_file), self.chunked_volume,
+                             progress_callback=progress)
+        self.assertTrue(chunked_volume_is_current(self.chunked_volume, [self.image_file]))
+        for extent, clipped in [([10, 20, 2, 5, 30, 40], [10, 20, 2, 5, 30, 40]),
+                                # across the chunks, on the edges and outside of the volume
+                                ([60, 65, 0, 8, 60, 69], [60, 65, 0, 8, 60, 69]),
+                                ([-5, 3, -1, 2, 66, 80], [0, 3, 0, 2, 66, 69]),
+                                ([0, 100, 0, 100, 0, 100], [0, 65, 0, 8, 0, 69])]:
+            voxels, box = read_volume_box(self.chunked_volume, extent)
+            self.assertEqual(box, clipped)
+            x0, x1, y0, y1, z0, z1 = clipped
+            np.testing.assert_array_equal(voxels, self.volume[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1])
+
+    def test_failed_write_removed(self):
+        os.mkdir(os.path.dirname(self.chunked_volume))
+
+        class FailingCallback(object):
+            def emit(self, value):
+                raise OSError("No space left on device")
+
+        with self.assertRaises(OSError):
+            write_chunked_volume([self.image_file], probe_volume(self.image_file), self.chunked_volume,
+                                 progress_callback=FailingCallback())
+        self.assertEqual(os.listdir(os.path.dirname(self.chunked_volume)), [])
+
+    def test_load_box(self):
+        output_image = vtk.vtkImageData()
+        image_info = {}
+        # the chunked volume is written the first time, without progress callback
+        for i in range(2):
+            loadVolumeBox(image_files=[self.image_file], output_image=output_image, image_info=image_info,
+                          chunked_volume=self.chunked_volume, target_extent=[60, 70, 3, 8, -2, 4])
+            self.assertEqual(output_image.GetExtent(), (60, 65, 3, 8, 0, 4))
+            voxels = numpy_support.vtk_to_numpy(output_image.GetPointData().GetScalars())
+            np.testing.assert_array_equal(voxels, self.volume[0:5, 3:9, 60:66].ravel())
+        self.assertEqual(image_info['shape'], (66, 9, 70))
+        self.assertTrue(image_info['cropped'])
+
+
+class TestTIFFStackBinned(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(7)
+        # the dimensions are not multiples of the binning factors, the remainder is cropped
+        self.volume = rng.integers(0, 65536, size=(13, 10, 11), dtype=np.uint16)
+        self.filenames = write_tiff_stack(self.folder, self.volume)
+        # as read by the TIFF reader, see read_tiff_stack_serially
+        self.voxels = read_tiff_stack_serially(self.filenames).reshape(self.volume.shape)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_binned_geometry(self):
+        spacing, origin = binned_geometry({'spacing': (1, 2, 0.5), 'origin': (10, 0, -1)}, 3)
+        self.assertEqual(spacing, [3, 6, 1.5])
+        self.assertEqual(origin, [11, 2, -0.5])
+        # a binned voxel is at the centre of its block of voxels of the volume
+        spacing, origin = binned_geometry({}, 4)
+        for i in range(3):
+            self.assertEqual(origin[0] + i * spacing[0], np.mean(range(4 * i, 4 * i + 4)))
+        self.assertEqual(binning_factor((11, 10, 13), 2, 11 * 10 * 13 * 2), 1)
+        self.assertEqual(binning_factor((11, 10, 13), 2, 200), 3)
+
+    def test_binned_values(self):
+        for target_size, factor in [(10**6, 1), (300, 2), (200, 3), (16, 5)]:
+            image = vtk.vtkImageData()
+            progress = EmitRecorder()
+            self.assertEqual(read_tiff_stack_binned(self.filenames, image, target_size, progress, 0, 80, workers=3),
+                             factor)
+            self.assertEqual(progress.values[-1], 80)
+            bz, by, bx = [n // factor for n in self.volume.shape]
+            self.assertEqual(image.GetDimensions(), (bx, by, bz))
+            self.assertEqual(image.GetSpacing(), (factor, factor, factor))
+            self.assertEqual(image.GetOrigin(), ((factor - 1) / 2,) * 3)
+            expected = np.rint(self.voxels[:bz * factor, :by * factor, :bx * factor].astype(np.float64).reshape(
+                bz, factor, by, factor, bx, factor).mean(axis=(1, 3, 5)))
+            binned = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+            self.assertEqual(binned.dtype, np.uint16)
+            np.testing.assert_array_equal(binned, expected.ravel())
+
+    def test_cancel(self):
+        cancel_event = threading.Event()
+        cancel_event.set()
+        image = vtk.vtkImageData()
+        self.assertIsNone(read_tiff_stack_binned(self.filenames, image, 200, cancel_event=cancel_event))
+        self.assertIsNone(image.GetPointData().GetScalars())
+
+
+if __name__ == '__main__':
+    unittest.main()
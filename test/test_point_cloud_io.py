@@ -0,0 +1,62 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from idvc.utils.point_cloud_io import point_cloud_generation_key, reusable_point_cloud
+
+
+class TestPointCloudGenerationKey(unittest.TestCase):
+
+    def setUp(self):
+        self.parameters = {'mask': "ab12", 'subvol_size': 30, 'shape': 0, 'dimensionality': 1,
+                           'orientation': 2, 'slice': 40, 'overlap': [0.2, 0.2, 0.2], 'rotation': [0., 0., 0.],
+                           'erode': True, 'erosion_multiplier': 1.1, 'point0': [10., 20., 30.],
+                           'point0_sampled': [10, 20, 30]}
+
+    def test_key_stable(self):
+        key = point_cloud_generation_key(self.parameters)
+        self.assertEqual(point_cloud_generation_key(dict(reversed(list(self.parameters.items())))), key)
+        self.assertEqual(point_cloud_generation_key(dict(self.parameters)), key)
+
+    def test_key_changes(self):
+        key = point_cloud_generation_key(self.parameters)
+        changes = {'mask': "cd34", 'subvol_size': 40, 'shape': 1, 'dimensionality': 0, 'orientation': 1,
+                   'slice': 41, 'overlap': [0.3, 0.2, 0.2], 'rotation': [0., 10., 0.], 'erode': False,
+                   'erosion_multiplier': 1.2, 'point0': None, 'point0_sampled': None}
+        for name, value in changes.items():
+            parameters = dict(self.parameters)
+            parameters[name] = value
+            self.assertNotEqual(point_cloud_generation_key(parameters), key, name)
+
+    def test_reusable_point_cloud(self):
+        folder = tempfile.mkdtemp()
+        try:
+            key = point_cloud_generation_key(self.parameters)
+            filename = os.path.join("Results", "run", "_30.roi")
+            os.makedirs(os.path.join(folder, "Results", "run"))
+            with open(os.path.join(folder, filename), "w") as f:
+                f.write("1\t10\t20\t30\n")
+            generated = {key: (filename, 1)}
+            self.assertEqual(reusable_point_cloud(generated, key, folder), (filename, 1))
+            self.assertIsNone(reusable_point_cloud(generated, "other", folder))
+            # generated again if the file was removed, e.g. with the run folder
+            os.remove(os.path.join(folder, filename))
+            self.assertIsNone(reusable_point_cloud(generated, key, folder))
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
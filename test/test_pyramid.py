@@ -0,0 +1,56 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from idvc.utils.pyramid import PyramidWriter, choose_level, level_filename, read_pyramid, PYRAMID_FILENAME
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_levels(self):
+        rng = np.random.default_rng(0)
+        volume = rng.integers(0, 1000, size=(19, 17, 21), dtype=np.uint16)
+        writer = PyramidWriter(self.folder, (21, 17, 19), volume.dtype)
+        # slabs which are not aligned to the blocks of the levels
+        for start in range(0, 19, 3):
+            writer.add_slab(volume[start:start + 3])
+        writer.close()
+        pyramid = read_pyramid(os.path.join(self.folder, PYRAMID_FILENAME))
+        for factor in (2, 4, 8):
+            bx, by, bz = pyramid['levels'][factor]
+            self.assertEqual([bx, by, bz], [21 // factor, 17 // factor, 19 // factor])
+            expected = volume[:bz * factor, :by * factor, :bx * factor].astype(np.float64).reshape(
+                bz, factor, by, factor, bx, factor).mean(axis=(1, 3, 5))
+            level = np.fromfile(os.path.join(self.folder, level_filename(factor)), dtype=pyramid['dtype'])
+            np.testing.assert_allclose(level.reshape(bz, by, bx), expected, atol=0.5)
+
+    def test_choose_level(self):
+        dims, itemsize = (1000, 1000, 1000), 2
+        self.assertEqual(choose_level(dims, itemsize, 2e9), 1)
+        self.assertEqual(choose_level(dims, itemsize, 0.125 * 1024**3), 4)
+        self.assertIsNone(choose_level(dims, itemsize, 1e6))
+
+
+if __name__ == '__main__':
+    unittest.main()